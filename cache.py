@@ -0,0 +1,176 @@
+"""
+In-process Caches
+-----------------
+
+A small least-recently-used cache for values that are expensive to
+compute but rarely (or never) change, like the code behind a permalink.
+"""
+
+import threading
+import pickle
+from collections import OrderedDict
+from time import time
+
+class LRUCache(object):
+    """
+    A thread-safe least-recently-used cache with an optional time to
+    live for each entry.
+
+    The ``hits`` and ``misses`` attributes count lookups; to export
+    them as metrics, see :meth:`export`.
+
+    :arg int maxsize: the maximum number of entries; when the cache is
+        full, the least recently used entry is dropped
+    :arg float ttl: the number of seconds an entry stays valid, or
+        ``None`` to keep entries until they are pushed out
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize=maxsize
+        self.ttl=ttl
+        self.hits=0
+        self.misses=0
+        # (name, hits counter, misses counter) if exported
+        self._exported=None
+        self._lock=threading.Lock()
+        # key -> (value, expiration time)
+        self._data=OrderedDict()
+
+    def export(self, name, hits, misses):
+        """
+        Also count the hits and misses with metrics.
+
+        :arg str name: the value of the ``cache`` label
+        :arg metrics.Counter hits: the counter of hits, with a
+            ``cache`` label
+        :arg metrics.Counter misses: the counter of misses, with a
+            ``cache`` label
+        """
+        self._exported=(name, hits, misses)
+
+    def _count(self, hit):
+        if hit:
+            self.hits+=1
+        else:
+            self.misses+=1
+        if self._exported is not None:
+            name, hits, misses=self._exported
+            (hits if hit else misses).labels(name).inc()
+
+    def get(self, key, default=None):
+        """
+        Look up a key, marking it as recently used.
+
+        :arg key: the key
+        :arg default: the value to return if the key is not in the cache
+            or has expired
+        """
+        with self._lock:
+            try:
+                value, expires=self._data.pop(key)
+            except KeyError:
+                self._count(False)
+                return default
+            if expires is not None and expires<time():
+                self._count(False)
+                return default
+            self._data[key]=(value, expires)
+            self._count(True)
+            return value
+
+    def set(self, key, value):
+        """
+        Add or replace an entry.
+
+        :arg key: the key
+        :arg value: the value
+        """
+        expires=time()+self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key]=(value, expires)
+            while len(self._data)>self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        :returns: the number of ``entries``, ``hits``, and ``misses``
+        :rtype: dict
+        """
+        return {'entries': len(self), 'hits': self.hits, 'misses': self.misses}
+
+class UWSGICache(LRUCache):
+    """
+    A cache shared by all the worker processes of a uwsgi server,
+    stored in uwsgi's caching framework (start uwsgi with the
+    ``--cache`` option).  Values are pickled.  The ``hits`` and
+    ``misses`` counters are per process.
+
+    :arg int maxsize: ignored; the size is set by uwsgi's ``--cache``
+        option
+    :arg float ttl: the number of seconds an entry stays valid, or
+        ``None`` to keep entries until they are pushed out
+    :arg str prefix: a prefix for the keys, so that several caches can
+        share uwsgi's cache
+    """
+    def __init__(self, maxsize=None, ttl=None, prefix=''):
+        import uwsgi
+        LRUCache.__init__(self, maxsize, ttl)
+        self._uwsgi=uwsgi
+        self.prefix=prefix
+
+    def _key(self, key):
+        return self.prefix+repr(key)
+
+    def get(self, key, default=None):
+        """
+        See :meth:`LRUCache.get`
+        """
+        value=self._uwsgi.cache_get(self._key(key))
+        with self._lock:
+            self._count(value is not None)
+        if value is None:
+            return default
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        """
+        See :meth:`LRUCache.set`
+        """
+        self._uwsgi.cache_update(self._key(key), pickle.dumps(value, -1),
+                                 int(self.ttl or 0))
+
+    def clear(self):
+        """
+        uwsgi's cache can't be cleared from a worker; this does nothing.
+        """
+
+    def __len__(self):
+        return 0
+
+def new_cache(maxsize=1000, ttl=None, shared=False, prefix=''):
+    """
+    Make a cache: a :class:`UWSGICache` if ``shared`` is True and we are
+    running under uwsgi, otherwise an :class:`LRUCache` local to this
+    process.
+
+    :arg int maxsize: the maximum number of entries
+    :arg float ttl: the time to live for each entry, in seconds
+    :arg bool shared: share the cache between uwsgi workers if possible
+    :arg str prefix: a key prefix for a shared cache
+    """
+    if shared:
+        try:
+            return UWSGICache(maxsize, ttl, prefix)
+        except ImportError:
+            pass
+    return LRUCache(maxsize, ttl)
@@ -0,0 +1,97 @@
+u"""
+Tab Completion
+--------------
+
+Completion requests are answered by the IPython kernel whose ports are
+stored in the database (see :meth:`db.DB.get_ipython_port`).  A
+:class:`CompletionService` keeps a small pool of connections to the
+kernel, since a \xd8MQ socket can only be used by one thread at a time,
+and caches the matches for each line prefix, since many users type
+the same things.
+"""
+
+import Queue
+import zmq
+from uuid import uuid4
+from ip_receiver import IPReceiver
+from cache import LRUCache
+
+class CompletionTimeout(Exception):
+    """
+    Raised when the kernel doesn't answer a completion request in time.
+    """
+    pass
+
+class Completer(object):
+    u"""
+    One \xd8MQ connection to the kernel's request channel.  Replies are
+    matched to requests by ``msg_id``, so a late reply to a request that
+    timed out is never mistaken for the reply to a newer request.
+
+    :arg int port: the kernel's ``xreq`` port
+    """
+    def __init__(self, port):
+        self.receiver=IPReceiver(zmq.XREQ, port)
+
+    def complete(self, code, pos, timeout):
+        """
+        Ask the kernel for completions.
+
+        :arg str code: the line being completed
+        :arg int pos: the cursor position in the line
+        :arg float timeout: the time (in seconds) to wait for a reply
+        :returns: the list of matches
+        :raises CompletionTimeout: if there is no reply in time
+        """
+        header={"msg_id": str(uuid4())}
+        self.receiver.socket.send_json({"header": header, "msg_type": "complete_request",
+                "content": {"text": "", "line": code, "block": code, "cursor_pos": pos}})
+        replies=self.receiver.getMessages(header, timeout=timeout)
+        if not replies:
+            raise CompletionTimeout()
+        return replies[0]["content"]["matches"]
+
+class CompletionService(object):
+    """
+    Answers completion requests using a pool of :class:`Completer`
+    objects, and caches the matches for each line prefix.
+
+    :arg int port: the kernel's ``xreq`` port
+    :arg int backends: the number of connections to the kernel
+    :arg float timeout: the time (in seconds) a request may take,
+        including waiting for a free connection
+    :arg int cache_size: the maximum number of cached prefixes
+    :arg float cache_ttl: the time (in seconds) to keep cached matches
+    """
+    def __init__(self, port, backends=4, timeout=0.5, cache_size=1000, cache_ttl=60):
+        self.timeout=timeout
+        self.cache=LRUCache(cache_size, cache_ttl)
+        self._completers=Queue.Queue()
+        for i in range(backends):
+            self._completers.put(Completer(port))
+
+    def complete(self, code, pos):
+        """
+        Get the completions for a line, from the cache if possible.
+
+        :arg str code: the line being completed
+        :arg int pos: the cursor position in the line
+        :returns: the list of matches (empty if the kernel is too busy)
+        """
+        # only the text before the cursor matters
+        key=code[:pos]
+        matches=self.cache.get(key)
+        if matches is not None:
+            return matches
+        try:
+            completer=self._completers.get(timeout=self.timeout)
+        except Queue.Empty:
+            return []
+        try:
+            matches=completer.complete(code, pos, self.timeout)
+        except CompletionTimeout:
+            return []
+        finally:
+            self._completers.put(completer)
+        self.cache.set(key, matches)
+        return matches
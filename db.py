@@ -23,7 +23,9 @@ class DB(object):
     def new_input_message(self, msg):
         """
         Add a new computation request to the database to be retrieved
-        by :meth:`get_input_messages`.
+        by :meth:`get_input_messages`.  Once the message is committed,
+        adaptors announce it with :meth:`notify.Notifier.publish_input`
+        so that devices waiting for work wake up.
 
         :arg dict msg: the IPython-style message containing a new
             string of code to execute
@@ -35,7 +37,9 @@ class DB(object):
         Find the computations that haven't been started yet,
         mark them as in-progress with the device ID and return
         the cells. The :obj:`limit` keyword can give an upper 
-        on the number of unassigned sessions returned.
+        on the number of unassigned sessions returned.  Devices pass
+        the number of sessions they can start soon, so that they
+        don't claim sessions another device could start at once.
 
         The database also stores a list of sessions for each device.
         Currently, we rely on each message having a device attribute
@@ -51,6 +55,17 @@ class DB(object):
         """
         raise NotImplementedError
 
+    def get_unassigned_count(self):
+        """
+        Count the computations that no device has claimed yet.  The web
+        server uses this to estimate how long a new computation would
+        wait for a worker.
+
+        :returns: the number of unclaimed input messages
+        :rtype: int
+        """
+        raise NotImplementedError
+
     def get_input_message_by_shortened(self, shortened):
         """
         Retrieve the input code for a shortened field
@@ -64,7 +79,10 @@ class DB(object):
 
     def add_messages(self, messages):
         """
-        Add IPython-style output messages to the database.
+        Add IPython-style output messages to the database.  Once the
+        messages are committed, adaptors announce them with
+        :meth:`notify.Notifier.publish_messages` so that waiting web
+        requests wake up.
 
         :arg list output: the messages to add
         """
@@ -87,6 +105,16 @@ class DB(object):
         """
         raise NotImplementedError
 
+    def set_device_slots(self, device, slots):
+        """
+        Record how many more sessions a device can start right away.
+        A new device has as many free slots as workers.
+
+        :arg str device: device ID
+        :arg int slots: the number of free workers
+        """
+        raise NotImplementedError
+
     def delete_device(self, device):
         """
         Delete a device from the database
@@ -97,22 +125,44 @@ class DB(object):
 
     def get_devices(self):
         """
-        :returns: currently registered devices
+        :returns: currently registered devices, as dicts with the keys
+            ``device``, ``account``, ``pgid``, ``workers`` and ``slots``
+            (see :meth:`set_device_slots`)
         :rtype: list
         """
         raise NotImplementedError
 
-    def get_messages(self, session, sequence=0):
+    def get_messages(self, session, sequence=0, limit=None):
         """
         Get the messages from some session, starting with
-        the message with sequence number ``sequence``.
+        the message with sequence number ``sequence``, in order.
 
         :arg str session: the session ID
         :arg int sequence: the minimum sequence in the returned messages
+        :arg int limit: the maximum number of messages to return, or
+            ``None`` for all of them
         :returns: a list of IPython-style messages
         """
         raise NotImplementedError
 
+    def get_messages_json(self, session, sequence=0, limit=None):
+        """
+        Like :meth:`get_messages`, but return each message encoded as
+        JSON.  Adaptors that store messages as JSON return the stored
+        strings, so the web server can pass output on without decoding
+        and encoding it again.
+
+        :arg str session: the session ID
+        :arg int sequence: the minimum sequence in the returned messages
+        :arg int limit: the maximum number of messages to return, or
+            ``None`` for all of them
+        :returns: a list of ``(sequence, JSON string)`` tuples
+        :rtype: list
+        """
+        import json
+        return [(m['sequence'], json.dumps(m))
+                for m in self.get_messages(session, sequence, limit=limit)]
+
     def close_session(self, device, session):
         u"""
         Delete a session-to-device mapping.
@@ -166,3 +216,20 @@ class DB(object):
         :returns: a new database object
         :rtype: DB
         """
+
+    def reset_context(self):
+        """
+        Return a context created by :meth:`new_context_copy` to a clean
+        state (for example, end any open transaction) so that another
+        request can reuse it.
+        """
+
+    def check_context(self):
+        """
+        Check that a context is still usable, for example that its
+        connection to the database has not gone away.
+
+        :returns: True if the context can be used
+        :rtype: bool
+        """
+        return True
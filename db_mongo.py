@@ -41,25 +41,36 @@ try:
 except ImportError:
     from sagecell_config_default import mongo_config
 
-from util import log
+from util import log, get_logger
+from notify import notifier
 import uuid
 
+logger=get_logger('db')
+
 class DB(db.DB):
     """
     MongoDB database adaptor
 
     :arg pymongo.Connection c: the PyMongo Connection object
         for the database
+    :arg bool ensure_indexes: whether to make sure the indexes exist;
+        copies made by :meth:`new_context_copy` skip this, so it only
+        happens once per process
     """
 
-    def __init__(self, c):
+    def __init__(self, c, ensure_indexes=True):
         self.c=c
         self.new_context()
+        if ensure_indexes:
+            self._ensure_indexes()
+
+    def _ensure_indexes(self):
         self.database.sessions.ensure_index([('session', ASCENDING)])
         self.database.input_messages.ensure_index([('device', ASCENDING)])
         self.database.input_messages.ensure_index([('evaluated',ASCENDING)])
         self.database.input_messages.ensure_index([('shortened',ASCENDING)])
         self.database.messages.ensure_index([('parent_header.session', ASCENDING)])
+        self.database.messages.ensure_index([('parent_header.session', ASCENDING), ('sequence', ASCENDING)])
 
     def new_input_message(self, msg):
         # look up device; None means a device has not yet been assigned
@@ -76,6 +87,7 @@ class DB(db.DB):
         import datetime
         msg['timestamp']=datetime.datetime.utcnow()
         self.database.input_messages.insert(msg)
+        notifier.publish_input()
 
     def get_input_message_by_shortened(self, shortened):
         """
@@ -129,26 +141,34 @@ class DB(db.DB):
         if len(unassigned_messages)>0:
             self.database.sessions.insert([{'session':m['header']['session'], 'device':device} 
                                            for m in unassigned_messages])
-            log("DEVICE %s took SESSIONS %s"%(device, [m['header']['session'] for m in unassigned_messages]))
+            logger.debug("DEVICE %s took SESSIONS %s", device, [m['header']['session'] for m in unassigned_messages])
 
         return device_messages+unassigned_messages
 
+    def get_unassigned_count(self):
+        """
+        See :meth:`db.DB.get_unassigned_count`
+        """
+        return self.database.input_messages.find({'device':None, 'evaluated':False}).count()
+
     def close_session(self, device, session):
         """
         See :meth:`db.DB.close_session`
         """
         self.database.sessions.remove({'session':session, 'device':device})
 
-    def get_messages(self, session, sequence=0):
+    def get_messages(self, session, sequence=0, limit=None):
         """
         See :meth:`db.DB.get_messages`
         """
-        messages=list(self.database.messages.find({'parent_header.session':session,
-                                            'sequence':{'$gte':sequence}}))
-        #TODO: just get the fields we want instead of deleting the ones we don't want
-        for m in messages:
-            del m['_id']
-        return messages
+        cursor=self.database.messages.find({'parent_header.session':session,
+                                            'sequence':{'$gte':sequence}},
+                                           {'_id': False}).sort('sequence', ASCENDING)
+        if limit is not None:
+            if limit<=0:
+                return []
+            cursor=cursor.limit(limit)
+        return list(cursor)
 
     def add_messages(self, messages):
         """
@@ -171,9 +191,10 @@ class DB(db.DB):
                       "msg_type": "execute_reply",
                       "output_block": None,
                       "sequence": m["sequence"]})
-        log("INSERTED: %s"%('\n'.join(str(m)[:1000] for m in success),))
+        notifier.publish_messages(messages)
+        logger.debug("INSERTED: %s", success)
         if len(success) < len(messages):
-            log("FAILED TO INSERT %d message(s)" % (len(messages) - len(success)))
+            logger.warning("FAILED TO INSERT %d message(s)", len(messages) - len(success))
 
     def purge_output(self):
         """
@@ -188,7 +209,8 @@ class DB(db.DB):
         """
         See :meth:`db.DB.register_device`
         """
-        doc={"device":device, "account":account, "workers": workers, "pgid":pgid}
+        doc={"device":device, "account":account, "workers": workers, "pgid":pgid,
+             "slots": workers}
         self.database.device.insert(doc)
         log("REGISTERED DEVICE: %s"%doc)
 
@@ -198,6 +220,12 @@ class DB(db.DB):
         """
         self.database.device.remove({'device': device})
 
+    def set_device_slots(self, device, slots):
+        """
+        See :meth:`db.DB.set_device_slots`
+        """
+        self.database.device.update({'device': device}, {'$set': {'slots': slots}})
+
     def get_devices(self):
         """
         See :meth:`db.DB.get_devices`
@@ -232,6 +260,20 @@ class DB(db.DB):
                 raise Exception("MongoDB authentication problem")
 
     def new_context_copy(self):
-        return type(self)(self.c)
+        """
+        See :meth:`db.DB.new_context_copy`
+        """
+        return type(self)(self.c, ensure_indexes=False)
+
+    def check_context(self):
+        """
+        See :meth:`db.DB.check_context`
+        """
+        try:
+            self.database.command('ping')
+            return True
+        except Exception:
+            return False
 
-    valid_untrusted_methods=('get_input_messages', 'close_session', 'add_messages')
+    valid_untrusted_methods=('get_input_messages', 'close_session', 'add_messages',
+                             'set_device_slots')
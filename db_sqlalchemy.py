@@ -1,14 +1,27 @@
 """
 SQLAlchemy Database Adapter
 ---------------------------
+
+The tables are created when the adaptor is first used.  Since
+SQLAlchemy doesn't change tables that already exist, the adaptor also
+brings older databases up to date when it starts:
+
+* the index of the ``messages`` table on ``(parent_session, sequence)``,
+  which output polling uses, is created if it is missing
+* the ``slots`` column of the ``devices`` table, where devices report
+  their free workers, is added if it is missing; devices registered
+  before the upgrade count as having no free workers
 """
 import db
 import json
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from sqlalchemy import create_engine, inspect, Column, Integer, String, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
-from util import log
+from util import log, get_logger
+from notify import notifier
+
+logger = get_logger('db')
 
 class DB(db.DB):
     """
@@ -21,6 +34,16 @@ class DB(db.DB):
             engine = create_engine(db_file)
             self.SQLSession = sessionmaker(bind=engine)
             Base.metadata.create_all(engine)
+            # create_all skips the indexes and columns of tables that
+            # already exist
+            inspector = inspect(engine)
+            indexes = [i['name'] for i in inspector.get_indexes(Message.__tablename__)]
+            for index in Message.__table__.indexes:
+                if index.name not in indexes:
+                    index.create(engine)
+            columns = [c['name'] for c in inspector.get_columns(Device.__tablename__)]
+            if 'slots' not in columns:
+                engine.execute('ALTER TABLE %s ADD COLUMN slots INTEGER' % Device.__tablename__)
             self.new_context()
 
     def new_input_message(self, msg):
@@ -37,6 +60,7 @@ class DB(db.DB):
         jsonMessageSync(message, True)
         self.dbsession.add(message)
         self.dbsession.commit()
+        notifier.publish_input()
 
     def get_input_messages(self, device, limit=None):
         """
@@ -59,8 +83,8 @@ class DB(db.DB):
                 row.device_id = device
                 jsonMessageSync(row, True)
             if len(unassigned_messages) > 0:
-                log("DEVICE %s took SESSIONS %s"%(device,
-                        [m.session_id for m in unassigned_messages]))
+                logger.debug("DEVICE %s took SESSIONS %s", device,
+                        [m.session_id for m in unassigned_messages])
         self.dbsession.commit()
         device_messages = [json.loads(m.json_message) for m in device_messages]
         unassigned_messages = [json.loads(m.json_message) for m in unassigned_messages]
@@ -85,13 +109,22 @@ class DB(db.DB):
             jsonMessageSync(m, False)
         self.dbsession.add_all(msgs)
         self.dbsession.commit()
-        log("INSERTED: %s" % ('\n'.join(str(m) for m in messages),))
+        notifier.publish_messages(messages)
+        logger.debug("INSERTED: %s", messages)
+
+    def get_unassigned_count(self):
+        """
+        See :meth:`db.DB.get_unassigned_count`
+        """
+        return self.dbsession.query(InputMessage) \
+                   .filter_by(device_id=None, evaluated=False).count()
 
     def register_device(self, device, account, workers, pgid):
         """
         See :meth:`db.DB.register_device`
         """
-        device = Device(device_id=device, account=account, workers=workers, pgid=pgid)
+        device = Device(device_id=device, account=account, workers=workers, pgid=pgid,
+                        slots=workers)
         self.dbsession.add(device)
         self.dbsession.commit()
         log("REGISTERED DEVICE: %s" % (device,))
@@ -100,7 +133,14 @@ class DB(db.DB):
         """
         See :meth:`db.DB.delete_device`
         """
-        self.dbsession.query(DB.Device).filter(device_id=device).delete()
+        self.dbsession.query(Device).filter_by(device_id=device).delete()
+        self.dbsession.commit()
+
+    def set_device_slots(self, device, slots):
+        """
+        See :meth:`db.DB.set_device_slots`
+        """
+        self.dbsession.query(Device).filter_by(device_id=device).update({'slots': slots})
         self.dbsession.commit()
 
 
@@ -109,18 +149,34 @@ class DB(db.DB):
         See :meth:`db.DB.get_devices`
         """
         return [{'device': row.device_id, 'account': row.account,
-                 'pgid': row.pgid, 'workers': row.workers} for row in
-                 self.dbsession.query(DB.Device)]
+                 'pgid': row.pgid, 'workers': row.workers, 'slots': row.slots} for row in
+                 self.dbsession.query(Device)]
 
-    def get_messages(self, session, sequence=0):
+    def get_messages(self, session, sequence=0, limit=None):
         """
         See :meth:`db.DB.get_messages`
         """
-        messages = self.dbsession.query(Message.json_message) \
-                       .filter_by(parent_session=session) \
-                       .filter(Message.sequence >= sequence).all()
+        q = self.dbsession.query(Message.json_message) \
+                .filter_by(parent_session=session) \
+                .filter(Message.sequence >= sequence) \
+                .order_by(Message.sequence)
+        if limit is not None:
+            q = q.limit(limit)
+        messages = q.all()
         return [json.loads(m.json_message) for m in messages]
 
+    def get_messages_json(self, session, sequence=0, limit=None):
+        """
+        See :meth:`db.DB.get_messages_json`
+        """
+        q = self.dbsession.query(Message.sequence, Message.json_message) \
+                .filter_by(parent_session=session) \
+                .filter(Message.sequence >= sequence) \
+                .order_by(Message.sequence)
+        if limit is not None:
+            q = q.limit(limit)
+        return [(m.sequence, m.json_message) for m in q]
+
     def close_session(self, device, session):
         """
         See :meth:`db.DB.close_session`
@@ -143,7 +199,24 @@ class DB(db.DB):
         new.new_context()
         return new
 
-    valid_untrusted_methods=('get_input_messages', 'close_session', 'add_messages')
+    def reset_context(self):
+        """
+        See :meth:`db.DB.reset_context`
+        """
+        self.dbsession.close()
+
+    def check_context(self):
+        """
+        See :meth:`db.DB.check_context`
+        """
+        try:
+            self.dbsession.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    valid_untrusted_methods=('get_input_messages', 'close_session', 'add_messages',
+                             'set_device_slots')
 
 Base = declarative_base()
 
@@ -160,6 +233,7 @@ class Device(Base):
     account = Column(String)
     workers = Column(Integer)
     pgid = Column(Integer)
+    slots = Column(Integer)
 
 class InputMessage(Base):
     """
@@ -188,6 +262,8 @@ class Message(Base):
     json_message = Column("json_message", String)
     parent_session = Column(String)
     sequence = Column(Integer)
+    # output is always read by session, in order
+    __table_args__ = (Index('ix_messages_session_sequence', 'parent_session', 'sequence'),)
 
 def jsonMessageSync(row, syncToJSON):
     """
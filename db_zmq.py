@@ -94,10 +94,19 @@ class DB(db.DB):
         """
         See :meth:`db.DB.add_messages`
         """
+        self.add_encoded_messages([(m['parent_header']['session'], dumps(m)) for m in messages],
+                                  hmacs)
+
+    def add_encoded_messages(self, messages, hmacs=None):
+        """
+        Like :meth:`add_messages`, but for messages that are already
+        JSON, which are sent on without decoding them.
+
+        :arg list messages: ``(session, JSON string)`` tuples
+        :arg dict hmacs: the :mod:`hmac` objects of the sessions
+        """
         new=[]
-        for m in messages:
-            s=dumps(m)
-            session=m['parent_header']['session']
+        for session, s in messages:
             if session in hmacs:
                 hmacs[session].update(s)
                 d=hmacs[session].hexdigest()
@@ -115,3 +124,4 @@ class DB(db.DB):
     close_session = db_method('close_session', ['device', 'session'])
     get_messages = db_method('get_messages', ['id','sequence'])
     register_device = db_method('register_device',['device', 'account', 'workers', 'pgid'])
+    set_device_slots = db_method('set_device_slots', ['device', 'slots'])
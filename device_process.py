@@ -1,28 +1,38 @@
 r"""
-The DEVICE process continuously polls the database for new cells and
-evaluations on current sessions. Each time a new session is required
-for a computation, the DEVICE starts up a DEVICE_WORKER process by
-executing it in a :class:`multiprocessing.pool.multiprocessing.Pool`.
-This pool has a limited number of workers, so there is a maximum
-number of simultaneous active sessions.
-
-The DEVICE_WORKER creates a temporary directory for the executed code
-to use for any files it creates. It then starts an EXEC process that
-executes the code.
-
-The EXEC process receives execution requests (both the initial message
+The DEVICE process waits for new cells and evaluations on current
+sessions and fetches them from the database.  If there is a
+notification bus (see :mod:`notify`), it sleeps until the trusted
+database (see :func:`trusted_db.loop`) passes on the bus's announcement
+of new input, rechecking the database only now and then in case an
+announcement was lost; otherwise it checks the database every
+``poll_interval`` seconds. Each time a new session is required
+for a computation, the DEVICE hands it to the ZYGOTE (see
+:class:`Zygote`).  The ZYGOTE is a process that imported Sage, ran the
+code every session starts with, and ran a warm-up corpus (``WARMUP``
+in ``sagecell_exec_config``) once, when the DEVICE started.  It keeps
+a few SESSION processes forked from itself and ready, so starting a
+session only takes a message down a pipe.  There is a limited number
+of workers, so there is a maximum number of simultaneous active
+sessions; more sessions wait for a worker.
+
+A SESSION process works in a temporary directory for the executed code
+to use for any files it creates. It runs the EXEC loop that executes
+the code.
+
+The EXEC loop receives execution requests (both the initial message
 and updates to interacts in the session) through a queue created by the
-DEVICE_WORKER. Messages to the EXEC_WORKER process have the form
+DEVICE. Messages to the EXEC loop have the form
 ``('command', dict_of_options)``.
 
-When the EXEC process receives an execution request, it runs it
+When the EXEC loop receives an execution request, it runs it
 in a minimal namespace. Any messages to stdout or stderr are
-redirected into a global output queue. The EXEC process is also
+buffered (see :class:`ChannelQueue`) and redirected into a global
+output pipe of frames (see :mod:`frames`). The EXEC loop is also
 responsible for sending back ``execute_reply`` messages through
 the global queue.
 
 If the code contains an :doc:`interact </interact_protocol>`, it will
-increase the time limit on the EXEC process so that, when the user
+increase the time limit on the EXEC loop so that, when the user
 updates the interact, the update will be sent to that process.
 Whenever an interact's internal code is executed, all output messages
 from that execution will include a field containing the interact's ID
@@ -30,39 +40,32 @@ number, which tells the user's browser to place that output in a
 location associated with the interact (probably below the interact
 control).
 
-The DEVICE process polls the global output queue for messages. When it
-receives a message, it inserts it into the database for the web server
-to read.
+The DEVICE process also waits on the global output pipe for messages.
+When it receives messages, it numbers them, joins consecutive stream
+messages, and inserts them into the database for the web server to
+read, all without decoding them.
 
 .. warning::
   You can specify resource limits, but please note that the memory limit is *not* enforced on OSX, as RLIMIT_AS is a suggestion, not a hard cap.
 """
 
-import sys, time, traceback, StringIO, contextlib, random, uuid
+import sys, time, StringIO, random, uuid, threading
 import util
 import hmac
 from util import log
 # TODO: be smart about importing json
 import json
-from json import dumps, loads
+from json import dumps
 from hashlib import sha1
 import interact_sagecell
 import sagecell_exec_config as CONFIG
 import re
 
-try:
-    import sage
-    import sage.all
-    CONFIG.EMBEDDED_MODE["enable_sage"] = enable_sage = True
-    # The first plot takes about 2 seconds to generate (presumably
-    # because lots of things, like matplotlib, are imported).  We plot
-    # something here so that worker processes don't have this overhead
-    # (I think what is happening is that we are priming the import
-    # cache here).  After this fix, worker processes' first plot takes
-    # something like 0.6 seconds (instead of 2 seconds).
-    sage.all.plot(lambda x: x, (0,1)).save(StringIO.StringIO())
-except ImportError as e:
-    CONFIG.EMBEDDED_MODE["enable_sage"] = enable_sage = False
+logger=util.get_logger('device')
+
+# Sage is imported by the zygote (see load_sage)
+sage = None
+CONFIG.EMBEDDED_MODE["enable_sage"] = enable_sage = False
 
 user_code="""
 import sys
@@ -83,16 +86,14 @@ def _update_interact(id, control_vals):
     interact_sagecell._INTERACTS[id]["function"](control_vals=kwargs)
 """
 
-user_code_sage="""
+# The namespace every Sage-mode execution starts with.  The zygote runs
+# this once; each execution gets a copy of the resulting namespace.
+prelude_sage="""
 from sage.all import *
 from sage.calculus.predefined import x
 from sage.misc.html import html
 from sage.server.support import help
 from sagenb.misc.support import automatic_names
-sage.misc.session.init()
-
-# Ensure unique random state after forking
-set_random_seed()
 
 #try:
 #    attach(os.path.join(os.environ['DOT_SAGE'], 'init.sage'))
@@ -106,8 +107,43 @@ from interact_compatibility import * # override the interact functionality
 import sage.misc.misc
 import sagecell_exec_config
 sage.misc.misc.EMBEDDED_MODE=sagecell_exec_config.EMBEDDED_MODE
+"""
+prelude={}
+
+user_code_sage="""
+sage.misc.session.init()
 """+user_code
 
+def load_sage(warmup=()):
+    """
+    Import Sage, run :data:`prelude_sage` into :data:`prelude`, and
+    run the warm-up code.  The zygote (see :class:`Zygote`) does this
+    once, so that the session processes forked from it don't have to.
+
+    :arg list warmup: Sage code to run once, so that the imports and
+        caches it fills (for plotting, symbolics, typesetting, ...)
+        are ready in every session; its output is thrown away
+    """
+    global sage, enable_sage
+    try:
+        import sage.all
+    except ImportError:
+        return
+    CONFIG.EMBEDDED_MODE["enable_sage"] = enable_sage = True
+    start=time.time()
+    exec prelude_sage in prelude
+    from sage.misc.preparser import preparse_file
+    for code in warmup:
+        old_stdout=sys.stdout
+        sys.stdout=StringIO.StringIO()
+        try:
+            exec preparse_file(code) in dict(prelude)
+        except Exception:
+            logger.warning("Warm-up code failed: %r", code, exc_info=True)
+        finally:
+            sys.stdout=old_stdout
+    logger.info("Loaded Sage in %.2f seconds", time.time()-start)
+
 line_prefix = re.compile(r"^[ \t]*(>>>|sage:|In \[\d+\]:|\.{3}(\.*:)?) ", re.MULTILINE)
 
 class QueueOut(StringIO.StringIO):
@@ -122,7 +158,7 @@ class QueueOut(StringIO.StringIO):
     custom message type).
 
     :arg str session: the session ID to include in a message's header
-    :arg multiprocessing.Queue queue: a global message queue
+    :arg frames.FramePipe queue: the global output pipe
     :arg dict parent_header: the header of the message to which
         messages from this object are the reply
     """
@@ -132,30 +168,55 @@ class QueueOut(StringIO.StringIO):
         self.queue=queue
         self.parent_header=parent_header
         self.output_block=None
+        # the queues whose buffered output has to be sent before a
+        # message from this one, and the lock they share (see
+        # OutputIPython)
+        self.group=[self]
+        self.lock=threading.RLock()
 
-    def raw_message(self, msg_type, content):
+    def flush_group(self):
         """
-        Send a message where you can change the outer
-        IPython ``msg_type`` and completely specify the content.
+        Send the output buffered by the other queues of the group, so
+        that it comes before this queue's next message.
+        """
+        for q in self.group:
+            if q is not self:
+                q.flush()
+
+    def new_message(self, msg_type):
+        """
+        Make a message without a content.
 
         :arg str msg_type: the message type
-        :arg dict content: the ``content`` field of the IPython message
+        :rtype: dict
         """
         # We don't use uuid4() for the msg_id since there is a bug in
         # older python versions (fixed in 2.6.6, I think) on OSX
         # that leads to each session having exactly the same sequence of UUIDs
         # see http://bugs.python.org/issue8621
         msg_id = random.randrange(sys.maxint)
-        msg = {'msg_type': msg_type,
-               'parent_header': self.parent_header,
-               # We don't transmit the session id in the header since
-               # it should already be in the parent_header
-               'header': {'msg_id':unicode(msg_id)},
-               'output_block': self.output_block,
-               'content': content}
-        msg=dumps(msg)
-        self.queue.put(msg)
-        log("USER MESSAGE PUT IN QUEUE: %r\n"%(msg[:1000]))
+        return {'msg_type': msg_type,
+                'parent_header': self.parent_header,
+                # We don't transmit the session id in the header since
+                # it should already be in the parent_header
+                'header': {'msg_id':unicode(msg_id)},
+                'output_block': self.output_block}
+
+    def raw_message(self, msg_type, content):
+        """
+        Send a message where you can change the outer
+        IPython ``msg_type`` and completely specify the content.
+
+        :arg str msg_type: the message type
+        :arg dict content: the ``content`` field of the IPython message
+        """
+        msg=self.new_message(msg_type)
+        msg['content']=content
+        frame=frames.message_frame(self.session, msg, self.output_block)
+        with self.lock:
+            self.flush_group()
+            self.queue.send(frame)
+        logger.debug("USER MESSAGE PUT IN QUEUE: %.1000r", frame.prefix)
 
 class ChannelQueue(QueueOut):
     """
@@ -163,24 +224,69 @@ class ChannelQueue(QueueOut):
     :class:`StringIO.StringIO` object, adds an IPython-style
     stream message to the queue.
 
+    What is written is buffered, and sent as one message when
+    ``flush_size`` characters have been written, ``flush_interval``
+    seconds after the first write, when the stream is flushed, or just
+    before another queue of the group sends a message.
+
     :arg str session: the session ID to include in a message's header
-    :arg multiprocessing.Queue queue: a global message queue
+    :arg frames.FramePipe queue: the global output pipe
     :arg str channel: the name of the channel (such as ``"stdout"``)
     :arg dict parent_header: the header of the message to which
         messages from this object are the reply
+    :arg int flush_size: the number of characters to buffer
+    :arg float flush_interval: the longest time (in seconds) to keep
+        output buffered
     """
-    def __init__(self, session, queue, channel, parent_header=None):
+    def __init__(self, session, queue, channel, parent_header=None,
+                 flush_size=4096, flush_interval=0.1):
         QueueOut.__init__(self, session=session, queue=queue, parent_header=parent_header)
         self.channel=channel
+        self.flush_size=flush_size
+        self.flush_interval=flush_interval
+        self._buffer=[]
+        self._size=0
+        self._timer=None
 
     def write(self, output):
         """
         Write some data to the output stream.
 
-        :arg str output: the string to add to the stream
+        :arg str output: the string to add to the stream; bytes that
+            aren't UTF-8 are replaced
         """
-        self.raw_message(msg_type='stream',
-                         content={'data': output, 'name':self.channel})
+        if not output:
+            return
+        if isinstance(output, str):
+            # decode now, so that a bad chunk can't break a later flush
+            output=output.decode('utf8', 'replace')
+        with self.lock:
+            self.flush_group()
+            self._buffer.append(output)
+            self._size+=len(output)
+            if self._size>=self.flush_size:
+                self.flush()
+            elif self._timer is None:
+                self._timer=threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon=True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Send the buffered output.
+        """
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer=None
+            if not self._buffer:
+                return
+            # take the output first, so that it is dropped even if it
+            # can't be sent
+            data, self._buffer, self._size=self._buffer, [], 0
+            frame=frames.stream_frame(self.session, self.new_message('stream'),
+                                      self.channel, data, self.output_block)
+            self.queue.send(frame)
 
 class QueueOutMessage(QueueOut):
     """
@@ -188,7 +294,7 @@ class QueueOutMessage(QueueOut):
     inside another message with the ``extension`` message type.
 
     :arg str session: the session ID to include in a message's header
-    :arg multiprocessing.Queue queue: a global message queue
+    :arg frames.FramePipe queue: the global output pipe
     :arg dict parent_header: the header of the message to which
         messages from this object are the reply
     """
@@ -224,24 +330,42 @@ class OutputIPython(object):
     written to the client.
 
     :arg str session: the session ID to include in a message's header
-    :arg multiprocessing.Queue queue: a global message queue
+    :arg frames.FramePipe queue: the global output pipe
     :arg dict parent_header: the header of the message to which
         messages from this object are the reply
     """
     def __init__(self, session, queue, parent_header=None):
         self.session=session
         self.queue=queue
-        self.stdout_queue=ChannelQueue(self.session, self.queue, "stdout", parent_header)
-        self.stderr_queue=ChannelQueue(self.session, self.queue, "stderr", parent_header)
+        flush_size=getattr(CONFIG, 'STREAM_FLUSH_SIZE', 4096)
+        flush_interval=getattr(CONFIG, 'STREAM_FLUSH_INTERVAL', 0.1)
+        self.stdout_queue=ChannelQueue(self.session, self.queue, "stdout", parent_header,
+                                       flush_size, flush_interval)
+        self.stderr_queue=ChannelQueue(self.session, self.queue, "stderr", parent_header,
+                                       flush_size, flush_interval)
         self.message_queue=QueueOutMessage(self.session, self.queue, parent_header)
+        # keep the order of the output of all three queues
+        group=[self.stdout_queue, self.stderr_queue, self.message_queue]
+        lock=threading.RLock()
+        for q in group:
+            q.group=group
+            q.lock=lock
         self.out_stack=[]
 
+    def flush(self):
+        """
+        Send the output buffered by stdout and stderr.
+        """
+        self.stdout_queue.flush()
+        self.stderr_queue.flush()
+
     def set_parent_header(self, parent_header):
         """
         Set the parent header on all output queues
 
         :arg dict parent_header: the new parent header
         """
+        self.flush()
         for q in [self.stdout_queue, self.stderr_queue, self.message_queue]:
             q.parent_header=parent_header
 
@@ -259,6 +383,8 @@ class OutputIPython(object):
         :arg str block: the ID of the output block (in the case of an
             interact, the interact ID)
         """
+        # buffered output goes to the block it was written to
+        self.flush()
         self.out_stack.append(block)
         for q in [self.stdout_queue, self.stderr_queue, self.message_queue]:
             q.output_block=block
@@ -270,6 +396,7 @@ class OutputIPython(object):
         """
         if len(self.out_stack)==0:
             return
+        self.flush()
         self.out_stack.pop()
         block=self.out_stack[-1] if len(self.out_stack)>0 else None
         for q in [self.stdout_queue, self.stderr_queue, self.message_queue]:
@@ -297,6 +424,7 @@ class OutputIPython(object):
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
         sys.stdout=self.old_stdout
         sys.stderr=self.old_stderr
         sys.displayhook = self.old_display
@@ -306,11 +434,239 @@ class OutputIPython(object):
         # supress the exception
         return False
 
-from multiprocessing import Pool, TimeoutError, Process, Queue, current_process, Manager, Pipe
-from raw_queue import RawQueue
-import uuid
+from multiprocessing import Process, Manager, Pipe
+import frames
+from collections import deque
+import cPickle
 
-def device(db, fs, workers, interact_timeout, keys, poll_interval=0.1, resource_limits=None):
+class Zygote(object):
+    """
+    The process that session processes are forked from.  It loads Sage
+    (see :func:`load_sage`) when it starts, and keeps ``idle`` session
+    processes (see :func:`session_process`) forked and waiting, so that
+    a session can start as soon as the device asks for it.  At most
+    ``workers`` sessions run at once; the rest wait in order.
+
+    The device talks to the zygote through a pipe: it sends the
+    sessions to start (:meth:`start`) and receives the IDs of the
+    sessions that have finished (:meth:`finished`).  The zygote sleeps
+    until the device sends a session or a session process exits
+    (``SIGCHLD``).
+
+    If the zygote dies, the device starts a new one.  The sessions that
+    the old zygote had been given are reported as finished, since their
+    processes can no longer be waited for.
+
+    :arg int workers: the maximum number of sessions running at once
+    :arg int idle: the number of session processes to keep ready
+    :arg list warmup: Sage code to run in the zygote before forking
+        session processes (see :func:`load_sage`)
+    """
+    def __init__(self, workers, idle=2, warmup=()):
+        self.workers=workers
+        self.idle=idle
+        self.warmup=warmup
+        # the sessions started and not finished yet, and the sessions
+        # lost with a zygote that died
+        self._sessions=set()
+        self._lost=set()
+        self._launch()
+
+    def _launch(self):
+        self._conn, conn=Pipe()
+        self.process=Process(target=self._run, args=(conn,))
+        self.process.start()
+        conn.close()
+        # multiprocessing waits for the zygote when the device exits,
+        # and the zygote waits for the device to close the pipe
+        from multiprocessing.util import Finalize
+        Finalize(self, self._conn.close, exitpriority=10)
+
+    def _restart(self):
+        self._conn.close()
+        self.process.join()
+        logger.error("The zygote exited with code %s; starting a new one", self.process.exitcode)
+        self._lost|=self._sessions
+        self._sessions=set()
+        self._launch()
+
+    def start(self, session, message_queue, resource_limits, fs_secret):
+        """
+        Start a session, as soon as there is a free worker.
+
+        :arg str session: the session ID
+        :arg message_queue: the queue the device sends the session's
+            execution requests down
+        :arg list resource_limits: as for :func:`execProcess`
+        :arg dict fs_secret: as for :func:`execProcess`
+        """
+        # the zygote passes the rest on without unpickling it, so
+        # that it never touches the manager's queue
+        assignment=(session, cPickle.dumps((message_queue, resource_limits, fs_secret), 2))
+        try:
+            self._conn.send(assignment)
+        except (EOFError, IOError):
+            self._restart()
+            self._conn.send(assignment)
+        self._sessions.add(session)
+
+    def finished(self):
+        """
+        :returns: the sessions that have finished since the last call
+        :rtype: set
+        """
+        done, self._lost=self._lost, set()
+        try:
+            while self._conn.poll():
+                done.add(self._conn.recv())
+        except (EOFError, IOError):
+            self._restart()
+            done|=self._lost
+            self._lost=set()
+        self._sessions-=done
+        return done
+
+    def fileno(self):
+        """
+        The file descriptor of the device's end of the pipe, which is
+        readable when sessions have finished.  It changes when the
+        zygote is restarted.
+        """
+        return self._conn.fileno()
+
+    # The rest runs in the zygote process
+
+    def _run(self, conn):
+        # the device's end of the pipe was copied by the fork
+        self._conn.close()
+        self._device=conn
+        # (process, pipe, temporary directory) of the ready processes
+        self._ready=[]
+        # pid -> (process, session, temporary directory)
+        self._running={}
+        self._pending=deque()
+        # SIGCHLD writes to the wakeup pipe, so a session process that
+        # exits wakes the select below
+        self._wakeup=os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL)|os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(self._wakeup[1])
+        load_sage(self.warmup)
+        while True:
+            # start waiting sessions first, and only then fork
+            # replacements for the processes they took
+            while self._pending and len(self._running)<self.workers:
+                if not self._ready:
+                    self._fork()
+                self._assign(self._pending.popleft())
+            while len(self._ready)<self.idle:
+                self._fork()
+            try:
+                ready=select.select([conn, self._wakeup[0]], [], [])[0]
+            except select.error as e:
+                if e.args[0]!=errno.EINTR:
+                    raise
+                ready=[]
+            if self._wakeup[0] in ready:
+                try:
+                    while os.read(self._wakeup[0], 512):
+                        pass
+                except OSError:
+                    pass
+            try:
+                while conn.poll():
+                    self._pending.append(conn.recv())
+            except (EOFError, IOError):
+                # the device is gone; closing the pipes ends the ready
+                # processes
+                break
+            self._reap()
+        for p, pipe, tmp_dir in self._ready:
+            pipe.close()
+            p.join()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _fork(self):
+        tmp_dir=tempfile.mkdtemp()
+        pipe, child=Pipe()
+        p=Process(target=self._session, args=(tmp_dir, child, pipe))
+        p.start()
+        child.close()
+        self._ready.append((p, pipe, tmp_dir))
+
+    def _session(self, tmp_dir, pipe, parent):
+        # Close the zygote's ends of the pipes, so that this process
+        # notices (by the end of its pipe) when the zygote exits.
+        parent.close()
+        self._device.close()
+        for p, other, d in self._ready:
+            other.close()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in self._wakeup:
+            os.close(fd)
+        session_process(tmp_dir, pipe)
+
+    def _assign(self, assignment):
+        p, pipe, tmp_dir=self._ready.pop(0)
+        pipe.send(assignment)
+        pipe.close()
+        self._running[p.pid]=(p, assignment[0], tmp_dir)
+        logger.debug("Session %s started in process %d", assignment[0], p.pid)
+
+    def _reap(self):
+        for pid, (p, session, tmp_dir) in self._running.items():
+            if not p.is_alive():
+                del self._running[pid]
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                self._device.send(session)
+        for ready in self._ready[:]:
+            if not ready[0].is_alive():
+                self._ready.remove(ready)
+                shutil.rmtree(ready[2], ignore_errors=True)
+
+def session_process(tmp_dir, assignments):
+    """
+    A session process.  This is forked from the zygote before it is
+    needed, gets everything ready to run a session, and then waits for
+    the zygote to hand it one.
+
+    :arg str tmp_dir: the temporary directory to work in
+    :arg assignments: the pipe the zygote sends the session down (see
+        :meth:`Zygote.start`)
+    """
+    os.chdir(tmp_dir)
+    # Ensure unique random state after forking
+    if enable_sage:
+        sage.all.set_random_seed()
+    else:
+        random.seed()
+    # we need a new context since we just forked
+    fs.new_context()
+    upload_recv, upload_send=Pipe()
+    file_parent, file_child=Pipe()
+    file_upload_process=Process(target=upload_files, args=(upload_recv, file_child))
+    file_upload_process.start()
+    try:
+        session, args=assignments.recv()
+    except (EOFError, IOError):
+        # the zygote has exited
+        upload_send.send(None)
+        file_upload_process.join()
+        return
+    message_queue, resource_limits, fs_secret=cPickle.loads(args)
+    log("Temp files in "+tmp_dir)
+    upload_send.send((session, fs_secret.pop('upload')))
+    output_handler=OutputIPython(session, outQueue)
+    output_handler.set_parent_header({'session':session})
+    execProcess(session, message_queue, output_handler, resource_limits, fs_secret,
+                (upload_send, file_parent, file_upload_process))
+
+def device(db, fs, workers, interact_timeout, keys, poll_interval=0.1, resource_limits=None,
+           prefork=2, input_address=None, input_recheck=2, lookahead=1,
+           max_frames=1000, max_drain_time=0.05):
     """
     This function is the main function. Its responsibility is to
     query the database for more work to do and put messages back into the
@@ -320,44 +676,82 @@ def device(db, fs, workers, interact_timeout, keys, poll_interval=0.1, resource_
     the database communication once a session is set up.  We don't
     know which is better for a highly scalable system.
 
-    This function also creates the worker pool for doing the actual
-    computations.
+    This function also starts the zygote (see :class:`Zygote`), which
+    runs the actual computations.
 
     :arg db_zmq.DB db: the untrusted database adaptor
     :arg filestore.FileStoreZMQ fs: the untrusted filestore adaptor
-    :arg int workers: the number of worker processes to start
-        in the pool
+    :arg int workers: the maximum number of sessions running at once
     :arg int interact_timeout: the timeout (in seconds) for a session
         containing an interact
     :arg tuple keys: a tuple of two strings to use to generate the
         shared secrets for the database and filestore
-    :arg float poll_interval: the time between each iteration of polling
-        the database and queue
+    :arg float poll_interval: the time between checks of the database
+        for new input when there is no notification bus
     :arg list resource_limits: list of tuples of the form
         ``(resource, limit)``, to be passed as arguments to
-        :func:`resource.setrlimit` in each EXEC process
+        :func:`resource.setrlimit` in each session process
+    :arg int prefork: the number of session processes to keep ready
+        (see :class:`Zygote`)
+    :arg str input_address: the address the trusted database relays new
+        input events on (see :func:`trusted_db.loop`), or ``None`` if
+        there is no notification bus
+    :arg float input_recheck: the time between checks of the database
+        for new input when there is a notification bus, in case an
+        announcement was lost
+    :arg int lookahead: the number of sessions to claim beyond the
+        free workers, so that a worker never waits for the database
+        when it finishes a session.  Claiming only that many leaves the
+        rest of the new sessions to the other devices.
+    :arg int max_frames: the most output messages to read from the
+        output pipe before going back to the database
+    :arg float max_drain_time: the longest time (in seconds) to spend
+        reading the output pipe before going back to the database
     """
     device_id=unicode(uuid.uuid4())
     log("Starting device loop for device %s..."%device_id, device_id)
+    zygote=Zygote(workers, prefork, getattr(CONFIG, 'WARMUP', ()))
     db.register_device(device=device_id, account=None, workers=workers, pgid=os.getpgid(0))
-    pool=Pool(processes=workers)
     sessions={}
     from collections import defaultdict
     sequence=defaultdict(int)
 
     manager = Manager()
+    import zmq
+    # wait for output, finished sessions and (with a bus) new input
+    poller=zmq.Poller()
+    poller.register(outQueue.fileno(), zmq.POLLIN)
+    zygote_fd=zygote.fileno()
+    poller.register(zygote_fd, zmq.POLLIN)
+    if input_address is not None:
+        import notify
+        inputs=notify.input_subscriber(zmq.Context(), input_address)
+        poller.register(inputs, zmq.POLLIN)
+        recheck=input_recheck
+    else:
+        inputs=None
+        recheck=poll_interval
+    next_check=0
+    # the free workers, as last told to the database
+    slots=workers
+    # finished sessions whose output may not all have been read yet
+    ending=set()
     log("Getting new messages")
     hmacs={}
     while True:
-        # TODO: be more intelligent about how many new sessions I can get
-        # one option is to make limit=3*(workers-len(sessions)))
-        for X in db.get_input_messages(device=device_id, limit=-1):
+        if time.time()>=next_check:
+            next_check=time.time()+recheck
+            new_input=db.get_input_messages(device=device_id,
+                                            limit=max(workers+lookahead-len(sessions), 0))
+        else:
+            new_input=[]
+        for X in new_input:
             # this gets both new session requests as well as execution
             # requests for current sessions.
             session=X['header']['session']
             if session not in sessions:
                 # session has not been set up yet
-                log("evaluating %r"%X['content']['code'], device_id+' '+session)
+                logger.debug("%s %s: evaluating %r", device_id, session, X['content']['code'])
                 while not db.create_secret(session=session):
                     time.sleep(0.1)
 
@@ -373,51 +767,46 @@ def device(db, fs, workers, interact_timeout, keys, poll_interval=0.1, resource_
                 keys[1]=sha1(keys[1]).digest()
                 fs_secret['upload']=keys[1]
                 msg_queue=manager.Queue()
-                args=(session, msg_queue, resource_limits, fs_secret)
+                zygote.start(session, msg_queue, resource_limits, fs_secret)
                 sessions[session]={'messages': msg_queue,
-                                   'worker': pool.apply_async(worker,args),
                                    'parent_header': X['header']}
             # send execution request down the queue.
             sessions[session]['messages'].put(('exec',X))
-            log("sent execution request", device_id+' '+session)
-        # Get whatever sessions are done
-        finished=set(i for i, r in sessions.iteritems() if r['worker'].ready())
+            logger.debug("%s %s: sent execution request", device_id, session)
+        # A session process writes all of its output before it exits,
+        # so a finished session's output is all in the pipe, but it may
+        # take more than one read to get to the end of it.
+        ending|=zygote.finished()
+        if zygote.fileno()!=zygote_fd:
+            # the zygote was restarted
+            poller.unregister(zygote_fd)
+            zygote_fd=zygote.fileno()
+            poller.register(zygote_fd, zmq.POLLIN)
         new_messages=[]
         last_message={}
-        # TODO: should just get until there is a Queue.Empty error,
-        # TODO: but should also have a max timeout for the message loop
-        # TODO: or maybe just a max number of messages we can handle in one loop
-        while not outQueue.empty():
-            # TODO: don't use Queue, which unpickles the message.  Instead, use some sort of Pipe which just extracts bytes.
-            try:
-                # make sure we can decode the message
-                msg=loads(outQueue.get())
-            except Exception as e:
-                # ignore the message
-                # TODO: send a message to the user; can we extract a session identifier?
-                log("Exception occurred while reading message: %s"%(msg,))
-                continue
-            try:
-                session = msg['parent_header']['session']
-                last_msg=last_message.get(session)
-                # Consolidate session messages of stderr or stdout to same output block
-                # channels
-                if (last_msg is not None
-                    and msg['msg_type'] == 'stream' and last_msg['msg_type']=='stream'
-                    and msg['content']['name'] in ('stdout', 'stderr')
-                    and msg['content']['name']==last_msg['content']['name']
-                    and msg['output_block'] == last_msg['output_block']):
-
-                    last_msg['content']['data']+=msg['content']['data']
-                else:
-                    msg['sequence']=sequence[session]
-                    sequence[session]+=1
-                    new_messages.append(msg)
-                    last_message[session]=msg
-            except KeyError:
-                # something was formatted wrongly in msg, or some other problem happened with formatting the message
-                # TODO: send an error back to the user
+        for frame in outQueue.read(max_frames, max_drain_time):
+            session=frame.session
+            if session not in sessions:
+                # left over from a session lost with a zygote
                 continue
+            last=last_message.get(session)
+            # Consolidate session messages of stderr or stdout to same output block
+            # channels
+            if (last is not None and frame.channel
+                and frame.channel==last[1].channel
+                and frame.output_block==last[1].output_block):
+                last[2].append(frame.data)
+            else:
+                last=(session, frame, [frame.data], sequence[session])
+                sequence[session]+=1
+                new_messages.append(last)
+                last_message[session]=last
+        new_messages=[(s, '%s%s%s, "sequence": %d}'%(f.prefix, ''.join(data), f.suffix, n))
+                      for s, f, data, n in new_messages]
+        if outQueue.drained:
+            finished, ending=ending, set()
+        else:
+            finished=()
          # delete the output that I'm finished with
         for session in finished:
             msg={'content': {"msg_type":"session_end"},
@@ -426,15 +815,32 @@ def device(db, fs, workers, interact_timeout, keys, poll_interval=0.1, resource_
                  "msg_type":"extension",
                  "output_block":None,
                  "sequence":sequence[session]}
-            new_messages.append(msg)
+            new_messages.append((session, dumps(msg)))
             del sequence[session]
             del sessions[session]
+            # claim the next session for the free worker right away,
+            # rather than when the next check is due
+            next_check=0
         if len(new_messages)>0:
-            db.add_messages(messages=new_messages, hmacs=hmacs)
+            db.add_encoded_messages(messages=new_messages, hmacs=hmacs)
         for session in finished:
             db.close_session(device=device_id, session=session,hmac=hmacs[session])
             del hmacs[session]
-        time.sleep(poll_interval)
+        if max(workers-len(sessions), 0)!=slots:
+            slots=max(workers-len(sessions), 0)
+            db.set_device_slots(device=device_id, slots=slots)
+        if outQueue.drained:
+            timeout=max(next_check-time.time(), 0)
+        else:
+            timeout=0
+        events=dict(poller.poll(timeout*1000))
+        if inputs in events:
+            try:
+                while True:
+                    inputs.recv(zmq.NOBLOCK)
+            except zmq.ZMQError:
+                pass
+            next_check=0
 
 
 def unicode_str(obj, encoding='utf-8'):
@@ -497,11 +903,15 @@ def displayhook_hack(string):
 import tempfile
 import shutil
 import os
+import select
+import signal
+import errno
+import fcntl
 
-def execProcess(session, message_queue, output_handler, resource_limits, sysargs, fs_secret):
+def execProcess(session, message_queue, output_handler, resource_limits, fs_secret, upload):
     """
     Run the code, outputting into a pipe.
-    Meant to be run as a separate process.
+    Meant to be run in a session process (see :func:`session_process`).
 
     :arg str session: the ID of the session running the code
     :arg multiprocessing.Queue message_queue: a queue through which
@@ -511,20 +921,19 @@ def execProcess(session, message_queue, output_handler, resource_limits, sysargs
     :arg list resource_limits: list of tuples of the form
         ``(resource, limit)``, to be passed as arguments to
         :func:`resource.setrlimit`.
+    :arg dict fs_secret: the initial secret (under the key ``''``) for
+        the filestore's hmac
+    :arg tuple upload: the pipe to the process running
+        :func:`upload_files`, the pipe it sends the uploaded files
+        back on, and the process
     """
-    # we need a new context since we just forked
-    global fs
-    fs.new_context()
     from Queue import Empty
     global user_code
     # Since the user can set a timeout, we safeguard by having a maximum timeout
     MAX_TIMEOUT=60
     timeout=0.1
 
-    upload_recv, upload_send=Pipe()
-    file_parent, file_child=Pipe()
-    file_upload_process=Process(target=upload_files, args=(upload_recv, file_child, session, fs_secret['upload']))
-    file_upload_process.start()
+    upload_send, file_parent, file_upload_process=upload
 
     fs_hmac=hmac.new(fs_secret[''], digestmod=sha1)
     del fs_secret
@@ -564,7 +973,7 @@ def execProcess(session, message_queue, output_handler, resource_limits, sysargs
         code = displayhook_hack(code)
         # always add a newline to avoid this bug in Python versions < 2.7: http://bugs.python.org/issue1184112
         code += '\n'
-        log("Executing: %r"%code)
+        logger.debug("Executing: %r", code)
         output_handler.set_parent_header(msg['header'])
         old_files=dict([(f,os.stat(f).st_mtime) for f in os.listdir(os.getcwd())])
         if 'files' in msg['content']:
@@ -577,13 +986,16 @@ def execProcess(session, message_queue, output_handler, resource_limits, sysargs
             try:
                 import user_convenience
 
-                locals={'_sagecell': user_convenience.UserConvenience(output_handler,
-                                                                      upload_send),
-                        '_sage_messages': output_handler,
-                        '_sage_upload_file_pipe': upload_send}
-
                 if enable_sage and sage_mode:
+                    # the namespace the zygote prepared
+                    locals=dict(prelude)
                     locals['sage'] = sage
+                else:
+                    locals={}
+                locals.update({'_sagecell': user_convenience.UserConvenience(output_handler,
+                                                                             upload_send),
+                               '_sage_messages': output_handler,
+                               '_sage_upload_file_pipe': upload_send})
 
                 exec code in locals
                 # I've commented out fields we aren't using below to
@@ -639,59 +1051,28 @@ def execProcess(session, message_queue, output_handler, resource_limits, sysargs
         if len(file_list)>0:
             output_handler.message_queue.message('files', {'files': file_list})
 
-        log("Done executing code: %r"%code)
+        logger.debug("Done executing code: %r", code)
     upload_send.send_bytes(json.dumps({'msg_type': 'end_session'}))
     file_upload_process.join()
 
-def worker(session, message_queue, resource_limits, fs_secret):
-    u"""
-    This function is executed by a worker process. It executes the
-    given code in a separate process. This function may start a
-    process on another computer, even, and communicate with that
-    process over SSH.
-
-    The result of this function is a list of messages in the global
-    device queue.  These messages represent the output and results of
-    executing the code.
-
-    :arg str session: the ID of the session running the code
-    :arg multiprocessing.Queue message_queue: a queue through which
-        this process will be passed input messages
-    :arg list resource_limits: list of tuples of the form
-        ``(resource, limit)``, to be passed as arguments to
-        :func:`resource.setrlimit`.
-    :arg str fs_secret: a string to serve as the initial secret message
-        with which to call :func:`hmac.new` and communicate with the
-        trusted filestore object over \xd8MQ. The trusted filestore
-        must be given the same secret.
-    """
-    curr_dir=os.getcwd()
-    tmp_dir=tempfile.mkdtemp()
-    log("Temp files in "+tmp_dir)
-    oldDaemon=current_process().daemon
-    # Daemonic processes cannot create children
-    current_process().daemon=False
-    os.chdir(tmp_dir)
-    output_handler=OutputIPython(session, outQueue)
-    output_handler.set_parent_header({'session':session})
-    args=(session, message_queue, output_handler, resource_limits, sysargs, fs_secret)
-    p=Process(target=execProcess, args=args)
-    p.start()
-    p.join()
-    current_process().daemon=oldDaemon
-    os.chdir(curr_dir)
-    shutil.rmtree(tmp_dir)
-
-def upload_files(upload_recv, file_child, session, fs_secret):
+def upload_files(upload_recv, file_child):
     """
     The user can pass in a list of filenames as a json message.  These will get uploaded.
     When the upload_queue gets an "end_exec" message, it then sends the hmac down the 
     file_child pipe and exits
+
+    The process starts before its session does, so the first message
+    is the session ID and the upload secret (or ``None`` if the process
+    isn't needed after all).
     """
     # for some reason, doing fs.new_context hangs on the statement when fs._xreq is assigned
     from filestore import FileStoreZMQ
     global fs
     fs=FileStoreZMQ(fs.address)
+    start=upload_recv.recv()
+    if start is None:
+        return
+    session, fs_secret=start
 
     fs_hmac=hmac.new(fs_secret, digestmod=sha1)
     log("starting fs secret for upload_files: %r"%fs_hmac.digest())
@@ -771,12 +1152,18 @@ if __name__ == "__main__":
     parser.add_option("--mem", type=float, default=-1,
                       dest="memory_limit",
                       help="Memory (MB) allotted to each session (hard limit)")
+    parser.add_option("--prefork", type=int, default=2, dest="prefork",
+                      help="Number of session processes to keep ready")
+    parser.add_option("--lookahead", type=int, default=1, dest="lookahead",
+                      help="Number of sessions to claim beyond the free workers")
+    parser.add_option("--input-address", dest="input_address",
+                      help="Address the trusted database relays new input events on")
     parser.add_option("--keyfile", dest="keyfile")
     parser.add_option("-q", action="store_true", dest="quiet", help="Turn off most logging")
     (sysargs, args) = parser.parse_args()
 
     if sysargs.quiet:
-        util.LOGGING=False
+        util.quiet()
 
     import resource
     resource_limits=[]
@@ -790,7 +1177,7 @@ if __name__ == "__main__":
         #resource_limits.append((resource.RLIMIT_DATA, (mem_bytes, mem_bytes)))
         #resource_limits.append((resource.RLIMIT_STACK, (mem_bytes, mem_bytes)))
 
-    outQueue=RawQueue()
+    outQueue=frames.FramePipe()
 
     filename=sysargs.keyfile
     with open(filename,"rb") as f:
@@ -801,4 +1188,5 @@ if __name__ == "__main__":
     db, fs = misc.select_db(sysargs)
 
     device(db=db, fs=fs, workers=sysargs.workers, interact_timeout=sysargs.interact_timeout,
-           keys=keys, resource_limits=resource_limits)
+           keys=keys, resource_limits=resource_limits, prefork=sysargs.prefork,
+           input_address=sysargs.input_address, lookahead=sysargs.lookahead)
@@ -3,7 +3,9 @@
 These classes implement ways to store files in the server.
 """
 
-from util import log
+import logging
+from util import log, get_logger
+logger=get_logger('fs')
 
 class FileStore(object):
     """
@@ -89,6 +91,21 @@ class FileStore(object):
         :rtype: FileStore
         """
 
+    def reset_context(self):
+        """
+        Return a context created by :meth:`new_context_copy` to a clean
+        state so that another request can reuse it.
+        """
+
+    def check_context(self):
+        """
+        Check that a context is still usable.
+
+        :returns: True if the context can be used
+        :rtype: bool
+        """
+        return True
+
 try:
     from sagecell_config import mongo_config
 except ImportError:
@@ -113,7 +130,7 @@ def Debugger(func):
     else:
         return func
 
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import create_engine, Column, Integer, String, func
 from sqlalchemy.types import Binary
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
@@ -138,7 +155,7 @@ class FileStoreSQLAlchemy(FileStore):
         See :meth:`FileStore.new_file`
         """
         self.delete_files(session, filename)
-        log("FS Creating %s/%s"%(session, filename))
+        logger.debug("FS Creating %s/%s", session, filename)
         return FileStoreSQLAlchemy.DBFileWriter(self, session, filename)
 
     @Debugger
@@ -158,9 +175,19 @@ class FileStoreSQLAlchemy(FileStore):
     def get_file(self, session, filename, **kwargs):
         """
         See :meth:`FileStore.get_file`
+
+        The contents are read from the database in pieces as they are
+        needed, rather than all at once.
+
+        :rtype: :class:`FileStoreSQLAlchemy.DBFileReader`
         """
-        return StringIO(self.dbsession.query(FileStoreSQLAlchemy.StoredFile.contents) \
-                .filter_by(session=session, filename=filename).first().contents)
+        StoredFile = FileStoreSQLAlchemy.StoredFile
+        row = self.dbsession.query(StoredFile.n, func.length(StoredFile.contents)) \
+                .filter_by(session=session, filename=filename) \
+                .order_by(StoredFile.n.desc()).first()
+        if row is None:
+            return None
+        return FileStoreSQLAlchemy.DBFileReader(self, row[0], row[1] or 0)
 
     @Debugger
     def create_file(self, file_handle, session, filename, **kwargs):
@@ -202,6 +229,22 @@ class FileStoreSQLAlchemy(FileStore):
         new.new_context()
         return new
 
+    def reset_context(self):
+        """
+        See :meth:`FileStore.reset_context`
+        """
+        self.dbsession.close()
+
+    def check_context(self):
+        """
+        See :meth:`FileStore.check_context`
+        """
+        try:
+            self.dbsession.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
     Base = declarative_base()
     
     class StoredFile(Base):
@@ -234,6 +277,47 @@ class FileStoreSQLAlchemy(FileStore):
             self.filestore.create_file(self, self.session, self.filename)
             super(type(self), self).close()
 
+    class DBFileReader(object):
+        """
+        A read-only file-like object for a file stored in the database,
+        which fetches only the bytes that are asked for.
+
+        :arg FileStoreSQLAlchemy filestore: the filestore the file is in
+        :arg int n: the primary key of the file's row
+        :arg int length: the size of the file in bytes
+        """
+        def __init__(self, filestore, n, length):
+            self.filestore = filestore
+            self.version = n
+            self.length = length
+            self._pos = 0
+        def read(self, size=-1):
+            if size < 0 or size > self.length - self._pos:
+                size = self.length - self._pos
+            if size <= 0:
+                return ""
+            StoredFile = FileStoreSQLAlchemy.StoredFile
+            data = self.filestore.dbsession \
+                       .query(func.substr(StoredFile.contents, self._pos + 1, size)) \
+                       .filter_by(n=self.version).scalar()
+            data = str(data) if data is not None else ""
+            self._pos += len(data)
+            return data
+        def seek(self, offset, whence=0):
+            if whence == 1:
+                offset += self._pos
+            elif whence == 2:
+                offset += self.length
+            self._pos = max(0, offset)
+        def tell(self):
+            return self._pos
+        def close(self):
+            pass
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            self.close()
+
 try:
     from gridfs import GridFS
     import pymongo
@@ -262,7 +346,7 @@ class FileStoreMongo(FileStore):
         :rtype: :class:`gridfs.grid_file.GridIn`
         """
         self.delete_files(**kwargs)
-        log("FS Creating %s"%self._filename(**kwargs))
+        logger.debug("FS Creating %s", kwargs)
         return self._fs.new_file(**self._filename(**kwargs))
 
     @Debugger
@@ -322,6 +406,16 @@ class FileStoreMongo(FileStore):
         """
         return type(self)(self._conn)
 
+    def check_context(self):
+        """
+        See :meth:`FileStore.check_context`
+        """
+        try:
+            self.database.command('ping')
+            return True
+        except Exception:
+            return False
+
     valid_untrusted_methods=()
 
 from flask import safe_join
@@ -370,7 +464,9 @@ class FileStoreFilesystem(FileStore):
         """
         See :meth:`FileStore.delete_files`
         """
-        os.path.remove(self._filename(session=session, filename=filename))
+        f=self._filename(session=session, filename=filename)
+        if os.path.exists(f):
+            os.remove(f)
 
     @Debugger
     def get_file(self, session, filename):
@@ -379,10 +475,27 @@ class FileStoreFilesystem(FileStore):
         """
         f=self._filename(session=session, filename=filename)
         if os.path.exists(f):
-            return open(f, 'r')
+            return open(f, 'rb')
         else:
             return None
 
+    def file_path(self, session, filename):
+        """
+        Get the location of a stored file, so that a front-end web
+        server like nginx can send it directly.
+
+        :arg str session: the session ID
+        :arg str filename: the name of the file
+        :returns: the path of the file relative to the filestore
+            directory, and its absolute path, or ``None`` if the file
+            does not exist
+        :rtype: tuple
+        """
+        f=self._filename(session=session, filename=filename)
+        if not os.path.isfile(f):
+            return None
+        return os.path.relpath(f, self._dir), os.path.abspath(f)
+
     @Debugger
     def create_file(self, file_handle, **kwargs):
         """
@@ -405,6 +518,13 @@ class FileStoreFilesystem(FileStore):
         """
         pass
 
+    def new_context_copy(self):
+        """
+        See :meth:`FileStore.new_context_copy`; this filestore has no
+        per-thread state, so this returns the same object.
+        """
+        return self
+
     valid_untrusted_methods=()
 
 import zmq
@@ -466,9 +586,11 @@ class FileStoreZMQ(FileStoreMongo):
             f=file_handle.read()
         msg_str=dumps({'msg_type':'create_file',"header":str(uuid4()),
                        'content':kwargs})
-        log("Sending: msg_str: %r, old_digest: %r"%(msg_str, hmac.digest()))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending: msg_str: %r, old_digest: %r", msg_str, hmac.digest())
         hmac.update(msg_str)
-        log("New digest: %r"%hmac.digest())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("New digest: %r", hmac.digest())
         message=[msg_str, hmac.digest(), f]
         self.socket.send_multipart(message,copy=False,track=True).wait()
         self.socket.recv()
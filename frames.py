@@ -0,0 +1,176 @@
+"""
+Output Frames
+-------------
+
+The pipe that carries output messages from the session processes to
+the device (see :mod:`device_process`).  Each message is one
+length-prefixed frame: a small header with the message's session,
+``msg_type``, stream channel and output block, followed by the JSON of
+the message in three pieces, ``prefix``, ``data`` and ``suffix``.  The
+JSON is left open at the end, so the device only has to add the
+sequence number::
+
+    prefix + data + suffix + ', "sequence": 5}'
+
+Stream messages (``stdout`` and ``stderr``) carry their text, already
+escaped for JSON, as ``data``, so the device joins consecutive stream
+frames of the same channel and output block by joining their ``data``.
+The device routes, numbers and coalesces messages without ever
+decoding them.
+"""
+
+import os
+import errno
+import fcntl
+import struct
+from collections import namedtuple
+from json import dumps
+from multiprocessing import Lock
+from time import time
+
+_LENGTH=struct.Struct('!I')
+# the lengths of session, msg_type, channel, output_block, prefix and
+# data; the suffix takes the rest of the frame
+_HEADER=struct.Struct('!BBBHII')
+
+#: A frame read from a :class:`FramePipe`.  ``channel`` is empty for
+#: messages that aren't streams, and ``output_block`` is empty for
+#: messages without one.
+Frame=namedtuple('Frame', 'session msg_type channel output_block prefix data suffix')
+
+def message_frame(session, msg, output_block=None):
+    """
+    Make the frame for a message that isn't a stream.
+
+    :arg str session: the session ID
+    :arg dict msg: the IPython-style message, without a sequence number
+    :arg str output_block: the message's output block
+    :rtype: Frame
+    """
+    return Frame(session, msg['msg_type'], '', output_block or '', dumps(msg)[:-1], '', '')
+
+def stream_frame(session, msg, channel, data, output_block=None):
+    """
+    Make the frame for a stream message.
+
+    :arg str session: the session ID
+    :arg dict msg: the IPython-style message, without a content or a
+        sequence number
+    :arg str channel: the stream's name (such as ``"stdout"``)
+    :arg list data: the pieces of text written to the stream
+    :arg str output_block: the message's output block
+    :rtype: Frame
+    """
+    prefix='%s, "content": {"name": %s, "data": "'%(dumps(msg)[:-1], dumps(channel))
+    return Frame(session, 'stream', channel, output_block or '', prefix,
+                 ''.join(dumps(d)[1:-1] for d in data), '"}')
+
+class FramePipe(object):
+    """
+    A pipe of frames.  Make it in the device before it forks the
+    processes that write to it.  Any number of processes may write
+    frames; only the device reads them.
+
+    After each :meth:`read`, ``drained`` tells whether it read
+    everything that had been written, rather than stopping at one of
+    its limits.
+    """
+    def __init__(self):
+        self._reader, self._writer=os.pipe()
+        fcntl.fcntl(self._reader, fcntl.F_SETFL,
+                    fcntl.fcntl(self._reader, fcntl.F_GETFL)|os.O_NONBLOCK)
+        # a frame bigger than PIPE_BUF would otherwise be interleaved
+        # with other writers' frames
+        self._lock=Lock()
+        self._buffer=''
+        self._offset=0
+        self.drained=True
+
+    def send(self, frame):
+        """
+        Write a frame, waiting if the pipe is full.
+
+        :arg Frame frame: the frame
+        """
+        fields=[f.encode('utf8') if isinstance(f, unicode) else f for f in frame]
+        body=_HEADER.pack(*[len(f) for f in fields[:6]])+''.join(fields)
+        data=_LENGTH.pack(len(body))+body
+        with self._lock:
+            while data:
+                try:
+                    data=data[os.write(self._writer, data):]
+                except OSError as e:
+                    if e.errno!=errno.EINTR:
+                        raise
+
+    def fileno(self):
+        """
+        The file descriptor of the reading end, which is readable when
+        there are frames to read.
+        """
+        return self._reader
+
+    def ready(self):
+        """
+        :returns: whether a whole frame has been read from the pipe but
+            not returned by :meth:`read` yet (which waiting on
+            :meth:`fileno` would miss)
+        :rtype: bool
+        """
+        if len(self._buffer)-self._offset<_LENGTH.size:
+            return False
+        length=_LENGTH.unpack_from(self._buffer, self._offset)[0]
+        return len(self._buffer)-self._offset>=_LENGTH.size+length
+
+    def _next(self):
+        if not self.ready():
+            return None
+        start=self._offset+_LENGTH.size
+        end=start+_LENGTH.unpack_from(self._buffer, self._offset)[0]
+        self._offset=end
+        lengths=_HEADER.unpack_from(self._buffer, start)
+        fields=[]
+        i=start+_HEADER.size
+        for n in lengths:
+            fields.append(self._buffer[i:i+n])
+            i+=n
+        fields.append(self._buffer[i:end])
+        return Frame(*fields)
+
+    def read(self, max_frames=1000, max_time=0.05):
+        """
+        Read the frames that are waiting, without blocking.  Reading
+        stops after ``max_frames`` frames or ``max_time`` seconds, so
+        that a flood of output can't hold up the device; the rest wait
+        for the next call (see :meth:`ready`).
+
+        :arg int max_frames: the most frames to return
+        :arg float max_time: the longest time (in seconds) to read for
+        :returns: the frames, in the order they were written
+        :rtype: list
+        """
+        frames=[]
+        end_time=time()+max_time
+        self.drained=False
+        while len(frames)<max_frames:
+            frame=self._next()
+            if frame is not None:
+                frames.append(frame)
+                continue
+            if time()>=end_time:
+                break
+            try:
+                chunk=os.read(self._reader, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.drained=True
+                    break
+                if e.errno==errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                self.drained=True
+                break
+            self._buffer=self._buffer[self._offset:]+chunk
+            self._offset=0
+        return frames
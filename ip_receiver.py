@@ -1,37 +1,68 @@
 import zmq
-from time import sleep
+from time import time
+from collections import OrderedDict
 
 class IPReceiver:
-    """Receives messages from IPython's ZeroMQ channels."""
-    def __init__(self, socketType, port):
+    """Receives messages from IPython's ZeroMQ channels.
+
+    Messages are archived by the ``msg_id`` of their parent header, so
+    looking up the replies to a request doesn't rescan every archived
+    message.  At most ``max_archived`` requests' worth of unclaimed
+    messages are kept; the oldest are dropped first."""
+    def __init__(self, socketType, port, max_archived=1000):
         self.context=zmq.Context()
         self.socket=self.context.socket(socketType)
         self.socket.connect("tcp://localhost:%i"%(port,))
         if socketType==zmq.SUB:
             self.socket.setsockopt(zmq.SUBSCRIBE,"")
-        self.messages=[]
+        self.poller=zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.max_archived=max_archived
+        # parent msg_id -> list of messages
+        self.messages=OrderedDict()
+
+    @staticmethod
+    def _key(parent_header):
+        if isinstance(parent_header, dict):
+            return parent_header.get('msg_id')
+        return None
 
-    def getMessages(self, parent_header, block=False):
+    def _receive(self, timeout):
+        """Wait up to ``timeout`` seconds (forever if ``None``) for a
+        message, then archive every message that is waiting."""
+        if not self.poller.poll(None if timeout is None else int(timeout*1000)):
+            return
+        while True:
+            try:
+                msg=self.socket.recv_json(zmq.NOBLOCK)
+            except zmq.ZMQError: # No more messages
+                break
+            self.messages.setdefault(self._key(msg.get('parent_header')), []).append(msg)
+        while len(self.messages)>self.max_archived:
+            self.messages.popitem(last=False)
+
+    def getMessages(self, parent_header, block=False, timeout=0.1):
         """Receives all messages from IPython, returning the ones with
         the given parent_header property, and archiving the rest.
         The next time this function is called with the parent_header of an archived message,
         that message will be included in the messages returned.
-        
-        If block is True, wait until at least one message is found."""
-        results=[]
+
+        If block is True, wait until at least one message is found.
+        Otherwise, wait at most ``timeout`` seconds for one."""
+        key=self._key(parent_header)
+        end_time=time()+timeout
         while True:
-            while True:
-                try:
-                    self.messages.append(self.socket.recv_json(zmq.NOBLOCK))
-                except zmq.core.error.ZMQError: # No more messages
-                    break
-            toDel=set()
-            for i,msg in enumerate(self.messages):
-                if msg['parent_header']==parent_header:
-                    results.append(msg)
-                    toDel.add(i)
-            self.messages[:]=[self.messages[i] for i in range(len(self.messages)) if i not in toDel]
-            if not block or len(results):
-                break
-        sleep(0.1)
-        return results
+            self._receive(0)
+            archived=self.messages.pop(key, [])
+            results=[m for m in archived if m['parent_header']==parent_header]
+            if len(results)<len(archived):
+                self.messages[key]=[m for m in archived if m['parent_header']!=parent_header]
+            if len(results):
+                return results
+            if block:
+                self._receive(None)
+            else:
+                remaining=end_time-time()
+                if remaining<=0:
+                    return results
+                self._receive(remaining)
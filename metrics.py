@@ -0,0 +1,463 @@
+"""
+Metrics
+-------
+
+Counters, gauges and latency histograms, exported in the Prometheus
+text format.
+
+The web server runs as many processes (for example, uwsgi workers), so
+each process keeps its values in its own memory-mapped file in a shared
+directory.  Recording a value just writes 8 bytes into that process's
+file; the process serving ``/metrics`` reads every file and adds the
+values together.  Gauge files of processes that have exited are
+ignored, while their counters and histograms still count.  The
+directory should be emptied when the web server starts.
+
+Use::
+
+    registry=Registry('/tmp/sagecell_metrics')
+    requests=registry.counter('requests_total', 'Requests', ['endpoint'])
+    requests.labels('eval').inc()
+"""
+
+import os
+import mmap
+import struct
+import threading
+from bisect import bisect_left
+
+_HEADER=struct.Struct('I')
+_KEY_LENGTH=struct.Struct('I')
+_VALUE=struct.Struct('d')
+
+class _ValueFile(object):
+    """
+    A memory-mapped file of ``(key, double)`` entries written by one
+    process.  An entry is the key's length, the key (padded to 8 bytes)
+    and the value; the header holds the number of bytes in use.
+
+    :arg str path: the file name
+    """
+    def __init__(self, path, size=2**16):
+        self._lock=threading.Lock()
+        self._path=path
+        self._f=open(path, 'w+b')
+        self._f.truncate(size)
+        self._size=size
+        self._mm=mmap.mmap(self._f.fileno(), size)
+        self._used=8
+        _HEADER.pack_into(self._mm, 0, self._used)
+        # key -> offset of the value
+        self._offsets={}
+
+    def offset(self, key):
+        """
+        Find (adding it if needed) the position of the value for ``key``.
+        """
+        with self._lock:
+            if key in self._offsets:
+                return self._offsets[key]
+            padded=(len(key)+_KEY_LENGTH.size+7)//8*8
+            entry_size=padded+_VALUE.size
+            while self._used+entry_size>self._size:
+                self._size*=2
+                self._f.truncate(self._size)
+                self._mm=mmap.mmap(self._f.fileno(), self._size)
+            _KEY_LENGTH.pack_into(self._mm, self._used, len(key))
+            self._mm[self._used+_KEY_LENGTH.size:self._used+_KEY_LENGTH.size+len(key)]=key
+            offset=self._used+padded
+            _VALUE.pack_into(self._mm, offset, 0.0)
+            # publish the entry only once it is complete, since other
+            # processes may be reading the file
+            self._used+=entry_size
+            _HEADER.pack_into(self._mm, 0, self._used)
+            self._offsets[key]=offset
+            return offset
+
+    def add(self, offset, amount):
+        with self._lock:
+            self._add(offset, amount)
+
+    def _add(self, offset, amount):
+        # the caller holds the lock
+        _VALUE.pack_into(self._mm, offset, _VALUE.unpack_from(self._mm, offset)[0]+amount)
+
+    def set(self, offset, value):
+        _VALUE.pack_into(self._mm, offset, value)
+
+def _read_values(path):
+    """
+    Read all the entries of a value file.
+
+    :returns: a list of ``(key, value)`` tuples
+    """
+    with open(path, 'rb') as f:
+        data=f.read()
+    if len(data)<_HEADER.size:
+        return []
+    used=min(_HEADER.unpack_from(data, 0)[0], len(data))
+    pos=8
+    values=[]
+    while pos+_KEY_LENGTH.size<=used:
+        length=_KEY_LENGTH.unpack_from(data, pos)[0]
+        key=data[pos+_KEY_LENGTH.size:pos+_KEY_LENGTH.size+length]
+        pos+=(length+_KEY_LENGTH.size+7)//8*8
+        if pos+_VALUE.size>used:
+            break
+        values.append((key, _VALUE.unpack_from(data, pos)[0]))
+        pos+=_VALUE.size
+    return values
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        import errno
+        return e.errno==errno.EPERM
+    return True
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _sample_key(name, labelnames, labelvalues, extra=''):
+    labels=','.join('%s="%s"'%(n, _escape(v)) for n, v in zip(labelnames, labelvalues))
+    if extra:
+        labels=labels+','+extra if labels else extra
+    return '%s{%s}'%(name, labels) if labels else name
+
+class _Metric(object):
+    """
+    A metric family: a name, help text and label names, with one child
+    per combination of label values.
+    """
+    type=None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self._registry=registry
+        self.name=name
+        self.documentation=documentation
+        self.labelnames=tuple(labelnames)
+        self._children={}
+        self._lock=threading.Lock()
+
+    def labels(self, *labelvalues):
+        """
+        Get the child for a combination of label values (in the same
+        order as the label names).  Keep the child around in hot code,
+        since looking it up is most of the cost of recording a value,
+        but don't keep it across a fork.
+        """
+        self._registry._check_fork()
+        child=self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child=self._children.get(labelvalues)
+                if child is None:
+                    child=self._children[labelvalues]=self._make_child(labelvalues)
+        return child
+
+class _CounterChild(object):
+    def __init__(self, values, offset):
+        self._values=values
+        self._offset=offset
+
+    def inc(self, amount=1):
+        self._values.add(self._offset, amount)
+
+class Counter(_Metric):
+    """
+    A value that only goes up, like the number of requests.
+    """
+    type='counter'
+
+    def _make_child(self, labelvalues):
+        values=self._registry._values('counter')
+        return _CounterChild(values, values.offset(_sample_key(self.name, self.labelnames, labelvalues)))
+
+class _GaugeChild(_CounterChild):
+    def dec(self, amount=1):
+        self._values.add(self._offset, -amount)
+
+    def set(self, value):
+        self._values.set(self._offset, value)
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, like the number of requests in
+    progress.  The values from all live processes are added together.
+    """
+    type='gauge'
+
+    def _make_child(self, labelvalues):
+        values=self._registry._values('gauge')
+        return _GaugeChild(values, values.offset(_sample_key(self.name, self.labelnames, labelvalues)))
+
+class _HistogramChild(object):
+    def __init__(self, values, buckets, bucket_offsets, sum_offset, count_offset):
+        self._values=values
+        self._buckets=buckets
+        self._bucket_offsets=bucket_offsets
+        self._sum_offset=sum_offset
+        self._count_offset=count_offset
+
+    def observe(self, value):
+        # buckets are stored non-cumulatively and added up on export
+        bucket=self._bucket_offsets[bisect_left(self._buckets, value)]
+        values=self._values
+        with values._lock:
+            values._add(bucket, 1)
+            values._add(self._sum_offset, value)
+            values._add(self._count_offset, 1)
+
+class Histogram(_Metric):
+    """
+    Counts observations (like request latencies) in buckets.
+
+    :arg tuple buckets: the upper bounds of the buckets, in increasing
+        order (an infinite bucket is added)
+    """
+    type='histogram'
+    DEFAULT_BUCKETS=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, registry, name, documentation, labelnames)
+        self.buckets=tuple(buckets)+(float('inf'),)
+
+    def _make_child(self, labelvalues):
+        values=self._registry._values('counter')
+        key=lambda suffix, extra='': _sample_key(self.name+suffix, self.labelnames, labelvalues, extra)
+        bucket_offsets=[values.offset(key('_bucket', 'le="%s"'%_format(b))) for b in self.buckets]
+        return _HistogramChild(values, self.buckets, bucket_offsets,
+                               values.offset(key('_sum')), values.offset(key('_count')))
+
+def _format(value):
+    if value==float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Registry(object):
+    """
+    The metrics of a program, shared by all its processes through a
+    directory of value files.
+
+    :arg str directory: the directory for the value files
+    """
+    def __init__(self, directory):
+        self.directory=directory
+        self._metrics=[]
+        self._files={}
+        self._pid=None
+        self._lock=threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another process made it first
+                pass
+
+    def _check_fork(self):
+        pid=os.getpid()
+        if pid!=self._pid:
+            # a new process (or the first use); start new files
+            with self._lock:
+                if pid!=self._pid:
+                    self._files={}
+                    for metric in self._metrics:
+                        metric._children={}
+                    self._pid=pid
+
+    def _values(self, kind):
+        pid=self._pid
+        values=self._files.get(kind)
+        if values is None:
+            with self._lock:
+                values=self._files.get(kind)
+                if values is None:
+                    values=self._files[kind]=_ValueFile(
+                        os.path.join(self.directory, '%s-%d.db'%(kind, pid)))
+        return values
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        :returns: a new :class:`Counter`
+        """
+        return self._add(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        """
+        :returns: a new :class:`Gauge`
+        """
+        return self._add(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        """
+        :returns: a new :class:`Histogram`
+        """
+        return self._add(Histogram(self, name, documentation, labelnames, buckets))
+
+    def render(self):
+        """
+        Add up the values from every process and format them in the
+        Prometheus text exposition format.
+
+        :rtype: str
+        """
+        totals={}
+        for filename in os.listdir(self.directory):
+            kind, _, rest=filename.partition('-')
+            if kind not in ('counter', 'gauge') or not rest.endswith('.db'):
+                continue
+            if kind=='gauge' and not _pid_alive(int(rest[:-3])):
+                continue
+            try:
+                values=_read_values(os.path.join(self.directory, filename))
+            except (IOError, OSError):
+                # the file went away
+                continue
+            for key, value in values:
+                totals[key]=totals.get(key, 0)+value
+        lines=[]
+        for metric in self._metrics:
+            lines.append('# HELP %s %s'%(metric.name, metric.documentation.replace('\n', ' ')))
+            lines.append('# TYPE %s %s'%(metric.name, metric.type))
+            prefix=metric.name+'{'
+            samples=sorted((k, v) for k, v in totals.iteritems()
+                           if k==metric.name or k.startswith(prefix)
+                           or (metric.type=='histogram' and k.startswith(metric.name+'_')))
+            if metric.type=='histogram':
+                samples=_cumulative(metric, samples)
+            for key, value in samples:
+                lines.append('%s %s'%(key, _format(value) if value!=int(value) else int(value)))
+        return '\n'.join(lines)+'\n'
+
+def _cumulative(metric, samples):
+    """
+    Turn the per-bucket counts of a histogram into the cumulative
+    counts Prometheus expects.
+    """
+    order=dict((_format(b), i) for i, b in enumerate(metric.buckets))
+    groups={}
+    others=[]
+    for key, value in samples:
+        if key.startswith(metric.name+'_bucket{'):
+            labels=key[len(metric.name+'_bucket{'):-1]
+            rest, _, le=labels.rpartition('le=')
+            groups.setdefault(rest, []).append((order.get(le.strip('"'), 0), key, value))
+        else:
+            others.append((key, value))
+    result=[]
+    for rest in sorted(groups):
+        total=0
+        for _, key, value in sorted(groups[rest]):
+            total+=value
+            result.append((key, total))
+    return result+others
+
+class CacheMetrics(object):
+    """
+    Exports the hits and misses of caches (see :meth:`cache.LRUCache.export`),
+    labelled with the name of each cache.
+
+    :arg Registry registry: the registry for the metrics
+    """
+    def __init__(self, registry):
+        self.hits=registry.counter('sagecell_cache_hits_total',
+                                   'Cache lookups that found an entry, by cache', ['cache'])
+        self.misses=registry.counter('sagecell_cache_misses_total',
+                                     'Cache lookups that found no entry, by cache', ['cache'])
+
+    def instrument(self, cache, name):
+        """
+        Export a cache's hits and misses.
+
+        :arg cache.LRUCache cache: the cache
+        :arg str name: the name of the cache
+        :returns: the cache
+        """
+        cache.export(name, self.hits, self.misses)
+        return cache
+
+class PoolMetrics(object):
+    """
+    Exports the events of context pools (see :meth:`misc.ContextPool.export`),
+    labelled with the name of each pool.
+
+    :arg Registry registry: the registry for the metrics
+    """
+    EVENTS={'checkouts': 'Contexts checked out',
+            'misses': 'Checkouts that found no idle context',
+            'waits': 'Checkouts that waited because the pool was full',
+            'timeouts': 'Checkouts that gave up waiting',
+            'created': 'Contexts created',
+            'discarded': 'Contexts discarded after a failed health check or reset'}
+
+    def __init__(self, registry):
+        self.counters=dict((event, registry.counter('sagecell_context_pool_%s_total'%event,
+                                                    '%s, by pool'%documentation, ['pool']))
+                           for event, documentation in sorted(self.EVENTS.items()))
+
+    def instrument(self, pool, name):
+        """
+        Export a pool's events.
+
+        :arg misc.ContextPool pool: the pool
+        :arg str name: the name of the pool
+        :returns: the pool
+        """
+        pool.export(name, self.counters)
+        return pool
+
+class Instrumented(object):
+    """
+    Records the number of calls, latency and errors of the public
+    methods of database or filestore classes.
+
+    :arg Registry registry: the registry for the metrics
+    :arg str subsystem: ``"db"`` or ``"fs"``, used in the metric names
+    """
+    def __init__(self, registry, subsystem):
+        self.latency=registry.histogram('sagecell_%s_call_duration_seconds'%subsystem,
+                                        'Time spent in %s methods'%subsystem, ['method'])
+        self.errors=registry.counter('sagecell_%s_errors_total'%subsystem,
+                                     'Exceptions raised by %s methods'%subsystem, ['method', 'type'])
+        self._done=set()
+
+    def instrument(self, cls, base):
+        """
+        Wrap the methods of ``cls`` that are part of the ``base`` class's
+        interface, once per class.
+
+        :arg type cls: the adaptor class
+        :arg type base: :class:`db.DB` or :class:`filestore.FileStore`
+        """
+        if cls in self._done:
+            return
+        self._done.add(cls)
+        for name in dir(base):
+            if name.startswith('_') or name in ('new_context', 'new_context_copy',
+                                                'reset_context', 'check_context'):
+                continue
+            method=getattr(cls, name, None)
+            if callable(method):
+                setattr(cls, name, self._wrap(name, method))
+
+    def _wrap(self, name, method):
+        from time import time
+        from functools import wraps
+        func=getattr(method, 'im_func', method)
+        instrumented=self
+        @wraps(func)
+        def wrapper(*args, **kwds):
+            start=time()
+            try:
+                return func(*args, **kwds)
+            except Exception as e:
+                instrumented.errors.labels(name, type(e).__name__).inc()
+                raise
+            finally:
+                instrumented.latency.labels(name).observe(time()-start)
+        return wrapper
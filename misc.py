@@ -85,5 +85,232 @@ def select_db(sysargs=None, context=None):
         return_fs = filestore.FileStoreMongo(conn)
     elif fs=="zmq":
         return_fs = filestore.FileStoreZMQ(address=sysargs.fsaddress)
+    elif fs=="filesystem":
+        return_fs = filestore.FileStoreFilesystem(**get_config('filesystem_config'))
 
     return return_db, return_fs
+
+import threading
+from contextlib import contextmanager
+
+class PoolTimeout(Exception):
+    """
+    Raised when no context becomes free in a :class:`ContextPool`
+    within the pool's timeout.
+    """
+    pass
+
+class ContextPool(object):
+    """
+    A bounded, thread-safe pool of database or filestore contexts.
+
+    Creating a context with ``new_context_copy`` can be expensive (for
+    MongoDB it authenticates again; for SQLAlchemy it opens a new
+    session), so instead of making one for each web request, requests
+    check a context out of the pool and return it when they are done.
+    A returned context is cleaned up with ``reset_context``, and a
+    context that has been idle for a while is checked with
+    ``check_context`` before it is handed out again.
+
+    The ``stats`` dict counts ``checkouts``, ``misses`` (no idle
+    context was available), ``waits`` (the pool was full, so the
+    request had to wait for a context to be returned), ``timeouts``
+    (the wait ran out), ``created``, and ``discarded`` (failed a health
+    check or reset) contexts.  To export them as metrics, see
+    :meth:`export`.
+
+    :arg obj: the database or filestore object to copy
+    :arg int size: the maximum number of contexts
+    :arg float timeout: the time (in seconds) to wait for a context
+        when all of them are in use
+    :arg float check_after: check the health of a context that has been
+        idle for longer than this many seconds
+    """
+    def __init__(self, obj, size=10, timeout=5, check_after=30):
+        self._obj=obj
+        self._size=size
+        self._timeout=timeout
+        self._check_after=check_after
+        self._cond=threading.Condition(threading.Lock())
+        # idle contexts, as (context, time returned) tuples; the most
+        # recently used contexts are at the end
+        self._idle=[]
+        self._count=0
+        self.stats=dict(checkouts=0, misses=0, waits=0, timeouts=0, created=0, discarded=0)
+        # (name, {stat: counter}) if exported
+        self._exported=None
+
+    def export(self, name, counters):
+        """
+        Also count the events in ``stats`` with metrics.
+
+        :arg str name: the value of the ``pool`` label
+        :arg dict counters: maps each key of ``stats`` to a
+            :class:`metrics.Counter` with a ``pool`` label
+        """
+        self._exported=(name, counters)
+
+    def _event(self, stat):
+        # the caller holds the lock
+        self.stats[stat]+=1
+        if self._exported is not None:
+            name, counters=self._exported
+            counters[stat].labels(name).inc()
+
+    def checkout(self):
+        """
+        Get a context from the pool, creating one if there are no idle
+        contexts and the pool is not full.
+
+        :raises PoolTimeout: if no context is free within the timeout
+        """
+        with self._cond:
+            self._event('checkouts')
+            if not self._idle:
+                self._event('misses')
+                if self._count>=self._size:
+                    self._event('waits')
+                    end_time=time.time()+self._timeout
+                    while not self._idle and self._count>=self._size:
+                        remaining=end_time-time.time()
+                        if remaining<=0:
+                            self._event('timeouts')
+                            raise PoolTimeout("no free context after %s seconds"%self._timeout)
+                        self._cond.wait(remaining)
+            if self._idle:
+                context, returned=self._idle.pop()
+            else:
+                context, returned=None, None
+                self._count+=1
+        if context is not None and time.time()-returned>self._check_after:
+            if not context.check_context():
+                # the new context takes the stale one's place in the
+                # pool, so the count doesn't change
+                with self._cond:
+                    self._event('discarded')
+                context=None
+        if context is None:
+            try:
+                context=self._obj.new_context_copy()
+            except:
+                self._discard(False)
+                raise
+            with self._cond:
+                self._event('created')
+        return context
+
+    def checkin(self, context):
+        """
+        Clean up a context and return it to the pool.
+
+        :arg context: a context from :meth:`checkout`
+        """
+        try:
+            context.reset_context()
+        except Exception:
+            self._discard()
+            return
+        with self._cond:
+            self._idle.append((context, time.time()))
+            self._cond.notify()
+
+    def _discard(self, count=True):
+        with self._cond:
+            self._count-=1
+            if count:
+                self._event('discarded')
+            self._cond.notify()
+
+    @contextmanager
+    def context(self):
+        """
+        Check out a context for the duration of a ``with`` block.
+        """
+        context=self.checkout()
+        try:
+            yield context
+        finally:
+            self.checkin(context)
+
+
+class Overloaded(Exception):
+    """
+    Raised by :meth:`AdmissionControl.admit` to turn a request away.
+
+    :arg float wait: the estimated wait (in seconds) for a worker
+    """
+    def __init__(self, wait):
+        Exception.__init__(self, "estimated wait of %s seconds"%wait)
+        self.wait=wait
+
+class AdmissionControl(object):
+    """
+    Decides whether to accept new computations, based on how long they
+    would wait for a worker: the number of computations no device has
+    claimed yet, less the free slots the devices report, divided by
+    the number of workers of the registered devices, times the typical
+    time a computation takes.
+
+    Querying the database for every request would add to the load we
+    are trying to shed, so the estimate is refreshed at most every
+    ``interval`` seconds; in between, each accepted computation adds
+    its share to the estimate.
+
+    :arg float max_wait: reject computations that would wait longer
+        than this many seconds, or ``None`` to accept everything
+    :arg float exec_time: the typical time (in seconds) a worker
+        spends on a computation
+    :arg float interval: how often (in seconds) to refresh the estimate
+    """
+    def __init__(self, max_wait=30, exec_time=2, interval=1):
+        self.max_wait=max_wait
+        self.exec_time=exec_time
+        self.interval=interval
+        self._lock=threading.Lock()
+        self._checked=None
+        self._wait=0
+        self._per_request=0
+
+    def estimate(self, db):
+        """
+        Estimate how long a new computation would wait for a worker.
+
+        :arg db: a database context
+        :returns: the estimated wait in seconds (infinite if there are
+            computations waiting but no workers)
+        :rtype: float
+        """
+        now=time.time()
+        if self._checked is None or now-self._checked>=self.interval:
+            # only one thread refreshes; the others use the old estimate
+            if self._lock.acquire(False):
+                try:
+                    queued=db.get_unassigned_count()
+                    devices=db.get_devices()
+                    workers=sum(d.get('workers') or 0 for d in devices)
+                    slots=sum(d.get('slots') or 0 for d in devices)
+                    if workers:
+                        self._per_request=float(self.exec_time)/workers
+                        self._wait=max(queued-slots, 0)*self._per_request
+                    else:
+                        self._per_request=0
+                        self._wait=float('inf') if queued else 0
+                    self._checked=now
+                finally:
+                    self._lock.release()
+        return self._wait
+
+    def admit(self, db, count=1):
+        """
+        Accept or reject new computations.
+
+        :arg db: a database context
+        :arg int count: the number of computations
+        :raises Overloaded: if the estimated wait is too long
+        """
+        if self.max_wait is None:
+            return
+        wait=self.estimate(db)
+        if wait>self.max_wait:
+            raise Overloaded(wait)
+        self._wait+=self._per_request*count
@@ -0,0 +1,341 @@
+u"""
+Output Notifications
+--------------------
+
+Web requests that wait for output (long polls, output streams) would
+otherwise have to query the database over and over.  Instead, they
+register interest in a session with a :class:`Notifier` and sleep until
+the database adaptor announces, through :meth:`Notifier.publish`, that
+it has committed new messages for that session.
+
+A wait always has a timeout, after which the caller checks the database
+anyway, so a lost notification only costs latency, not correctness.
+
+The waits use :class:`threading.Event`, so when the web server runs
+under gevent (for example, ``uwsgi --gevent``), each waiting request
+is a greenlet and thousands of idle waiters fit in one process.
+
+Output is usually committed by another process (the trusted database
+that the devices talk to), so a notification published there has to
+reach every web server process.  That is the job of the optional
+notification bus, a \xd8MQ forwarder started with::
+
+    python notify.py
+
+and configured with ``notify_config`` in ``sagecell_config``.  Every
+process that commits output sends ``(session, last sequence, completed)``
+to the bus, and every web server process runs a thread (see
+:meth:`Notifier.subscribe`) that passes the events on to its local
+waiters.  Without the bus, waiters just recheck the database when their
+timeouts expire.
+
+Every session ID with output goes over the bus, so only trusted
+processes (the web servers and the trusted database) may publish to it
+or subscribe to it.  Give the bus ``ipc://`` addresses: the forwarder
+makes their socket files readable and writable only by its own account,
+which has to be the trusted account.  A ``tcp://`` address can be
+reached by every account on the machine.
+
+The bus also carries an event (with the topic :data:`INPUT_TOPIC`)
+whenever a new input message is committed (see
+:meth:`Notifier.publish_input`), so that devices can sleep until there
+is work for them instead of polling the database.  Devices run
+untrusted code, so they don't subscribe to the bus themselves; the
+trusted database relays just these events to them (see
+:func:`trusted_db.loop`).
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+#: The bus topic of new input events.  Output events have session IDs
+#: as their topics, which are never this.
+INPUT_TOPIC='input'
+
+class Notifier(object):
+    """
+    Wakes up the waiters on a session when new output is published
+    for that session.
+
+    :arg str publish_address: the address of the notification bus to
+        send committed output to, or ``None``
+    """
+
+    def __init__(self, publish_address=None):
+        self._lock=threading.Lock()
+        # session ID -> {waiter: True if the waiter only wants to know
+        # when the computation completes}
+        self._waiters={}
+        self.publish_address=publish_address
+        self._bus=None
+        self._bus_pid=None
+        self._bus_lock=threading.Lock()
+        self._subscriber_pid=None
+
+    @contextmanager
+    def listen(self, session, completion=False):
+        """
+        Register interest in new output for a session.  Register
+        *before* checking the database, so that output committed between
+        the check and the wait still wakes the waiter::
+
+            with notifier.listen(session) as event:
+                messages=db.get_messages(session, sequence)
+                if not messages:
+                    event.wait(timeout)
+
+        :arg str session: the session ID
+        :arg bool completion: if True, only wake up when the output
+            includes the end of a computation (an ``execute_reply`` or
+            ``session_end`` message), not for every new message
+        :returns: an event that is set when new output is published
+        :rtype: threading.Event
+        """
+        event=threading.Event()
+        self.register(session, event, completion)
+        try:
+            yield event
+        finally:
+            self.unregister(session, event)
+
+    def register(self, session, waiter, completion=False):
+        """
+        Register a waiter on a session until :meth:`unregister` is
+        called.  This is what :meth:`listen` uses; servers that don't
+        block a thread per request (see :mod:`tornado_server`) register
+        their own waiters.
+
+        :arg str session: the session ID
+        :arg waiter: any object with a ``set()`` method, which is called
+            (from whatever thread publishes) when new output is published
+        :arg bool completion: as for :meth:`listen`
+        """
+        with self._lock:
+            self._waiters.setdefault(session, {})[waiter]=completion
+
+    def unregister(self, session, waiter):
+        """
+        Remove a waiter registered with :meth:`register`.
+
+        :arg str session: the session ID
+        :arg waiter: the waiter
+        """
+        with self._lock:
+            waiters=self._waiters.get(session)
+            if waiters is not None:
+                waiters.pop(waiter, None)
+                if not waiters:
+                    del self._waiters[session]
+
+    def publish(self, session, sequence, completed=False):
+        """
+        Announce that messages up to ``sequence`` have been committed
+        for ``session``, waking everything listening on that session.
+
+        :arg str session: the session ID
+        :arg int sequence: the sequence number of the last new message
+        :arg bool completed: True if the new messages include the end of
+            a computation; listeners waiting only for completion are
+            not woken otherwise
+        """
+        with self._lock:
+            waiters=self._waiters.get(session)
+            if not waiters:
+                return
+            waiters=[e for e, c in waiters.iteritems() if completed or not c]
+        for event in waiters:
+            event.set()
+
+    def publish_messages(self, messages):
+        """
+        Call :meth:`publish` once for each session that has a message in
+        ``messages``.
+
+        :arg list messages: IPython-style messages that have just been
+            committed to the database
+        """
+        last={}
+        completed=set()
+        for m in messages:
+            try:
+                session=m['parent_header']['session']
+            except (KeyError, TypeError):
+                continue
+            last[session]=max(last.get(session, -1), m.get('sequence', -1))
+            if is_completion(m):
+                completed.add(session)
+        for session, sequence in last.iteritems():
+            self.publish(session, sequence, session in completed)
+            if self.publish_address is not None:
+                self._bus_send([session.encode('utf8'),
+                                '%d %d'%(sequence, session in completed)])
+
+    def publish_input(self):
+        """
+        Announce on the notification bus (if there is one) that a new
+        input message has been committed, waking the devices waiting for
+        work (see :func:`input_subscriber`).
+        """
+        if self.publish_address is not None:
+            self._bus_send([INPUT_TOPIC, ''])
+
+    def _bus_send(self, frames):
+        zmq=_zmq()
+        with self._bus_lock:
+            if self._bus_pid!=os.getpid():
+                # a socket can't be shared with a parent process
+                self._bus=zmq.Context().socket(zmq.PUB)
+                self._bus.connect(self.publish_address)
+                self._bus_pid=os.getpid()
+            try:
+                self._bus.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.ZMQError:
+                # the bus is only an optimization
+                pass
+
+    def subscribe(self, address):
+        """
+        Start a thread that wakes local waiters for the events on the
+        notification bus.  This can be called in every request; it only
+        starts the thread once per process.
+
+        :arg str address: the address the bus forwarder publishes on
+        """
+        if self._subscriber_pid==os.getpid():
+            return
+        with self._bus_lock:
+            if self._subscriber_pid==os.getpid():
+                return
+            self._subscriber_pid=os.getpid()
+        subscriber=threading.Thread(target=self._subscriber, args=(address,),
+                                    name='notification bus')
+        subscriber.daemon=True
+        subscriber.start()
+
+    def _subscriber(self, address):
+        zmq=_zmq()
+        socket=zmq.Context().socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, '')
+        socket.connect(address)
+        while True:
+            try:
+                session, event=socket.recv_multipart()
+                sequence, completed=event.split()
+                self.publish(session.decode('utf8'), int(sequence), completed=='1')
+            except (ValueError, UnicodeDecodeError):
+                # not one of our events
+                pass
+
+    def waiting(self):
+        """
+        :returns: the number of sessions that currently have waiters
+        :rtype: int
+        """
+        return len(self._waiters)
+
+def is_session_end(msg):
+    """
+    Return True if ``msg`` is the ``session_end`` extension message
+    that the device sends as the last message of a session.
+
+    :arg dict msg: an IPython-style message
+    """
+    return (msg.get('msg_type')=='extension'
+            and msg['content'].get('msg_type')=='session_end')
+
+def is_completion(msg):
+    """
+    Return True if ``msg`` ends a computation: either the
+    ``execute_reply`` for an execution request or the end of the
+    session.
+
+    :arg dict msg: an IPython-style message
+    """
+    return msg.get('msg_type')=='execute_reply' or is_session_end(msg)
+
+def _zmq():
+    u"""
+    Import the \xd8MQ bindings that cooperate with gevent if the
+    server runs under gevent.
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            import zmq.green as zmq
+            return zmq
+    except ImportError:
+        pass
+    import zmq
+    return zmq
+
+def input_subscriber(context, address):
+    u"""
+    Make a \xd8MQ socket that receives the new input events of the
+    notification bus (see :meth:`Notifier.publish_input`).  Its messages
+    carry no information; the socket is only for waiting on.
+
+    :arg zmq.Context context: the context to make the socket in
+    :arg str address: the address the bus forwarder publishes on, or
+        the address of a relay of its new input events
+    :rtype: zmq.Socket
+    """
+    import zmq
+    socket=context.socket(zmq.SUB)
+    socket.setsockopt(zmq.SUBSCRIBE, INPUT_TOPIC)
+    socket.connect(address)
+    return socket
+
+def bus_config():
+    """
+    :returns: the ``notify_config`` setting (a dict with the
+        ``publish`` and ``subscribe`` addresses of the notification
+        bus), or ``None`` if there is no bus
+    """
+    try:
+        import sagecell_config
+    except ImportError:
+        import sagecell_config_default as sagecell_config
+    return getattr(sagecell_config, 'notify_config', None)
+
+def forwarder(publish, subscribe):
+    """
+    Run the notification bus: receive the events that processes
+    committing output send to ``publish``, and send them on to the web
+    server processes subscribed to ``subscribe``.
+
+    :arg str publish: the address publishers connect to
+    :arg str subscribe: the address subscribers connect to
+    """
+    import zmq
+    context=zmq.Context()
+    frontend=context.socket(zmq.SUB)
+    frontend.setsockopt(zmq.SUBSCRIBE, '')
+    _bind(frontend, publish)
+    backend=context.socket(zmq.PUB)
+    _bind(backend, subscribe)
+    zmq.device(zmq.FORWARDER, frontend, backend)
+
+def _bind(socket, address):
+    """
+    Bind a socket of the bus.  The socket file of an ``ipc://`` address
+    is only readable and writable by this account.
+    """
+    if not address.startswith('ipc://'):
+        socket.bind(address)
+        return
+    # the file must not be open to other accounts, even for a moment
+    umask=os.umask(0077)
+    try:
+        socket.bind(address)
+    finally:
+        os.umask(umask)
+    os.chmod(address[len('ipc://'):], 0600)
+
+_config=bus_config()
+notifier=Notifier(_config['publish'] if _config else None)
+
+if __name__=='__main__':
+    if _config is None:
+        raise SystemExit("Set notify_config in sagecell_config to use the notification bus")
+    forwarder(_config['publish'], _config['subscribe'])
@@ -0,0 +1,183 @@
+"""
+Rate Limiting
+-------------
+
+Limits how fast each client may use the expensive parts of the web
+service, so that one misbehaving page or script can't crowd out
+everybody else.  Each client has a token bucket per budget (like
+``eval`` or ``service``): a request takes a token, and tokens come back
+at a steady rate up to the size of the bucket.  A client is identified
+both by its IP address and by the site it came from (its ``Origin`` or
+``Referer``), each with its own limits, since one embedding site serves
+many users.
+
+The buckets are kept in a memory-mapped file, locked with ``fcntl``, so
+all the processes of the web server share them.  The file is a fixed
+size hash table; when it is full, the buckets that were used the
+longest time ago are reused.
+"""
+
+import os
+import mmap
+import struct
+import fcntl
+import threading
+from hashlib import sha1
+from time import time
+
+# key hash (0 for an empty slot), tokens, time of the last update
+_SLOT=struct.Struct('Qdd')
+_KEY=struct.Struct('Q')
+
+class RateLimited(Exception):
+    """
+    Raised when a client has used up its budget.
+
+    :arg float retry_after: the number of seconds until the request
+        would be allowed
+    :arg str limit: which limit was hit (``"ip"`` or ``"origin"``)
+    """
+    def __init__(self, retry_after, limit):
+        Exception.__init__(self, "rate limited by %s for %s seconds"%(limit, retry_after))
+        self.retry_after=retry_after
+        self.limit=limit
+
+class TokenBuckets(object):
+    """
+    Token buckets shared by all the processes that open the same file.
+
+    :arg str path: the file that holds the buckets
+    :arg int slots: the number of buckets the file holds
+    :arg int probes: how many slots to search for a bucket before
+        reusing the least recently used one
+    """
+    def __init__(self, path, slots=65536, probes=8):
+        self.slots=slots
+        self.probes=probes
+        self._lock=threading.Lock()
+        size=slots*_SLOT.size
+        self._fd=os.open(path, os.O_RDWR|os.O_CREAT, 0600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size<size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._mm=mmap.mmap(self._fd, size)
+
+    def _find(self, key):
+        """
+        Find the slot for a key: its own, an empty one, or the least
+        recently used one of the slots searched.
+
+        :returns: the offset of the slot, the key's hash, and the
+            tokens and last update time (``None`` for a new bucket)
+        """
+        h=_KEY.unpack(sha1(key).digest()[:_KEY.size])[0] or 1
+        first=h%self.slots
+        oldest=None
+        for i in range(self.probes):
+            offset=((first+i)%self.slots)*_SLOT.size
+            slot_key, tokens, last=_SLOT.unpack_from(self._mm, offset)
+            if slot_key==h:
+                return offset, h, tokens, last
+            if slot_key==0:
+                return offset, h, None, None
+            if oldest is None or last<oldest[1]:
+                oldest=(offset, last)
+        return oldest[0], h, None, None
+
+    def take(self, buckets, cost=1):
+        """
+        Take ``cost`` tokens from each of several buckets, but only if
+        all of them have enough.
+
+        :arg list buckets: ``(key, rate, burst)`` tuples, where ``rate``
+            is the number of tokens added per second and ``burst`` the
+            size of the bucket
+        :arg int cost: the number of tokens to take
+        :returns: 0 if the tokens were taken, or else the number of
+            seconds until they would be available and the index of the
+            bucket that is short of tokens
+        :rtype: tuple
+        """
+        now=time()
+        with self._lock:
+            # fcntl locks don't exclude other threads of this process
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                states=[]
+                wait, short=0, None
+                for i, (key, rate, burst) in enumerate(buckets):
+                    offset, h, tokens, last=self._find(key)
+                    if tokens is None:
+                        tokens=burst
+                    else:
+                        tokens=min(burst, tokens+max(now-last, 0)*rate)
+                    needed=min(cost, burst)
+                    if tokens<needed and (needed-tokens)/rate>wait:
+                        wait, short=(needed-tokens)/rate, i
+                    states.append((offset, h, tokens, needed))
+                for offset, h, tokens, needed in states:
+                    if wait==0:
+                        tokens-=needed
+                    _SLOT.pack_into(self._mm, offset, h, tokens, now)
+                return wait, short
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+class RateLimiter(object):
+    """
+    Applies the configured limits to requests.
+
+    :arg dict limits: maps a budget name (``"eval"``, ``"message"``,
+        ``"service"``, ``"complete"``) to a dict with optional ``"ip"`` and ``"origin"``
+        limits, each a ``(tokens per second, bucket size)`` tuple
+    :arg str path: the file that holds the buckets
+    :arg int slots: the number of buckets the file holds
+    """
+    def __init__(self, limits, path='/tmp/sagecell_ratelimit', slots=65536):
+        self.limits=limits
+        self.path=path
+        self.slots=slots
+        self._buckets=None
+
+    def check(self, budget, ip, origin=None, cost=1):
+        """
+        Charge a request to a client's budget.
+
+        :arg str budget: the budget name
+        :arg str ip: the client's IP address
+        :arg str origin: the site the request came from, if known
+        :arg int cost: the number of tokens the request takes, which
+            should be at most :meth:`max_cost`; a bigger cost is
+            charged as if it were :meth:`max_cost`
+        :raises RateLimited: if the client has used up its budget
+        """
+        limits=self.limits.get(budget)
+        if not limits:
+            return
+        buckets=[]
+        names=[]
+        for name, client in (('ip', ip), ('origin', origin)):
+            if client and name in limits:
+                rate, burst=limits[name]
+                buckets.append(('%s:%s:%s'%(budget, name, client), rate, burst))
+                names.append(name)
+        if not buckets:
+            return
+        if self._buckets is None:
+            self._buckets=TokenBuckets(self.path, self.slots)
+        wait, short=self._buckets.take(buckets, cost)
+        if wait>0:
+            raise RateLimited(wait, names[short])
+
+    def max_cost(self, budget):
+        """
+        :returns: the most tokens one request can take from a budget
+            (the size of its smallest bucket), or ``None`` if the budget
+            is unlimited
+        :rtype: int
+        """
+        bursts=[burst for rate, burst in (self.limits.get(budget) or {}).values()]
+        return min(bursts) if bursts else None
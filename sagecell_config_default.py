@@ -27,6 +27,7 @@ mongo_config={
 webserver='flaskweb'
 #webserver='twistd'
 #webserver='uwsgi'
+#webserver='tornado'
 
 flaskweb_config={
     'port': 8080,
@@ -45,6 +46,17 @@ uwsgi_config={
     'listen': 500,
     'disable-logging': '',
     'socket': '/tmp/uwsgi.sock',
+    # Run each worker's requests as greenlets, so that requests waiting
+    # in /output_long_poll or /output_stream don't each hold a process
+    #'gevent': 1000,
+    }
+
+# The asynchronous server (tornado_server.py): database and filestore
+# calls run in 'threads' worker threads, which should be no more than
+# flask_config['db_pool']['size']
+tornado_config={
+    'port': 8888,
+    'threads': 20,
     }
 
 # DEVICE
@@ -56,10 +68,124 @@ device_config={
     'untrusted-python': python,
     'untrusted-cpu': -1, # seconds
     'untrusted-mem': -1, # megabytes
+    # session processes to keep forked and ready to start a session
+    'prefork': 2,
+    # sessions each device claims beyond its free workers; the rest are
+    # left for other devices
+    'lookahead': 1,
     }
 
 flask_config={
     'max_files': 10,
+    # the maximum total size (in bytes) of the files uploaded with a cell
+    'max_upload_bytes': 10*2**20,
+    # The most messages, and bytes of JSON, in one /output_poll response;
+    # clients page through larger backlogs
+    'output_poll_limit': 1000,
+    'output_poll_max_bytes': 2**20,
+    # /output_stream: maximum lifetime of a stream (the client reconnects
+    # after this), the range of the database polling interval, and how
+    # often to send a keepalive comment (all in seconds)
+    'stream_timeout': 300,
+    'stream_min_interval': 0.05,
+    'stream_max_interval': 1,
+    'stream_keepalive': 15,
+    # /output_long_poll: default and maximum time a request waits for
+    # output, and how often a waiting request (including /service)
+    # rechecks the database in case it missed a notification (all in
+    # seconds).  Without the notification bus (notify_config) there are
+    # no notifications from the trusted database, so requests recheck
+    # every 0.1 seconds at most.
+    'long_poll_timeout': 30,
+    'long_poll_max_timeout': 60,
+    'long_poll_recheck': 1,
+    # /service: the maximum time to wait for a snippet (in seconds), and
+    # the maximum number of snippets in one /service/batch request (a
+    # batch also has to fit in the client's 'service' rate limit buckets)
+    'service_timeout': 30,
+    'service_batch_max': 100,
+    # Database and filestore contexts are reused across requests.  Each
+    # web process keeps at most 'size' of each, and a request waits up
+    # to 'timeout' seconds for one before failing with a 503 error.
+    # Requests waiting for output only hold a context while they query
+    # the database, so 'size' doesn't limit how many can wait.
+    'db_pool': {'size': 20, 'timeout': 5},
+    # Cache the code and rendered page for the most popular permalinks
+    # (up to 'maxsize' of each, for 'ttl' seconds).  If 'shared' is True
+    # and uwsgi is started with --cache, all workers share one cache.
+    'permalink_cache': {'maxsize': 1000, 'ttl': 3600, 'shared': False},
+    # Files are streamed in pieces of this many bytes.  URLs with a
+    # version parameter may be cached by browsers for file_max_age seconds.
+    'file_chunk_size': 2**16,
+    'file_max_age': 365*24*3600,
+    # With fs='filesystem', let nginx send files itself, from an internal
+    # location that aliases filesystem_config['dir']:
+    #'file_sendfile': {'header': 'X-Accel-Redirect', 'prefix': '/sagecell_files/'},
+    # or for Apache/lighttpd:
+    #'file_sendfile': {'header': 'X-Sendfile'},
+    # Compress output and /service responses of at least min_size bytes
+    # with gzip (or brotli, if the brotli module is installed and
+    # 'brotli' is True).  The level goes from 1 (fastest) to 9 (smallest).
+    'compression': {'level': 6, 'min_size': 1024, 'brotli': True},
+    # Tab completion: the number of connections to the kernel, the time a
+    # request may take (in seconds), and how many line prefixes to cache
+    # and for how long (in seconds)
+    'completion': {'backends': 4, 'timeout': 0.5, 'cache_size': 1000, 'cache_ttl': 60},
+    # How long (in seconds) browsers may cache fingerprinted static
+    # assets and MathJax fonts, and the embedding script
+    'static_max_age': 365*24*3600,
+    'embed_max_age': 600,
+    # Cache the results of /service requests made with cache=1, and of
+    # the code of the listed permalinks (give their 'q' IDs), keeping up
+    # to 'maxsize' results for 'ttl' seconds.  Results that create files
+    # or interacts are never cached.
+    'service_cache': {'maxsize': 1000, 'ttl': 24*3600, 'shared': False, 'permalinks': []},
+    # Turn new computations away (with a 503 response) when they would
+    # wait more than max_wait seconds for a worker, estimating that each
+    # computation takes exec_time seconds and refreshing the estimate
+    # every interval seconds.  Set max_wait to None to accept everything.
+    'admission': {'max_wait': 30, 'exec_time': 2, 'interval': 1},
+    # Per-client rate limits for new computations (eval), messages to
+    # running sessions such as interact updates (message), /service (each
+    # snippet of a batch counts) and /complete, by IP address and by the
+    # site (Origin or Referer) the request came from.  Each limit is
+    # (requests per second, burst size); a client over its limit gets a
+    # 429 response.
+    'rate_limits': {
+        'eval': {'ip': (1, 30), 'origin': (20, 300)},
+        'message': {'ip': (10, 100), 'origin': (100, 1000)},
+        'service': {'ip': (2, 60), 'origin': (20, 300)},
+        'complete': {'ip': (10, 100), 'origin': (100, 1000)},
+        },
+    # Where the rate limit buckets (shared by all web server processes)
+    # are kept, and whether to trust the X-Forwarded-For header (set this
+    # when running behind nginx or another proxy)
+    'rate_limit': {'path': '/tmp/sagecell_ratelimit', 'slots': 65536, 'forwarded': False},
+    # The directory where each web server process keeps its values for
+    # /metrics; start_web.py empties it
+    'metrics_dir': '/tmp/sagecell_metrics',
+    }
+
+# OUTPUT NOTIFICATION BUS (optional; start it with "python notify.py")
+# Processes that commit output announce it on the bus, so that waiting
+# web requests in every web server process wake up at once instead of
+# polling the database.  New input is announced too, so devices wake up
+# as soon as there is work for them.  Every session ID goes over the bus,
+# so run it as the trusted account on ipc:// addresses, whose socket files
+# only that account can use; any local account can reach a tcp:// address.
+#notify_config={
+#    'publish': 'ipc:///tmp/sagecell_notify_publish',
+#    'subscribe': 'ipc:///tmp/sagecell_notify_subscribe',
+#    }
+
+# FILESYSTEM FILESTORE (use with fs='filesystem')
+filesystem_config={
+    'dir': '/tmp/sagecell_files',
+    'levels': 2,
     }
 
 LOGGING=True
+# The default log level, and the levels of the web, device, db, fs and
+# trusted loggers (for example, {'web': 'DEBUG'} logs every request)
+LOG_LEVEL='INFO'
+LOG_LEVELS={}
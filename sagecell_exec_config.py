@@ -8,6 +8,23 @@ EMBEDDED_MODE = {"frontend":"sagecell",
                  "enable_sage":False,
                  "sage_mode":False}
 
+# Output written to stdout or stderr is sent in one message once this
+# many characters have been written, or this many seconds after the
+# first of them was written, whichever comes first.
+STREAM_FLUSH_SIZE = 4096
+STREAM_FLUSH_INTERVAL = 0.1
+
+# Sage code the device runs once, before it forks the processes that run
+# sessions, so that the modules it imports and the caches it fills are
+# ready in every session.  The first plot, for example, takes seconds
+# because of everything it imports.
+WARMUP = [
+    "plot(sin(x), (x, 0, 2*pi)).save(tmp_filename(ext='.png'))",
+    "integrate(x^2*sin(x), x); diff(exp(x)*cos(x), x); solve(x^2 == 2, x)",
+    "latex(sqrt(x)/(1 + x^2)); html('$%s$' % latex(x^2))",
+    "matrix(QQ, 3, range(9)).echelon_form(); factor(2^64 - 1)",
+]
+
 
     
 
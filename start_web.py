@@ -17,6 +17,8 @@ if webserver=='uwsgi':
     command=sagecell_config.uwsgi+' --module web_server:app'
 elif webserver=='twistd':
     command = sagecell_config.twistd+" -n web --wsgi web_server.app"
+elif webserver=='tornado':
+    command = sagecell_config.python+" ./tornado_server.py"
 elif webserver=='flaskweb':
     command = sagecell_config.python+" ./web_server.py"
 
@@ -26,6 +28,13 @@ for k,v in config.items():
     command+=' --%s %r '%(k,v)
 
 import os
+# drop the metrics of the previous server
+metrics_dir = getattr(sagecell_config, 'flask_config', {}).get('metrics_dir', '/tmp/sagecell_metrics')
+if os.path.isdir(metrics_dir):
+    for f in os.listdir(metrics_dir):
+        if f.endswith('.db'):
+            os.remove(os.path.join(metrics_dir, f))
+
 print 'Executing: ', command
 os.system(command)
 if pidfile and os.path.isfile(pidfile):
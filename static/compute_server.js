@@ -58,6 +58,14 @@ sagecell.Session.prototype.init = function (outputDiv, output, session_id, sage_
 
 // Manages querying the webserver for messages
 sagecell.Session.prototype.setQuery = function() {
+    if (this.eventSource !== undefined) {
+        // the output stream delivers messages as they arrive
+        return;
+    }
+    if (window.EventSource !== undefined && sagecell.$URL.output_stream !== undefined) {
+        this.openStream();
+        return;
+    }
     this.clearQuery();
     var now =  (new Date).getTime();
     var delta = now-this.last_update;
@@ -72,8 +80,29 @@ sagecell.Session.prototype.clearQuery = function() {
     clearTimeout(this.queryID);
 }
 
+// Receives messages through a Server-Sent Events stream instead of polling.
+// If the connection drops, the browser reconnects with a Last-Event-ID
+// header so the server resumes after the last message we received.
+sagecell.Session.prototype.openStream = function() {
+    var url = sagecell.$URL.output_stream + "?computation_id=" +
+        encodeURIComponent(this.session_id) + "&sequence=" + this.sequence;
+    this.eventSource = new EventSource(url);
+    this.eventSource.onmessage = $.proxy(function (e) {
+        this.get_output_success('{"content":[' + e.data + ']}');
+    }, this);
+}
+
+sagecell.Session.prototype.closeStream = function() {
+    if (this.eventSource !== undefined) {
+        this.eventSource.close();
+    }
+}
+
 sagecell.Session.prototype.updateQuery = function(new_interval) {
     this.poll_interval = new_interval;
+    if (this.eventSource !== undefined) {
+        return;
+    }
     this.clearQuery();
     this.setQuery();
 }
@@ -227,7 +256,8 @@ sagecell.Session.prototype.get_output_success = function(data) {
                     this.output('<div>'+html+'</div>',output_block);
                 }
                 if(msg.content.data['text/filename']!==undefined) {
-                    this.output('<img src="'+filepath+msg.content.data['text/filename']+'" />',output_block);
+                    // the version parameter lets the browser cache each version of the file
+                    this.output('<img src="'+filepath+msg.content.data['text/filename']+'?v='+encodeURIComponent(msg.header.msg_id)+'" />',output_block);
                 }
                 if(msg.content.data['image/png']!==undefined) {
                     //console.log('making png img with data in src');
@@ -278,7 +308,7 @@ sagecell.Session.prototype.get_output_success = function(data) {
                     }
                     for (j in this.files) {
                         //TODO: escape filenames and id
-                        html+='<a href="'+sagecell.$URL.root+'files/'+id+'/'+j+'" target="_blank">'+j+'</a> [Updated '+this.files[j]+' time(s)]<br>\n';
+                        html+='<a href="'+sagecell.$URL.root+'files/'+id+'/'+j+'?v='+this.files[j]+'" target="_blank">'+j+'</a> [Updated '+this.files[j]+' time(s)]<br>\n';
                     }
                     html+="</div>";
                     this.output(html,output_block).effect("pulsate", {times:1}, 500);
@@ -292,6 +322,7 @@ sagecell.Session.prototype.get_output_success = function(data) {
                         }
                     }
                     this.clearQuery();
+                    this.closeStream();
                     this.sessionContinue = false;
                     break;
                 case "interact_prepare":
@@ -323,6 +354,10 @@ sagecell.Session.prototype.get_output_success = function(data) {
         var output = this.outputDiv.find(".sagecell_output").get(0);
         MathJax.Hub.Queue(["Typeset",MathJax.Hub, output]);
         MathJax.Hub.Queue([function () {$(output).find(".math").removeClass('math');}]);
+        if (data.more) {
+            // the server has more output waiting; ask for it right away
+            this.last_update = 0;
+        }
     }
     if (this.sessionContinue) {
         this.setQuery();
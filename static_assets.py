@@ -0,0 +1,101 @@
+"""
+Static Assets
+-------------
+
+Serves the static bundles (``all.min.js``, ``all.min.css``, ...) that
+every page embedding a Sage cell loads.  When the web server starts,
+each bundle is hashed once.  Templates link to a bundle with
+:meth:`StaticAssets.url`, which adds the hash to the URL, so the
+response to that URL can never change and browsers may cache it
+forever.  If a ``.gz`` file (made by ``make``) sits next to a bundle,
+clients that accept gzip get it without any compression at request
+time.
+"""
+
+import os
+import mimetypes
+from hashlib import sha1
+
+class StaticAssets(object):
+    """
+    Fingerprinted, precompressed static files, which are kept in
+    memory.
+
+    :arg str static_folder: the directory with the static files
+    :arg list filenames: the files (relative to ``static_folder``) to
+        fingerprint; missing files are skipped
+    :arg int max_age: the number of seconds browsers may cache a
+        response to a fingerprinted URL
+    """
+    def __init__(self, static_folder, filenames, max_age=365*24*3600):
+        self.static_folder=static_folder
+        self.max_age=max_age
+        # filename -> {'hash', 'data', 'gzip' (data or None), 'mimetype'}
+        self.assets={}
+        for filename in filenames:
+            self.add(filename)
+
+    def add(self, filename):
+        """
+        Hash a static file and look for a precompressed copy.
+
+        :arg str filename: the file, relative to the static folder
+        """
+        path=os.path.join(self.static_folder, filename)
+        if not os.path.isfile(path):
+            return
+        with open(path, 'rb') as f:
+            data=f.read()
+        gz=path+'.gz'
+        # ignore a compressed copy left over from an older version
+        if os.path.isfile(gz) and os.path.getmtime(gz)>=os.path.getmtime(path):
+            with open(gz, 'rb') as f:
+                gzip_data=f.read()
+        else:
+            gzip_data=None
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if mimetype.startswith('text/') or mimetype=='application/javascript':
+            mimetype+='; charset=utf-8'
+        self.assets[filename]={'hash': sha1(data).hexdigest()[:16], 'data': data,
+                               'gzip': gzip_data, 'mimetype': mimetype}
+
+    def url(self, filename, **kwargs):
+        """
+        Get the external URL of a static file, including its hash if it
+        is a fingerprinted asset.  This is available in templates as
+        ``static_url``.
+
+        :arg str filename: the file, relative to the static folder
+        """
+        from flask import url_for
+        if filename in self.assets:
+            kwargs['v']=self.assets[filename]['hash']
+        return url_for('.static', filename=filename, _external=True, **kwargs)
+
+    def response(self, filename, request):
+        """
+        Make the response for a fingerprinted asset, or return ``None``
+        if ``filename`` isn't one.
+
+        :arg str filename: the file, relative to the static folder
+        :arg request: the current request
+        """
+        from flask import Response
+        asset=self.assets.get(filename)
+        if asset is None:
+            return None
+        etag='"%s"'%asset['hash']
+        headers={'ETag': etag, 'Vary': 'Accept-Encoding',
+                 'Access-Control-Allow-Origin': '*'}
+        if request.args.get('v')==asset['hash']:
+            headers['Cache-Control']='public, max-age=%d, immutable'%self.max_age
+        else:
+            # an old or missing hash; make the browser revalidate
+            headers['Cache-Control']='no-cache'
+        if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+            return Response(status=304, headers=headers)
+        data=asset['data']
+        if asset['gzip'] is not None and request.accept_encodings['gzip']:
+            data=asset['gzip']
+            headers['Content-Encoding']='gzip'
+        return Response(data, headers=headers, content_type=asset['mimetype'])
@@ -33,9 +33,9 @@ sagecell.init = function (callback) {
     sagecell.dependencies_loaded = false;
 
     // many stylesheets that have been smashed together into all.min.css
-    var stylesheets = [{{url_for(".static", filename="all.min.css", _external=True)|tojson|safe}},
-                       {{url_for(".static", filename="jqueryui/css/sage/jquery-ui-1.8.17.custom.css", _external=True)|tojson|safe}},
-                       {{url_for(".static", filename="colorpicker/css/colorpicker.css", _external=True)|tojson|safe}}];
+    var stylesheets = [{{static_url("all.min.css")|tojson|safe}},
+                       {{static_url("jqueryui/css/sage/jquery-ui-1.8.17.custom.css")|tojson|safe}},
+                       {{static_url("colorpicker/css/colorpicker.css")|tojson|safe}}];
     for (var i = 0; i < stylesheets.length; i++) {
         document.head.appendChild(sagecell.functions.createElement("link",
                 {rel: "stylesheet", href: stylesheets[i]}));
@@ -61,7 +61,7 @@ sagecell.init = function (callback) {
     load({'src': "{{- url_for('.static',filename='mathjax/MathJax.js', _external=True, config='TeX-AMS-MML_HTMLorMML') -}}"});
 
     // many prerequisites that have been smashed together into all.min.js
-    load({'src': "{{- url_for('.static', filename='all.min.js', _external=True) -}}"});
+    load({'src': "{{- static_url('all.min.js') -}}"});
 };
 
 sagecell.sagecell_dependencies_callback = function () {
@@ -666,9 +666,10 @@ sagecell.functions = {
 // Make the script root available to jquery
 sagecell.$URL = {'root': {{request.url_root|tojson|safe}},
         'evaluate': {{url_for('evaluate',_external=True)|tojson|safe}},
-        'powered_by_img': {{url_for('.static', filename='sagelogo.png', _external=True)|tojson|safe}},
-        'spinner_img': {{url_for('.static', filename='spinner.gif', _external=True)|tojson|safe}},
+        'powered_by_img': {{static_url('sagelogo.png')|tojson|safe}},
+        'spinner_img': {{static_url('spinner.gif')|tojson|safe}},
         'output_poll': {{url_for('output_poll',_external=True)|tojson|safe}},
+        'output_stream': {{url_for('output_stream',_external=True)|tojson|safe}},
         'output_long_poll': {{url_for('output_long_poll',_external=True)|tojson|safe}}};
 
 // Purely for backwards compability
@@ -0,0 +1,73 @@
+"""
+Nose tests for the in-process caches
+"""
+
+import time
+import tempfile
+import shutil
+import cache
+import metrics
+
+class TestLRUCache:
+    def setUp(self):
+        self.cache = cache.LRUCache(maxsize=3)
+
+    def test_get_set(self):
+        self.cache.set('a', 1)
+        assert self.cache.get('a') == 1
+        assert self.cache.get('b') is None
+        assert self.cache.get('b', 2) == 2
+
+    def test_eviction(self):
+        for key in 'abc':
+            self.cache.set(key, key)
+        # using 'a' makes 'b' the least recently used entry
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+        assert len(self.cache) == 3
+        assert self.cache.get('b') is None
+        assert self.cache.get('a') == 'a'
+        assert self.cache.get('d') == 'd'
+
+    def test_replace(self):
+        self.cache.set('a', 1)
+        self.cache.set('a', 2)
+        assert len(self.cache) == 1
+        assert self.cache.get('a') == 2
+
+    def test_ttl(self):
+        c = cache.LRUCache(ttl=0.01)
+        c.set('a', 1)
+        time.sleep(0.02)
+        assert c.get('a') is None
+
+    def test_counters(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('a')
+        self.cache.get('b')
+        assert self.cache.stats() == {'entries': 1, 'hits': 2, 'misses': 1}
+
+    def test_clear(self):
+        self.cache.set('a', 1)
+        self.cache.clear()
+        assert len(self.cache) == 0
+        assert self.cache.get('a') is None
+
+class TestCacheMetrics:
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.registry = metrics.Registry(self.dir)
+        self.cache = metrics.CacheMetrics(self.registry).instrument(cache.LRUCache(), 'test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_export(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+        self.cache.get('c')
+        text = self.registry.render()
+        assert 'sagecell_cache_hits_total{cache="test"} 1\n' in text
+        assert 'sagecell_cache_misses_total{cache="test"} 2\n' in text
@@ -0,0 +1,84 @@
+"""
+Nose tests for the database adaptors
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from nose.plugins.skip import SkipTest
+
+def output(session, sequence):
+    return {'header': {'msg_id': str(uuid.uuid4())},
+            'parent_header': {'session': session},
+            'msg_type': 'stream',
+            'content': {'name': 'stdout', 'data': '%d\n' % sequence},
+            'sequence': sequence}
+
+class Messages(object):
+    """
+    Tests of reading output back, shared by the adaptors.  The
+    subclasses set ``self.db`` to a database context.
+    """
+    def add(self):
+        self.session = str(uuid.uuid4())
+        other = str(uuid.uuid4())
+        self.sessions = [self.session, other]
+        # stored out of order, and mixed with another session's output
+        self.db.add_messages([output(self.session, s) for s in (2, 0, 3, 1)]
+                             + [output(other, s) for s in range(3)])
+
+    def test_get_messages(self):
+        self.add()
+        messages = self.db.get_messages(self.session)
+        assert [m['sequence'] for m in messages] == [0, 1, 2, 3]
+        assert all(m['parent_header']['session'] == self.session for m in messages)
+        assert [m['sequence'] for m in self.db.get_messages(self.session, 2)] == [2, 3]
+        assert self.db.get_messages(self.session, 4) == []
+
+    def test_get_messages_limit(self):
+        self.add()
+        messages = self.db.get_messages(self.session, 1, limit=2)
+        assert [m['sequence'] for m in messages] == [1, 2]
+        messages = self.db.get_messages(self.session, 3, limit=2)
+        assert [m['sequence'] for m in messages] == [3]
+        assert len(self.db.get_messages(self.session, limit=None)) == 4
+
+    def test_get_messages_json(self):
+        self.add()
+        messages = self.db.get_messages_json(self.session, 1, limit=2)
+        assert [s for s, m in messages] == [1, 2]
+        for s, m in messages:
+            m = json.loads(m)
+            assert m['sequence'] == s
+            assert m['content']['data'] == '%d\n' % s
+        assert self.db.get_messages_json(self.session, 4) == []
+
+class TestSQLAlchemy(Messages):
+    def setUp(self):
+        try:
+            import db_sqlalchemy
+        except ImportError:
+            raise SkipTest("SQLAlchemy is not installed")
+        self.directory = tempfile.mkdtemp()
+        uri = 'sqlite:///' + os.path.join(self.directory, 'test.db')
+        self.db = db_sqlalchemy.DB(uri)
+
+    def tearDown(self):
+        self.db.reset_context()
+        shutil.rmtree(self.directory)
+
+class TestMongo(Messages):
+    def setUp(self):
+        try:
+            import pymongo
+            import db_mongo
+            self.db = db_mongo.DB(pymongo.Connection(db_mongo.mongo_config['mongo_uri']))
+        except Exception:
+            raise SkipTest("MongoDB is not available")
+        self.sessions = []
+
+    def tearDown(self):
+        self.db.database.messages.remove(
+            {'parent_header.session': {'$in': self.sessions}})
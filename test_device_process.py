@@ -0,0 +1,148 @@
+"""
+Nose tests for the output buffering of session processes and the zygote
+"""
+
+import json
+import os
+import signal
+import time
+from multiprocessing import Manager
+import device_process
+import frames
+
+class Pipe(object):
+    """
+    Keeps the frames sent to it, like a :class:`frames.FramePipe` that
+    is read at once.
+    """
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(frame)
+
+    def messages(self):
+        return [json.loads('%s%s%s}' % (f.prefix, f.data, f.suffix)) for f in self.frames]
+
+class TestChannelQueue:
+    def setUp(self):
+        self.pipe = Pipe()
+        self.output = device_process.OutputIPython('s', self.pipe)
+        self.output.stdout_queue.flush_interval = 60
+
+    def tearDown(self):
+        self.output.flush()
+
+    def test_buffering(self):
+        stdout = self.output.stdout_queue
+        stdout.write('a')
+        stdout.write('b')
+        assert self.pipe.frames == []
+        stdout.flush()
+        assert [m['content'] for m in self.pipe.messages()] == [{'name': 'stdout', 'data': 'ab'}]
+
+    def test_flush_size(self):
+        stdout = self.output.stdout_queue
+        stdout.flush_size = 3
+        stdout.write('ab')
+        assert self.pipe.frames == []
+        stdout.write('cd')
+        assert len(self.pipe.frames) == 1
+        assert stdout._buffer == []
+
+    def test_flush_interval(self):
+        stdout = self.output.stdout_queue
+        stdout.flush_interval = 0.01
+        stdout.write('a')
+        time.sleep(0.2)
+        assert len(self.pipe.frames) == 1
+
+    def test_group(self):
+        # output keeps its order across the streams and other messages
+        self.output.stdout_queue.write('out')
+        self.output.stderr_queue.write('err')
+        self.output.message_queue.display({'text/plain': 'x'})
+        self.output.stdout_queue.write('more')
+        self.output.flush()
+        messages = self.pipe.messages()
+        assert [m['msg_type'] for m in messages] == ['stream', 'stream', 'display_data', 'stream']
+        assert [m['content'].get('data') for m in messages] == ['out', 'err', {'text/plain': 'x'}, 'more']
+
+    def test_bad_bytes(self):
+        stdout = self.output.stdout_queue
+        stdout.write('\xff')
+        stdout.write('ok')
+        stdout.flush()
+        stdout.write('after')
+        stdout.flush()
+        assert [m['content']['data'] for m in self.pipe.messages()] == [u'\ufffdok', 'after']
+
+class FS(object):
+    address = None
+
+    def new_context(self):
+        pass
+
+def upload_files(pipe, fs_secret):
+    pipe.recv()
+
+def run_session(session, message_queue, output_handler, resource_limits, fs_secret, upload):
+    # the session ID says how long the session runs
+    time.sleep(float(session.split(':')[1]))
+
+class TestZygote:
+    def setUp(self):
+        self.saved = dict((name, getattr(device_process, name, None)) for name in
+                          ('fs', 'outQueue', 'upload_files', 'execProcess'))
+        device_process.fs = FS()
+        device_process.outQueue = frames.FramePipe()
+        device_process.upload_files = upload_files
+        device_process.execProcess = run_session
+        # the manager first, so that it doesn't hold on to the zygote's pipe
+        self.manager = Manager()
+        self.queues = []
+        self.zygote = device_process.Zygote(1, idle=1)
+
+    def tearDown(self):
+        self.zygote._conn.close()
+        self.zygote.process.join()
+        self.manager.shutdown()
+        for name, value in self.saved.items():
+            setattr(device_process, name, value)
+
+    def start(self, session):
+        # the queue has to outlive the session's start, like the device's
+        self.queues.append(self.manager.Queue())
+        self.zygote.start(session, self.queues[-1], [], {'': 'a', 'upload': 'b'})
+
+    def wait(self, sessions, timeout=10):
+        done = []
+        end = time.time()+timeout
+        while len(done) < len(sessions) and time.time() < end:
+            done.extend(self.zygote.finished())
+            time.sleep(0.01)
+        return done
+
+    def test_assign(self):
+        # with one worker, the second session waits for the first
+        self.start('a:0.3')
+        self.start('b:0')
+        assert self.wait(['a:0.3', 'b:0']) == ['a:0.3', 'b:0']
+        assert self.zygote.finished() == set()
+        self.start('c:0')
+        assert self.wait(['c:0']) == ['c:0']
+
+    def test_reap_dead_zygote(self):
+        self.start('a:5')
+        time.sleep(0.5)
+        os.kill(self.zygote.process.pid, signal.SIGKILL)
+        # the lost session is reported, and a new zygote takes over
+        assert self.wait(['a:5'], timeout=2) == ['a:5']
+        assert self.zygote.process.is_alive()
+        self.start('b:0')
+        assert self.wait(['b:0']) == ['b:0']
+        # a zygote that dies between sessions is restarted on the next one
+        os.kill(self.zygote.process.pid, signal.SIGKILL)
+        time.sleep(0.2)
+        self.start('c:0')
+        assert set(self.wait(['c:0'])) == set(['c:0'])
@@ -0,0 +1,76 @@
+"""
+Nose tests for the output frames
+"""
+
+import os
+import json
+import frames
+
+def encode(frame, sequence=0):
+    return '%s%s%s, "sequence": %d}' % (frame.prefix, frame.data, frame.suffix, sequence)
+
+class TestFrames:
+    def test_message_frame(self):
+        msg = {'msg_type': 'display_data', 'content': {'data': {'text/plain': '2'}}}
+        frame = frames.message_frame('s', msg, 'block')
+        assert frame.channel == ''
+        assert frame.output_block == 'block'
+        assert json.loads(encode(frame, 5)) == dict(msg, sequence=5)
+
+    def test_stream_frame(self):
+        frame = frames.stream_frame('s', {'msg_type': 'stream'}, 'stdout', ['a"b\n', u'\xe9'])
+        assert frame.channel == 'stdout'
+        assert frame.output_block == ''
+        assert json.loads(encode(frame)) == {'msg_type': 'stream', 'sequence': 0,
+                                             'content': {'name': 'stdout', 'data': u'a"b\n\xe9'}}
+
+    def test_coalesce(self):
+        # the device joins consecutive stream frames by their data
+        first = frames.stream_frame('s', {'msg_type': 'stream'}, 'stdout', ['one\n'])
+        second = frames.stream_frame('s', {'msg_type': 'stream'}, 'stdout', ['"two"\\'])
+        joined = first._replace(data=first.data+second.data)
+        assert json.loads(encode(joined))['content']['data'] == 'one\n"two"\\'
+
+class TestFramePipe:
+    def setUp(self):
+        self.pipe = frames.FramePipe()
+
+    def tearDown(self):
+        os.close(self.pipe._reader)
+        os.close(self.pipe._writer)
+
+    def test_round_trip(self):
+        sent = [frames.message_frame('s%d' % i, {'msg_type': 'm', 'n': i}) for i in range(3)]
+        sent.append(frames.stream_frame(u's\xe9', {'msg_type': 'stream'}, 'stderr', ['x'], 'b'))
+        for frame in sent:
+            self.pipe.send(frame)
+        received = self.pipe.read()
+        assert self.pipe.drained
+        assert received[:3] == sent[:3]
+        assert received[3] == sent[3]._replace(session=sent[3].session.encode('utf8'))
+        assert self.pipe.read() == []
+        assert self.pipe.drained
+
+    def test_partial(self):
+        self.pipe.send(frames.message_frame('s', {'msg_type': 'm'}))
+        data = os.read(self.pipe._reader, 65536)
+        # only part of a frame has been written
+        os.write(self.pipe._writer, data[:7])
+        assert self.pipe.read() == []
+        assert not self.pipe.ready()
+        os.write(self.pipe._writer, data[7:])
+        received = self.pipe.read()
+        assert len(received) == 1 and received[0].session == 's'
+
+    def test_limit(self):
+        for i in range(5):
+            self.pipe.send(frames.message_frame('s', {'msg_type': 'm', 'n': i}))
+        first = self.pipe.read(max_frames=3)
+        assert len(first) == 3
+        assert not self.pipe.drained
+        # the rest was read into the buffer, where polling the pipe
+        # wouldn't find it
+        assert self.pipe.ready()
+        rest = self.pipe.read(max_frames=3)
+        assert [json.loads(encode(f))['n'] for f in first+rest] == range(5)
+        assert self.pipe.drained
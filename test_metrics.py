@@ -0,0 +1,106 @@
+"""
+Nose tests for the metrics
+"""
+
+import os
+import tempfile
+import shutil
+import metrics
+
+class TestRegistry:
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.registry = metrics.Registry(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_counter(self):
+        c = self.registry.counter('requests_total', 'Requests', ['endpoint'])
+        c.labels('eval').inc()
+        c.labels('eval').inc(2)
+        c.labels('service').inc()
+        text = self.registry.render()
+        assert '# TYPE requests_total counter\n' in text
+        assert 'requests_total{endpoint="eval"} 3\n' in text
+        assert 'requests_total{endpoint="service"} 1\n' in text
+
+    def test_gauge(self):
+        g = self.registry.gauge('in_progress', 'Requests in progress')
+        g.labels().inc(5)
+        g.labels().dec(2)
+        assert 'in_progress 3\n' in self.registry.render()
+        g.labels().set(1.5)
+        assert 'in_progress 1.5\n' in self.registry.render()
+
+    def test_histogram(self):
+        h = self.registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            h.labels().observe(value)
+        text = self.registry.render()
+        assert 'latency_seconds_bucket{le="0.1"} 1\n' in text
+        assert 'latency_seconds_bucket{le="1.0"} 3\n' in text
+        assert 'latency_seconds_bucket{le="+Inf"} 4\n' in text
+        assert 'latency_seconds_count 4\n' in text
+        assert 'latency_seconds_sum 6.05\n' in text
+
+    def test_escaping(self):
+        c = self.registry.counter('labelled_total', 'Labels', ['value'])
+        c.labels('a "b"\\\n').inc()
+        assert r'labelled_total{value="a \"b\"\\\n"} 1' in self.registry.render()
+
+    def test_processes(self):
+        c = self.registry.counter('forked_total', 'Counted in two processes')
+        g = self.registry.gauge('forked', 'Set in two processes')
+        c.labels().inc()
+        g.labels().inc()
+        pid = os.fork()
+        if pid == 0:
+            # a new process writes its own files
+            try:
+                c.labels().inc()
+                g.labels().inc()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        text = self.registry.render()
+        # the counters of exited processes still count; their gauges don't
+        assert 'forked_total 2\n' in text
+        assert 'forked 1\n' in text
+
+class TestInstrumented:
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.registry = metrics.Registry(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_instrument(self):
+        class Base(object):
+            def get(self):
+                pass
+            def fail(self):
+                pass
+        class Adaptor(Base):
+            def get(self):
+                return 1
+            def fail(self):
+                raise KeyError
+            def extra(self):
+                return 2
+        metrics.Instrumented(self.registry, 'db').instrument(Adaptor, Base)
+        a = Adaptor()
+        assert a.get() == 1
+        try:
+            a.fail()
+        except KeyError:
+            pass
+        else:
+            assert False
+        assert a.extra() == 2
+        text = self.registry.render()
+        assert 'sagecell_db_call_duration_seconds_count{method="get"} 1\n' in text
+        assert 'sagecell_db_call_duration_seconds_count{method="fail"} 1\n' in text
+        assert 'method="extra"' not in text
+        assert 'sagecell_db_errors_total{method="fail",type="KeyError"} 1\n' in text
@@ -0,0 +1,166 @@
+"""
+Nose tests for the context pools and admission control
+"""
+
+import time
+import threading
+import tempfile
+import shutil
+import misc
+import metrics
+
+class Context(object):
+    """
+    A database context that counts how it is used.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.healthy = True
+
+    def new_context_copy(self):
+        self.source.created += 1
+        return Context(self.source)
+
+    def reset_context(self):
+        if not self.healthy:
+            raise RuntimeError("broken context")
+
+    def check_context(self):
+        return self.healthy
+
+class Source(Context):
+    def __init__(self):
+        Context.__init__(self, self)
+        self.created = 0
+
+class TestContextPool:
+    def setUp(self):
+        self.source = Source()
+        self.pool = misc.ContextPool(self.source, size=2, timeout=0.05, check_after=30)
+
+    def test_reuse(self):
+        with self.pool.context() as first:
+            pass
+        with self.pool.context() as second:
+            assert second is first
+        assert self.source.created == 1
+        assert self.pool.stats['checkouts'] == 2
+        assert self.pool.stats['misses'] == 1
+
+    def test_timeout(self):
+        contexts = [self.pool.checkout() for i in range(2)]
+        start = time.time()
+        try:
+            self.pool.checkout()
+        except misc.PoolTimeout:
+            pass
+        else:
+            assert False
+        assert time.time()-start >= 0.05
+        assert self.pool.stats['waits'] == 1
+        assert self.pool.stats['timeouts'] == 1
+        # a returned context goes to a waiting request
+        threading.Timer(0.01, self.pool.checkin, (contexts[0],)).start()
+        self.pool._timeout = 5
+        assert self.pool.checkout() is contexts[0]
+
+    def test_discard(self):
+        context = self.pool.checkout()
+        context.healthy = False
+        self.pool.checkin(context)
+        assert self.pool.stats['discarded'] == 1
+        # the broken context's place in the pool is free again
+        contexts = [self.pool.checkout() for i in range(2)]
+        assert context not in contexts
+        assert self.source.created == 3
+
+    def test_stale(self):
+        self.pool._check_after = 0
+        with self.pool.context() as first:
+            pass
+        first.healthy = False
+        with self.pool.context() as second:
+            assert second is not first
+            assert self.pool._count == 1
+        assert self.pool.stats['discarded'] == 1
+
+    def test_export(self):
+        directory = tempfile.mkdtemp()
+        try:
+            registry = metrics.Registry(directory)
+            metrics.PoolMetrics(registry).instrument(self.pool, 'db')
+            with self.pool.context():
+                pass
+            text = registry.render()
+            assert 'sagecell_context_pool_checkouts_total{pool="db"} 1\n' in text
+            assert 'sagecell_context_pool_misses_total{pool="db"} 1\n' in text
+            assert 'sagecell_context_pool_created_total{pool="db"} 1\n' in text
+        finally:
+            shutil.rmtree(directory)
+
+class Queue(object):
+    """
+    A database context that reports a fixed queue and set of devices.
+    """
+    def __init__(self, queued, devices):
+        self.queued = queued
+        self.devices = devices
+        self.queries = 0
+
+    def get_unassigned_count(self):
+        self.queries += 1
+        return self.queued
+
+    def get_devices(self):
+        return self.devices
+
+class TestAdmissionControl:
+    def setUp(self):
+        self.control = misc.AdmissionControl(max_wait=10, exec_time=2, interval=30)
+
+    def test_admit(self):
+        # 4 workers with 1 free slot: 5 waiting computations take
+        # (5-1)*2/4 = 2 seconds to start
+        db = Queue(5, [{'workers': 2, 'slots': 1}, {'workers': 2, 'slots': 0}])
+        self.control.admit(db)
+        assert self.control.estimate(db) == 2.5
+
+    def test_reject(self):
+        db = Queue(25, [{'workers': 2, 'slots': 0}])
+        try:
+            self.control.admit(db)
+        except misc.Overloaded as e:
+            assert e.wait == 25
+        else:
+            assert False
+
+    def test_no_workers(self):
+        self.control.admit(Queue(0, []))
+        try:
+            self.control.admit(Queue(1, []), count=1)
+        except misc.Overloaded:
+            assert False
+        self.control._checked = None
+        try:
+            self.control.admit(Queue(1, []))
+        except misc.Overloaded as e:
+            assert e.wait == float('inf')
+        else:
+            assert False
+
+    def test_interval(self):
+        # between refreshes, accepted computations add to the estimate
+        db = Queue(0, [{'workers': 1, 'slots': 0}])
+        for i in range(3):
+            self.control.admit(db, count=2)
+        assert db.queries == 1
+        try:
+            self.control.admit(db)
+        except misc.Overloaded as e:
+            assert e.wait == 12
+        else:
+            assert False
+
+    def test_disabled(self):
+        control = misc.AdmissionControl(max_wait=None)
+        control.admit(Queue(1000, []))
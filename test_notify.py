@@ -0,0 +1,81 @@
+"""
+Nose tests for the output notifications
+"""
+
+import threading
+import notify
+
+class Waiter(object):
+    def __init__(self):
+        self.count = 0
+
+    def set(self):
+        self.count += 1
+
+def message(session, sequence, msg_type='stream'):
+    return {'parent_header': {'session': session}, 'sequence': sequence,
+            'msg_type': msg_type, 'content': {}}
+
+class TestNotifier:
+    def setUp(self):
+        self.notifier = notify.Notifier()
+
+    def test_listen(self):
+        with self.notifier.listen('s') as event:
+            assert self.notifier.waiting() == 1
+            assert not event.is_set()
+            self.notifier.publish('other', 1)
+            assert not event.is_set()
+            threading.Timer(0.01, self.notifier.publish, ('s', 1)).start()
+            assert event.wait(5)
+        assert self.notifier.waiting() == 0
+        # publishing without listeners does nothing
+        self.notifier.publish('s', 2)
+
+    def test_register(self):
+        w = Waiter()
+        self.notifier.register('s', w)
+        assert self.notifier.waiting() == 1
+        self.notifier.publish('s', 1)
+        self.notifier.publish('s', 2, completed=True)
+        assert w.count == 2
+        self.notifier.unregister('s', w)
+        assert self.notifier.waiting() == 0
+        self.notifier.publish('s', 3)
+        assert w.count == 2
+        # unregistering twice does nothing
+        self.notifier.unregister('s', w)
+
+    def test_publish_messages_once(self):
+        # one wakeup per session, however many messages it has
+        w = Waiter()
+        self.notifier.register('s', w)
+        self.notifier.publish_messages([message('s', 0), message('s', 1)])
+        assert w.count == 1
+
+    def test_completion(self):
+        with self.notifier.listen('s') as every:
+            with self.notifier.listen('s', completion=True) as completion:
+                self.notifier.publish('s', 1)
+                assert every.is_set() and not completion.is_set()
+                self.notifier.publish('s', 2, completed=True)
+                assert completion.is_set()
+
+    def test_publish_messages(self):
+        with self.notifier.listen('a') as a:
+            with self.notifier.listen('b', completion=True) as b_done:
+                with self.notifier.listen('c') as c:
+                    self.notifier.publish_messages([message('a', 0), message('a', 1),
+                                                    message('b', 0), message('b', 1, 'execute_reply'),
+                                                    {'content': {}}])
+                    assert a.is_set() and b_done.is_set() and not c.is_set()
+
+class TestMessages:
+    def test_is_completion(self):
+        end = {'msg_type': 'extension', 'content': {'msg_type': 'session_end'}}
+        assert notify.is_session_end(end)
+        assert notify.is_completion(end)
+        assert notify.is_completion({'msg_type': 'execute_reply', 'content': {}})
+        assert not notify.is_completion({'msg_type': 'stream', 'content': {}})
+        assert not notify.is_session_end({'msg_type': 'extension',
+                                          'content': {'msg_type': 'files'}})
@@ -0,0 +1,102 @@
+"""
+Nose tests for the rate limiter
+"""
+
+import os
+import time
+import tempfile
+import shutil
+import ratelimit
+
+class TestRateLimiter:
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'buckets')
+        self.limits = {'eval': {'ip': (1, 2), 'origin': (1, 3)},
+                       'complete': {'ip': (100, 2)}}
+        self.limiter = ratelimit.RateLimiter(self.limits, self.path, slots=64)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def limited(self, *args):
+        try:
+            self.limiter.check(*args)
+        except ratelimit.RateLimited as e:
+            return e
+        return None
+
+    def test_burst(self):
+        assert self.limited('eval', '1.2.3.4') is None
+        assert self.limited('eval', '1.2.3.4') is None
+        e = self.limited('eval', '1.2.3.4')
+        assert e is not None
+        assert e.limit == 'ip'
+        assert 0 < e.retry_after <= 1
+        # other clients have their own buckets
+        assert self.limited('eval', '5.6.7.8') is None
+
+    def test_refill(self):
+        for i in range(2):
+            self.limiter.check('complete', '1.2.3.4')
+        assert self.limited('complete', '1.2.3.4') is not None
+        time.sleep(0.02)
+        assert self.limited('complete', '1.2.3.4') is None
+
+    def test_origin(self):
+        # each IP address is within its limit, but the site isn't
+        for ip in ('1.1.1.1', '2.2.2.2', '3.3.3.3'):
+            assert self.limited('eval', ip, 'http://example.com') is None
+        e = self.limited('eval', '4.4.4.4', 'http://example.com')
+        assert e is not None and e.limit == 'origin'
+        assert self.limited('eval', '4.4.4.4', 'http://example.org') is None
+
+    def test_all_or_nothing(self):
+        # a request turned away by its site takes nothing from its IP
+        # address's bucket
+        for ip in ('1.1.1.1', '2.2.2.2', '3.3.3.3'):
+            self.limiter.check('eval', ip, 'http://example.com')
+        assert self.limited('eval', '1.1.1.1', 'http://example.com') is not None
+        assert self.limited('eval', '1.1.1.1') is None
+
+    def test_cost(self):
+        assert self.limited('eval', '1.2.3.4', None, 2) is None
+        assert self.limited('eval', '1.2.3.4') is not None
+        # a cost bigger than the bucket takes the whole bucket
+        assert self.limited('eval', '5.6.7.8', None, 10) is None
+        assert self.limited('eval', '5.6.7.8') is not None
+
+    def test_budgets(self):
+        for i in range(2):
+            self.limiter.check('eval', '1.2.3.4')
+        assert self.limited('eval', '1.2.3.4') is not None
+        assert self.limited('complete', '1.2.3.4') is None
+        # budgets without limits are unlimited
+        for i in range(10):
+            assert self.limited('service', '1.2.3.4') is None
+
+    def test_max_cost(self):
+        assert self.limiter.max_cost('eval') == 2
+        assert self.limiter.max_cost('complete') == 2
+        assert self.limiter.max_cost('service') is None
+
+    def test_shared(self):
+        other = ratelimit.RateLimiter(self.limits, self.path, slots=64)
+        self.limiter.check('eval', '1.2.3.4')
+        other.check('eval', '1.2.3.4')
+        assert self.limited('eval', '1.2.3.4') is not None
+
+class TestTokenBuckets:
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.buckets = ratelimit.TokenBuckets(os.path.join(self.dir, 'buckets'), slots=4, probes=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_full_table(self):
+        # more keys than slots: the least recently used buckets are reused
+        for i in range(20):
+            assert self.buckets.take([('key%d' % i, 1, 1)]) == (0, None)
+        wait, short = self.buckets.take([('key19', 1, 1)])
+        assert wait > 0 and short == 0
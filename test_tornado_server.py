@@ -0,0 +1,179 @@
+"""
+Nose tests for the Tornado front end
+"""
+
+import json
+import threading
+import time
+from urllib import urlencode
+from tornado import gen, ioloop, testing, websocket
+import test_web_server
+from test_web_server import output, session_end
+import tornado_server
+import web_server
+
+class TornadoTest(testing.AsyncHTTPTestCase):
+    """
+    Runs the Tornado front end on a database and filestore in a
+    temporary directory (see :class:`test_web_server.ServerTest`).
+    """
+    def setUp(self):
+        self.backend = test_web_server.ServerTest()
+        self.backend.setUp()
+        self.db, self.fs = self.backend.db, self.backend.fs
+        # the front end has its own references to these
+        self.saved = tornado_server.rate_limiter, tornado_server.admission
+        tornado_server.rate_limiter = web_server.rate_limiter
+        tornado_server.admission = web_server.admission
+        testing.AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        testing.AsyncHTTPTestCase.tearDown(self)
+        tornado_server.rate_limiter, tornado_server.admission = self.saved
+        self.backend.tearDown()
+
+    def get_new_ioloop(self):
+        # the thread pool and the waiters use the global event loop
+        return ioloop.IOLoop.instance()
+
+    def get_app(self):
+        return tornado_server.make_app(threads=2)
+
+class TestLongPoll(TornadoTest):
+    def setUp(self):
+        TornadoTest.setUp(self)
+        self.recheck = tornado_server.LONG_POLL_RECHECK
+        # only a notification can end the wait in time
+        tornado_server.LONG_POLL_RECHECK = 30
+
+    def tearDown(self):
+        tornado_server.LONG_POLL_RECHECK = self.recheck
+        TornadoTest.tearDown(self)
+
+    def test_loop_waiter(self):
+        waiter = tornado_server.LoopWaiter(self.io_loop)
+        waiter.wait(30, self.stop)
+        threading.Thread(target=waiter.set).start()
+        self.wait()
+        # a notification before the wait isn't lost
+        waiter.set()
+        self.io_loop.add_callback(lambda: waiter.wait(30, self.stop))
+        self.wait()
+        waiter.clear()
+        waiter.wait(0.05, self.stop)
+        self.wait()
+
+    def test_output(self):
+        self.db.add_messages([output('s', 0), output('s', 1)])
+        rv = json.loads(self.fetch('/output_long_poll?computation_id=s&sequence=1').body)
+        assert [m['sequence'] for m in rv['content']] == [1]
+        assert rv['next_sequence'] == 2
+
+    def test_wakeup(self):
+        thread = self.backend.add_later([output('s', 0)])
+        start = time.time()
+        rv = json.loads(self.fetch('/output_long_poll?computation_id=s&timeout=20').body)
+        thread.join()
+        assert [m['sequence'] for m in rv['content']] == [0]
+        assert time.time()-start < 3
+
+    def test_timeout(self):
+        start = time.time()
+        rv = self.fetch('/output_long_poll?computation_id=s&timeout=0.2')
+        assert json.loads(rv.body) == {}
+        assert time.time()-start >= 0.2
+
+class TestService(TornadoTest):
+    def setUp(self):
+        TornadoTest.setUp(self)
+        self.device = test_web_server.Device(self.db)
+        self.device.start()
+
+    def tearDown(self):
+        self.device.stopped = True
+        self.device.join()
+        TornadoTest.tearDown(self)
+
+    def test_service(self):
+        rv = self.fetch('/service', method='POST', body=urlencode({'code': 'hello'}))
+        assert json.loads(rv.body) == {'output': 'hello', 'success': True}
+        rv = self.fetch('/service?code=error')
+        assert json.loads(rv.body) == {'output': 'error', 'success': False}
+
+    def test_batch(self):
+        rv = self.fetch('/service/batch', method='POST',
+                        body=json.dumps(['sleep:0.3', {'code': 'b', 'timeout': 10}]))
+        assert json.loads(rv.body) == [{'output': 'sleep:0.3', 'success': True},
+                                       {'output': 'b', 'success': True}]
+        rv = self.fetch('/service/batch', method='POST', body='{"code": "a"}')
+        assert rv.code == 400
+
+class TestFiles(TornadoTest):
+    def setUp(self):
+        TornadoTest.setUp(self)
+        with self.fs.new_file(session='s', filename='a.txt') as f:
+            f.write('abcdefghij')
+        self.etag = self.fetch('/files/s/a.txt').headers['ETag']
+
+    def test_file(self):
+        rv = self.fetch('/files/s/a.txt')
+        assert rv.code == 200
+        assert rv.body == 'abcdefghij'
+        assert rv.headers['Accept-Ranges'] == 'bytes'
+        assert self.fetch('/files/s/b.txt').code == 404
+
+    def test_range(self):
+        rv = self.fetch('/files/s/a.txt', headers={'Range': 'bytes=2-4'})
+        assert rv.code == 206
+        assert rv.body == 'cde'
+        assert rv.headers['Content-Range'] == 'bytes 2-4/10'
+        rv = self.fetch('/files/s/a.txt', headers={'Range': 'bytes=-3', 'If-Range': self.etag})
+        assert rv.code == 206
+        assert rv.body == 'hij'
+        rv = self.fetch('/files/s/a.txt', headers={'Range': 'bytes=2-4', 'If-Range': '"old"'})
+        assert rv.code == 200
+        assert rv.body == 'abcdefghij'
+        rv = self.fetch('/files/s/a.txt', headers={'Range': 'bytes=20-'})
+        assert rv.code == 416
+        assert rv.headers['Content-Range'] == 'bytes */10'
+
+    def test_not_modified(self):
+        rv = self.fetch('/files/s/a.txt', headers={'If-None-Match': self.etag})
+        assert rv.code == 304
+
+class TestOutputWebSocket(TornadoTest):
+    def connect(self, session):
+        url = self.get_url('/output_ws?computation_id=%s' % session).replace('http:', 'ws:', 1)
+        return websocket.websocket_connect(url)
+
+    @testing.gen_test
+    def test_output(self):
+        self.db.add_messages([output('s', 0)])
+        conn = yield self.connect('s')
+        m = yield conn.read_message()
+        assert json.loads(m)['sequence'] == 0
+        # new output is sent as it arrives, and the socket is closed
+        # after the end of the session
+        self.backend.add_later([output('s', 1), session_end('s', 2)], delay=0.1)
+        m = yield conn.read_message()
+        assert json.loads(m)['sequence'] == 1
+        m = yield conn.read_message()
+        assert json.loads(m)['content']['msg_type'] == 'session_end'
+        m = yield conn.read_message()
+        assert m is None
+
+    @testing.gen_test
+    def test_message(self):
+        conn = yield self.connect('s')
+        conn.write_message(json.dumps({'header': {'session': 'other'}, 'content': {}}))
+        conn.write_message(json.dumps({'header': {'session': 's', 'msg_id': 'm'},
+                                       'msg_type': 'execute_request', 'content': {}}))
+        received = []
+        for i in range(50):
+            received.extend(self.db.get_input_messages('device'))
+            if received:
+                break
+            yield gen.sleep(0.05)
+        # the message for another session is dropped
+        assert [m['header']['msg_id'] for m in received] == ['m']
+        conn.close()
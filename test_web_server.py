@@ -2,6 +2,17 @@
 Nose tests for the web server
 """
 
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+import misc
+import ratelimit
+import db_sqlalchemy
+import filestore
 import web_server
 
 def skipped(func):
@@ -31,3 +42,422 @@ class TestWebReplies:
         rv = self.app.get('/config')
         assert 'webserver=' in rv.data
 
+
+def output(session, sequence, msg_type='stream', content=None):
+    if content is None:
+        content = {'name': 'stdout', 'data': '%d\n' % sequence}
+    return {'header': {'msg_id': '%s-%d' % (session, sequence)},
+            'parent_header': {'session': session},
+            'msg_type': msg_type,
+            'content': content,
+            'sequence': sequence}
+
+def session_end(session, sequence):
+    return output(session, sequence, 'extension', {'msg_type': 'session_end'})
+
+class ServerTest(object):
+    """
+    Runs the web server on a database and filestore in a temporary
+    directory, without rate limits or admission control.
+    """
+    def setUp(self):
+        web_server.app.config['TESTING'] = True
+        self.app = web_server.app.test_client()
+        self.directory = tempfile.mkdtemp()
+        self.db = db_sqlalchemy.DB('sqlite:///' + os.path.join(self.directory, 'test.db'))
+        self.fs = filestore.FileStoreFilesystem(os.path.join(self.directory, 'files'))
+        self.saved = dict((name, getattr(web_server, name)) for name in
+                          ('db_pool', 'fs_pool', 'rate_limiter', 'admission'))
+        web_server.db_pool = misc.ContextPool(self.db)
+        web_server.fs_pool = misc.ContextPool(self.fs)
+        web_server.rate_limiter = ratelimit.RateLimiter({})
+        web_server.admission = misc.AdmissionControl(max_wait=None)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(web_server, name, value)
+        self.db.reset_context()
+        shutil.rmtree(self.directory)
+
+    def add_later(self, messages, delay=0.2):
+        """
+        Add output messages from another thread, after ``delay`` seconds.
+        """
+        def add():
+            time.sleep(delay)
+            db = self.db.new_context_copy()
+            db.add_messages(messages)
+            db.reset_context()
+        thread = threading.Thread(target=add)
+        thread.start()
+        return thread
+
+def events(data):
+    """
+    Split a Server-Sent Events stream into ``(id, message)`` pairs.
+    """
+    result = []
+    for block in data.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n')
+                      if line and not line.startswith(':'))
+        if 'data' in fields:
+            result.append((int(fields['id']), json.loads(fields['data'])))
+    return result
+
+class TestOutputStream(ServerTest):
+    def setUp(self):
+        ServerTest.setUp(self)
+        self.timeout = web_server.STREAM_TIMEOUT
+        web_server.STREAM_TIMEOUT = 5
+
+    def tearDown(self):
+        web_server.STREAM_TIMEOUT = self.timeout
+        ServerTest.tearDown(self)
+
+    def test_stream(self):
+        self.db.add_messages([output('s', 0), output('s', 1), session_end('s', 2)])
+        rv = self.app.get('/output_stream?computation_id=s')
+        assert rv.mimetype == 'text/event-stream'
+        assert rv.headers['Cache-Control'] == 'no-cache'
+        assert rv.data.startswith('retry: %d\n\n' % (web_server.STREAM_MIN_INTERVAL*1000))
+        result = events(rv.data)
+        assert [seq for seq, m in result] == [0, 1, 2]
+        assert [m['sequence'] for seq, m in result] == [0, 1, 2]
+        assert result[0][1]['content']['data'] == '0\n'
+
+    def test_resume(self):
+        self.db.add_messages([output('s', 0), output('s', 1), session_end('s', 2)])
+        rv = self.app.get('/output_stream?computation_id=s', headers={'Last-Event-ID': '0'})
+        assert [seq for seq, m in events(rv.data)] == [1, 2]
+        # without the header, the sequence parameter says where to start
+        rv = self.app.get('/output_stream?computation_id=s&sequence=2')
+        assert [seq for seq, m in events(rv.data)] == [2]
+
+    def test_wakeup(self):
+        self.db.add_messages([output('s', 0)])
+        thread = self.add_later([output('s', 1), session_end('s', 2)])
+        start = time.time()
+        rv = self.app.get('/output_stream?computation_id=s')
+        thread.join()
+        assert [seq for seq, m in events(rv.data)] == [0, 1, 2]
+        assert time.time()-start < web_server.STREAM_TIMEOUT
+
+    def test_timeout(self):
+        web_server.STREAM_TIMEOUT = 0.2
+        self.db.add_messages([output('s', 0)])
+        rv = self.app.get('/output_stream?computation_id=s')
+        # the stream ends without the end of the session; the client
+        # reconnects with the last ID it received
+        assert [seq for seq, m in events(rv.data)] == [0]
+
+class TestLongPoll(ServerTest):
+    def poll(self, query):
+        return json.loads(self.app.get('/output_long_poll?computation_id=s&' + query).data)
+
+    def test_output(self):
+        self.db.add_messages([output('s', 0), output('s', 1)])
+        rv = self.poll('sequence=1')
+        assert [m['sequence'] for m in rv['content']] == [1]
+        assert rv['next_sequence'] == 2
+        assert rv['more'] is False
+
+    def test_timeout(self):
+        start = time.time()
+        rv = self.poll('timeout=0.2')
+        assert rv == {}
+        assert time.time()-start >= 0.2
+
+    def test_wakeup(self):
+        thread = self.add_later([output('s', 0)])
+        start = time.time()
+        rv = self.poll('timeout=10')
+        thread.join()
+        assert [m['sequence'] for m in rv['content']] == [0]
+        assert time.time()-start < 5
+
+    def test_more(self):
+        self.db.add_messages([output('s', i) for i in range(5)])
+        rv = self.poll('limit=2')
+        assert [m['sequence'] for m in rv['content']] == [0, 1]
+        assert rv['next_sequence'] == 2
+        assert rv['more'] is True
+        rv = self.poll('sequence=%d&limit=2' % rv['next_sequence'])
+        assert [m['sequence'] for m in rv['content']] == [2, 3]
+        rv = self.poll('sequence=%d&limit=2' % rv['next_sequence'])
+        assert [m['sequence'] for m in rv['content']] == [4]
+        assert rv['more'] is False
+
+    def test_max_bytes(self):
+        self.db.add_messages([output('s', i) for i in range(3)])
+        # the first message is returned even if it is too big
+        rv = self.poll('max_bytes=1')
+        assert [m['sequence'] for m in rv['content']] == [0]
+        assert rv['more'] is True
+
+    def test_callback(self):
+        self.db.add_messages([output('s', 0)])
+        rv = self.app.get('/output_long_poll?computation_id=s&callback=f')
+        assert rv.mimetype == 'application/javascript'
+        assert rv.data.startswith('f(')
+        assert json.loads(json.loads(rv.data[2:-1]))['next_sequence'] == 1
+
+class Device(threading.Thread):
+    """
+    Answers the execution requests in the database: the output of a
+    snippet is its code, and the snippet ``error`` fails.  A snippet
+    ``sleep:N`` takes N seconds.
+    """
+    def __init__(self, db):
+        threading.Thread.__init__(self)
+        self.db = db.new_context_copy()
+        self.daemon = True
+        self.stopped = False
+        self.runs = []
+        self.answers = []
+
+    def run(self):
+        while not self.stopped:
+            for m in self.db.get_input_messages('device'):
+                self.answers.append(threading.Thread(target=self.answer, args=(m,)))
+                self.answers[-1].start()
+            time.sleep(0.01)
+        for thread in self.answers:
+            thread.join()
+        self.db.reset_context()
+
+    def answer(self, m):
+        session, code = m['header']['session'], m['content']['code']
+        self.runs.append(code)
+        if code.startswith('sleep:'):
+            time.sleep(float(code[len('sleep:'):]))
+        status = 'error' if code == 'error' else 'ok'
+        db = self.db.new_context_copy()
+        db.add_messages([output(session, 0, content={'name': 'stdout', 'data': code}),
+                         output(session, 1, 'execute_reply', {'status': status})])
+        db.reset_context()
+
+class TestService(ServerTest):
+    def setUp(self):
+        ServerTest.setUp(self)
+        self.device = Device(self.db)
+        self.device.start()
+
+    def tearDown(self):
+        self.device.stopped = True
+        self.device.join()
+        ServerTest.tearDown(self)
+
+    def test_service(self):
+        rv = json.loads(self.app.post('/service', data={'code': 'hello'}).data)
+        assert rv == {'output': 'hello', 'success': True}
+        rv = json.loads(self.app.get('/service?code=error').data)
+        assert rv == {'output': 'error', 'success': False}
+
+    def test_cache(self):
+        code = 'cached %s' % time.time()
+        for i in range(2):
+            rv = json.loads(self.app.post('/service', data={'code': code, 'cache': '1'}).data)
+            assert rv == {'output': code, 'success': True}
+        assert self.device.runs == [code]
+        # without the flag, the code runs again
+        self.app.post('/service', data={'code': code})
+        assert self.device.runs == [code, code]
+
+    def test_batch(self):
+        snippets = ['sleep:0.3', {'code': 'b', 'timeout': 10}, 'error']
+        start = time.time()
+        rv = self.app.post('/service/batch', data=json.dumps(snippets),
+                           content_type='application/json')
+        # the results are in the order of the snippets, not the order
+        # they finished in
+        assert json.loads(rv.data) == [{'output': 'sleep:0.3', 'success': True},
+                                       {'output': 'b', 'success': True},
+                                       {'output': 'error', 'success': False}]
+        assert sorted(self.device.runs) == ['b', 'error', 'sleep:0.3']
+        # the snippets run at the same time
+        assert time.time()-start < 0.9
+        rv = self.app.post('/service/batch', data={'snippets': json.dumps(['a'])})
+        assert json.loads(rv.data) == [{'output': 'a', 'success': True}]
+
+    def test_batch_timeout(self):
+        rv = self.app.post('/service/batch', data=json.dumps([{'code': 'sleep:1', 'timeout': 0.1}, 'a']))
+        assert json.loads(rv.data) == [{'output': '', 'success': False},
+                                       {'output': 'a', 'success': True}]
+
+    def test_batch_bad(self):
+        for data in ('{"code": "a"}', '[1]', '[{"code": "a", "timeout": "1"}]',
+                     json.dumps(['a']*(web_server.SERVICE_BATCH_MAX+1)), 'not JSON'):
+            assert self.app.post('/service/batch', data=data).status_code == 400
+        assert self.device.runs == []
+
+class TestServiceHelpers:
+    def test_batch_jobs(self):
+        jobs = web_server._batch_jobs(json.dumps(['a', {'code': 'b', 'timeout': 1},
+                                                 {'code': 'c', 'timeout': 1e6}, {'code': 'd', 'timeout': -1}]))
+        assert jobs == [('a', web_server.SERVICE_TIMEOUT), ('b', 1),
+                        ('c', web_server.SERVICE_TIMEOUT), ('d', 0)]
+
+    def test_batch_rate_limit(self):
+        # a batch can't be bigger than the client's service budget
+        saved = web_server.rate_limiter
+        web_server.rate_limiter = ratelimit.RateLimiter({'service': {'ip': (1, 3)}})
+        try:
+            assert len(web_server._batch_jobs(json.dumps(['a']*3))) == 3
+            try:
+                web_server._batch_jobs(json.dumps(['a']*4))
+            except ValueError:
+                pass
+            else:
+                assert False
+        finally:
+            web_server.rate_limiter = saved
+
+    def test_service_output(self):
+        service = web_server.ServiceOutput()
+        service.add([{'sequence': 0, 'msg_type': 'stream', 'content': {'name': 'stdout', 'data': 'a'}},
+                     {'sequence': 1, 'msg_type': 'stream', 'content': {'name': 'stderr', 'data': 'b'}},
+                     {'sequence': 2, 'msg_type': 'pyout', 'content': {'data': {'text/plain': 'c'}}}])
+        assert service.sequence == 3
+        assert not service.done
+        service.add([{'sequence': 3, 'msg_type': 'execute_reply', 'content': {'status': 'ok'}}])
+        assert service.result() == ('ac', True, True)
+
+    def test_service_output_uncacheable(self):
+        service = web_server.ServiceOutput()
+        service.add([{'sequence': 0, 'msg_type': 'extension', 'content': {'msg_type': 'files'}},
+                     {'sequence': 1, 'msg_type': 'extension', 'content': {'msg_type': 'session_end'}}])
+        assert service.result() == ('', False, False)
+
+class TestFiles(ServerTest):
+    def setUp(self):
+        ServerTest.setUp(self)
+        with self.fs.new_file(session='s', filename='a.txt') as f:
+            f.write('abcdefghij')
+        self.etag = self.app.get('/files/s/a.txt').headers['ETag']
+
+    def test_file(self):
+        rv = self.app.get('/files/s/a.txt')
+        assert rv.status_code == 200
+        assert rv.data == 'abcdefghij'
+        assert rv.mimetype == 'text/plain'
+        assert rv.headers['Content-Length'] == '10'
+        assert rv.headers['Accept-Ranges'] == 'bytes'
+        assert rv.headers['Cache-Control'] == 'no-cache'
+        rv = self.app.get('/files/s/a.txt?v=1')
+        assert rv.headers['Cache-Control'] == 'public, max-age=%d' % web_server.FILE_MAX_AGE
+        assert self.app.get('/files/s/b.txt').status_code == 404
+
+    def test_range(self):
+        for header, data, content_range in (('bytes=2-4', 'cde', 'bytes 2-4/10'),
+                                            ('bytes=7-', 'hij', 'bytes 7-9/10'),
+                                            ('bytes=-3', 'hij', 'bytes 7-9/10'),
+                                            ('bytes=8-20', 'ij', 'bytes 8-9/10')):
+            rv = self.app.get('/files/s/a.txt', headers={'Range': header})
+            assert rv.status_code == 206
+            assert rv.data == data
+            assert rv.headers['Content-Range'] == content_range
+            assert rv.headers['Content-Length'] == str(len(data))
+
+    def test_bad_range(self):
+        rv = self.app.get('/files/s/a.txt', headers={'Range': 'bytes=20-'})
+        assert rv.status_code == 416
+        assert rv.headers['Content-Range'] == 'bytes */10'
+        # anything but a single byte range gets the whole file
+        for header in ('bytes=0-1,3-4', 'lines=1-2', 'bytes=a-b'):
+            rv = self.app.get('/files/s/a.txt', headers={'Range': header})
+            assert rv.status_code == 200
+            assert rv.data == 'abcdefghij'
+
+    def test_if_range(self):
+        rv = self.app.get('/files/s/a.txt', headers={'Range': 'bytes=2-4', 'If-Range': self.etag})
+        assert rv.status_code == 206
+        assert rv.data == 'cde'
+        # the file changed since the client got the first part
+        rv = self.app.get('/files/s/a.txt', headers={'Range': 'bytes=2-4', 'If-Range': '"old"'})
+        assert rv.status_code == 200
+        assert rv.data == 'abcdefghij'
+
+    def test_not_modified(self):
+        rv = self.app.get('/files/s/a.txt', headers={'If-None-Match': '"old", ' + self.etag})
+        assert rv.status_code == 304
+        assert rv.data == ''
+        assert rv.headers['ETag'] == self.etag
+        with self.fs.new_file(session='s', filename='a.txt') as f:
+            f.write('new')
+        rv = self.app.get('/files/s/a.txt', headers={'If-None-Match': self.etag})
+        assert rv.status_code == 200
+        assert rv.data == 'new'
+
+    def test_sendfile(self):
+        saved = web_server.FILE_SENDFILE
+        web_server.FILE_SENDFILE = {'header': 'X-Accel-Redirect', 'prefix': '/files/'}
+        try:
+            rv = self.app.get('/files/s/a.txt')
+            assert rv.headers['X-Accel-Redirect'] == '/files/s/a.txt'
+            assert rv.data == ''
+            assert self.app.get('/files/s/b.txt').status_code == 404
+        finally:
+            web_server.FILE_SENDFILE = saved
+
+class TestParseRange:
+    def test_parse_range(self):
+        assert web_server._parse_range('bytes=0-0', 10) == (0, 0)
+        assert web_server._parse_range('bytes=5-', 10) == (5, 9)
+        assert web_server._parse_range('bytes=-20', 10) == (0, 9)
+        assert web_server._parse_range('bytes=5-100', 10) == (5, 9)
+        assert web_server._parse_range('bytes=10-', 10) is False
+        assert web_server._parse_range('bytes=5-4', 10) is False
+        assert web_server._parse_range(None, 10) is None
+        assert web_server._parse_range('bytes=0-1,5-6', 10) is None
+        assert web_server._parse_range('bytes=x-', 10) is None
+
+class TestUploads(ServerTest):
+    def setUp(self):
+        ServerTest.setUp(self)
+        self.saved_limits = web_server.MAX_FILES, web_server.MAX_UPLOAD_BYTES
+
+    def tearDown(self):
+        web_server.MAX_FILES, web_server.MAX_UPLOAD_BYTES = self.saved_limits
+        ServerTest.tearDown(self)
+
+    def evaluate(self, files):
+        return self.app.post('/eval', data={'commands': json.dumps('print 1'),
+                                            'file': [(StringIO(data), name) for name, data in files]})
+
+    def stored(self):
+        return sorted(f for d, dirs, files in os.walk(os.path.join(self.directory, 'files'))
+                      for f in files)
+
+    def test_upload(self):
+        rv = self.evaluate([('a.txt', 'a'*100000), ('../b.txt', 'b')])
+        session = json.loads(rv.data)['session_id']
+        assert self.fs.get_file(session=session, filename='a.txt').read() == 'a'*100000
+        assert self.fs.get_file(session=session, filename='b.txt').read() == 'b'
+        message = self.db.get_input_messages('device')[0]
+        assert message['header']['session'] == session
+        assert message['content']['files'] == ['a.txt', 'b.txt']
+
+    def test_too_big(self):
+        web_server.MAX_UPLOAD_BYTES = 1000
+        rv = self.evaluate([('a.txt', 'a'*600), ('b.txt', 'b'*600)])
+        assert rv.status_code == 413
+        # the file written before the limit was crossed is removed
+        assert self.stored() == []
+        assert self.db.get_input_messages('device') == []
+
+    def test_too_many(self):
+        web_server.MAX_FILES = 1
+        rv = self.evaluate([('a.txt', 'a'), ('b.txt', 'b')])
+        assert rv.status_code == 200
+        assert self.stored() == []
+        message = self.db.get_input_messages('device')[0]
+        assert message['content']['files'] == []
+        assert 'Too many files' in message['content']['code']
+
+    def test_rejected(self):
+        # a request that is turned away writes nothing
+        web_server.admission = misc.AdmissionControl(max_wait=-1)
+        rv = self.evaluate([('a.txt', 'a')])
+        assert rv.status_code == 503
+        assert self.stored() == []
+        assert self.db.get_input_messages('device') == []
@@ -0,0 +1,802 @@
+"""
+Tornado Front End
+-----------------
+
+An asynchronous web server that implements the same API as the Flask
+server (:mod:`web_server`) on a single Tornado event loop.  A request
+waiting for output (a long poll, an output stream, a ``/service`` call)
+costs a few objects on the loop rather than a process or a thread, so
+one process can hold thousands of sessions open.  Start it with::
+
+    python tornado_server.py --port 8888
+
+or set ``webserver='tornado'`` in ``sagecell_config`` and use
+``start_web.py``.
+
+The databases and filestores are synchronous, so every call into them
+runs in a small pool of worker threads (see :class:`ThreadPool`), each
+using a context from the same pools as the Flask server.  Waiting for
+output never holds a thread: handlers register with the notifier (see
+:mod:`notify`) and are woken on the event loop.
+
+These URLs are handled natively: ``/eval``, ``/output_poll``,
+``/output_long_poll``, ``/output_stream``, ``/service``,
+``/service/batch``, ``/files/<session>/<filename>`` and ``/complete``.
+Output can also be received over a WebSocket at ``/output_ws`` (see
+:class:`OutputWebSocket`).  Everything else (the root page, static
+files, the embedding script and ``/metrics``) is passed to the Flask
+application, which serves those from memory.
+"""
+
+import sys
+import json
+import mimetypes
+import threading
+import Queue
+from functools import partial
+from hashlib import sha1
+from time import time
+from urllib import urlencode, quote
+from uuid import uuid4
+
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+import tornado.wsgi
+import tornado.httpserver
+from tornado import gen, stack_context
+from werkzeug import secure_filename
+
+import misc
+import ratelimit
+import util
+import web_server
+from web_server import (app, init_db, admission, rate_limiter, logger, ServiceOutput,
+                        MAX_FILES, MAX_UPLOAD_BYTES, OUTPUT_POLL_LIMIT, SERVICE_TIMEOUT,
+                        LONG_POLL_TIMEOUT, LONG_POLL_MAX_TIMEOUT, LONG_POLL_RECHECK,
+                        STREAM_TIMEOUT, STREAM_MIN_INTERVAL, STREAM_MAX_INTERVAL, STREAM_KEEPALIVE,
+                        FILE_CHUNK_SIZE, FILE_MAX_AGE, FILE_SENDFILE)
+from notify import notifier, is_session_end
+
+try:
+    import sagecell_config
+except ImportError:
+    import sagecell_config_default as sagecell_config
+
+TORNADO_CONFIG = getattr(sagecell_config, 'tornado_config', {})
+
+class ThreadPool(object):
+    """
+    Worker threads for the blocking database and filestore calls.
+
+    :arg int threads: the number of threads; there is no point in
+        having more than the size of the context pools (``db_pool`` in
+        ``flask_config``)
+    :arg io_loop: the event loop to return results to
+    """
+    def __init__(self, threads=20, io_loop=None):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._jobs = Queue.Queue()
+        for i in range(threads):
+            t = threading.Thread(target=self._work, name='tornado worker %d'%i)
+            t.daemon = True
+            t.start()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call ``func(db, fs, *args)`` in a worker thread, with database
+        and filestore contexts that are checked out of the context
+        pools for the call.
+
+        :arg callback: (keyword argument) called on the event loop with
+            a tuple of the result and ``None``, or ``None`` and the
+            ``sys.exc_info()`` of the exception ``func`` raised
+        :arg tuple contexts: (keyword argument) the contexts to pass to
+            ``func`` instead of checking out new ones (see
+            :func:`checkout`); pass ``()`` to call ``func(*args)``
+        """
+        self._jobs.put((func, args, kwargs.get('contexts'), kwargs['callback']))
+
+    def _work(self):
+        while True:
+            func, args, contexts, callback = self._jobs.get()
+            try:
+                if contexts is not None:
+                    result = (func(*(contexts+args)), None)
+                else:
+                    db_pool, fs_pool = init_db()
+                    with db_pool.context() as db:
+                        with fs_pool.context() as fs:
+                            result = (func(db, fs, *args), None)
+            except Exception:
+                result = (None, sys.exc_info())
+            self.io_loop.add_callback(partial(callback, result))
+
+def checkout():
+    """
+    Check a database and a filestore context out of the context pools,
+    for a handler that uses them over several calls.  Run this in the
+    thread pool, since it may wait for a free context.
+    """
+    db_pool, fs_pool = init_db()
+    db = db_pool.checkout()
+    try:
+        return db, fs_pool.checkout()
+    except:
+        db_pool.checkin(db)
+        raise
+
+def checkin(db, fs):
+    """
+    Return the contexts from :func:`checkout`.
+    """
+    db_pool, fs_pool = init_db()
+    db_pool.checkin(db)
+    fs_pool.checkin(fs)
+
+pool = None
+
+def blocking(func, *args, **kwargs):
+    """
+    Call ``func(db, fs, *args)`` in the thread pool (see
+    :meth:`ThreadPool.run`), and call ``callback`` (a keyword argument)
+    with its result on the event loop, so that this can be used with
+    :class:`tornado.gen.Task`::
+
+        messages = yield gen.Task(blocking, _messages, session, sequence)
+
+    An exception raised by ``func`` is raised again on the event loop,
+    in the stack context of the caller, so it ends the request with an
+    error (see :meth:`BaseHandler.write_error`).
+    """
+    callback = kwargs.pop('callback')
+    def done(result):
+        value, exc_info = result
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        callback(value)
+    pool.run(func, *args, callback=stack_context.wrap(done), **kwargs)
+
+class LoopWaiter(object):
+    """
+    Waits on the event loop for new output in a session.  Register it
+    with :meth:`notify.Notifier.register`; the notifier may call
+    :meth:`set` from any thread.
+
+    :arg io_loop: the event loop
+    """
+    def __init__(self, io_loop=None):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._set = False
+        self._callback = None
+        self._timeout = None
+
+    def set(self):
+        self.io_loop.add_callback(self._wake)
+
+    def clear(self):
+        """
+        Forget earlier notifications.  Clear the waiter *before*
+        checking the database, so that output committed during the check
+        still counts.
+        """
+        self._set = False
+
+    def wait(self, timeout, callback):
+        """
+        Call ``callback`` (with no arguments) when the waiter is set,
+        or after ``timeout`` seconds.
+        """
+        self._callback = callback
+        if self._set:
+            self._fire()
+        else:
+            self._timeout = self.io_loop.add_timeout(time()+timeout, self._fire)
+
+    def _wake(self):
+        self._set = True
+        self._fire()
+
+    def _fire(self):
+        callback, self._callback = self._callback, None
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if callback is not None:
+            callback()
+
+# The blocking parts of the handlers, which run in the thread pool
+
+def _new_input(db, fs, message):
+    db.new_input_message(message)
+
+def _start_eval(db, fs, message, uploads):
+    admission.admit(db)
+    for filename, body in uploads:
+        f = fs.new_file(session=message['header']['session'], filename=filename)
+        try:
+            f.write(body)
+        finally:
+            f.close()
+    db.new_input_message(message)
+
+def _output(db, fs, session, sequence, limit, max_bytes):
+    return web_server._output_page(db, session, sequence, limit, max_bytes)
+
+def _messages_json(db, fs, session, sequence):
+    return db.get_messages_json(session, sequence=sequence, limit=OUTPUT_POLL_LIMIT)
+
+def _messages(db, fs, session, sequence):
+    return db.get_messages(session, sequence=sequence)
+
+def _permalinks(db, fs):
+    return web_server._service_cache_permalinks(db)
+
+def _start_service(db, fs, jobs):
+    admission.admit(db, len(jobs))
+    for code, session in jobs:
+        db.new_input_message(web_server._service_request(code, session))
+
+def _complete(db, fs, code, pos):
+    return web_server.get_completer(db).complete(code, pos)
+
+def _open_file(db, fs, session, filename):
+    f = fs.get_file(session=session, filename=filename)
+    if f is None:
+        return None
+    return f, web_server._file_size(f), web_server._file_version(f)
+
+def _seek(db, fs, f, offset):
+    f.seek(offset)
+
+def _read(db, fs, f, length):
+    return f.read(length)
+
+def _close(db, fs, f):
+    f.close()
+
+class BaseHandler(tornado.web.RequestHandler):
+    """
+    The common parts of the native handlers: CORS headers, errors,
+    rate limiting, and the same request metrics as the Flask server
+    (labelled with the name of the Flask view, ``endpoint``).
+    """
+    endpoint = 'none'
+
+    closed = False
+    metrics_start = None
+
+    def prepare(self):
+        self.metrics_start = time()
+        web_server.requests_in_flight.labels(self.endpoint).inc()
+
+    def on_finish(self):
+        if self.metrics_start is None:
+            return
+        web_server.requests_in_flight.labels(self.endpoint).dec()
+        web_server.request_latency.labels(self.endpoint).observe(time() - self.metrics_start)
+        web_server.request_count.labels(self.endpoint, str(self.get_status())).inc()
+
+    def on_connection_close(self):
+        # stop waiting for output nobody will read
+        self.closed = True
+
+    def set_default_headers(self):
+        self.set_header("Access-Control-Allow-Origin", "*")
+
+    def values(self):
+        """
+        The request parameters, as a dict of strings.
+        """
+        return dict((k, v[-1]) for k, v in self.request.arguments.iteritems())
+
+    def rate_limit(self, budget, cost=1):
+        """
+        Charge the request to the client's ``budget`` (see
+        :class:`ratelimit.RateLimiter`).
+        """
+        ip, origin = web_server._client(self.request.remote_ip, self.request.headers)
+        rate_limiter.check(budget, ip, origin, cost)
+
+    def write_error(self, status_code, **kwargs):
+        error = kwargs.get('exc_info', (None, None))[1]
+        if isinstance(error, ratelimit.RateLimited):
+            web_server.rate_limited_requests.labels(self.endpoint, error.limit).inc()
+            self.busy(429, "Too many requests; please slow down.", int(error.retry_after) + 1)
+        elif isinstance(error, misc.Overloaded):
+            web_server.admission_rejections.labels(self.endpoint).inc()
+            self.busy(503, "The server is too busy; please try again later.",
+                      int(min(error.wait, admission.max_wait)) + 1)
+        elif isinstance(error, misc.PoolTimeout):
+            self.busy(503, "The server is too busy; please try again.", 1)
+        else:
+            if error is not None and not isinstance(error, tornado.web.HTTPError):
+                web_server.request_errors.labels(self.endpoint, type(error).__name__).inc()
+            tornado.web.RequestHandler.write_error(self, status_code, **kwargs)
+
+    def busy(self, status, text, retry_after):
+        self.clear()
+        self.set_status(status)
+        self.set_header("Content-Type", "text/plain")
+        self.set_header("Retry-After", str(retry_after))
+        self.finish(text)
+
+    def send(self, body, content_type):
+        """
+        Finish the request with ``body``, unless the client has gone.
+        """
+        if not self.closed:
+            self.set_header("Content-Type", content_type)
+            self.finish(body)
+
+    @gen.engine
+    def wait_for_output(self, session, waiter, end_time, check, callback):
+        """
+        Call ``check()`` (in the thread pool) until it returns something
+        true, the request times out or the client goes away, waiting on
+        the event loop between calls for new output in the session, and
+        call ``callback`` with the last result.
+
+        :arg LoopWaiter waiter: a waiter registered on ``session``
+        :arg float end_time: when to give up
+        :arg check: a function to call with ``db`` and ``fs``
+        """
+        while True:
+            waiter.clear()
+            result = yield gen.Task(blocking, check)
+            remaining = end_time-time()
+            if result or remaining <= 0 or self.closed:
+                break
+            yield gen.Task(waiter.wait, min(remaining, LONG_POLL_RECHECK))
+        callback(result)
+
+class EvalHandler(BaseHandler):
+    """
+    ``/eval``: start a computation or send a message (like an interact
+    update) to a running one (see :func:`web_server.evaluate`).  Unlike
+    the Flask server, uploaded files are read into memory before they
+    are written to the filestore.
+    """
+    endpoint = 'evaluate'
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def post(self):
+        if self.get_argument("message", None) is not None:
+            self.rate_limit('message')
+            message = json.loads(self.get_argument("message"))
+            logger.debug('Received Request: %s', message)
+            yield gen.Task(blocking, _new_input, message)
+            rval = json.dumps({"computation_id": message['header']['session']})
+        else:
+            self.rate_limit('eval')
+            uploads = self.request.files.get("file", [])
+            if sum(len(f['body']) for f in uploads) > MAX_UPLOAD_BYTES:
+                raise tornado.web.HTTPError(413)
+            if len(uploads) > MAX_FILES:
+                code = "print('ERROR: Too many files uploaded. Maximum number of uploaded files is %d.')\n"%MAX_FILES
+                files = []
+            else:
+                code = json.loads(self.get_argument("commands"))
+                if not isinstance(code, basestring):
+                    util.log("code was not a string: %r"%(code,))
+                    self.send("{}", "application/json")
+                    return
+                files = [(secure_filename(f['filename']), f['body'])
+                         for f in uploads if secure_filename(f['filename'])]
+            message = web_server._eval_request(code, str(uuid4()), self.get_argument("msg_id", None),
+                                               [name for name, body in files],
+                                               self.get_argument("sage_mode", None) is not None)
+            logger.debug("Received Request: %s", message)
+            yield gen.Task(blocking, _start_eval, message, files)
+            root = "%s://%s/?"%(self.request.protocol, self.request.host)
+            rval = json.dumps({"zipurl": root+urlencode({"z": web_server._zip_code(code)}),
+                               "queryurl": root+urlencode({"q": message["shortened"]}),
+                               "session_id": message['header']['session']})
+        if self.get_argument("frame", None) is not None:
+            self.send("<script>parent.postMessage(" + json.dumps(rval) +
+                      ",\"*\");</script>", "text/html")
+        else:
+            self.send(rval, "application/json")
+
+class OutputPollHandler(BaseHandler):
+    """
+    ``/output_poll``: the output of a session (see
+    :func:`web_server.output_poll`).
+    """
+    endpoint = 'output_poll'
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self):
+        session = self.get_argument('computation_id')
+        sequence = int(self.get_argument('sequence', 0))
+        limit, max_bytes = web_server._page_limits(self.values())
+        page = yield gen.Task(blocking, _output, session, sequence, limit, max_bytes)
+        logger.debug("Retrieved messages: %.2000s", page[0])
+        self.send(*web_server._output_body(self.get_argument('callback', None), *page))
+
+class OutputLongPollHandler(BaseHandler):
+    """
+    ``/output_long_poll``: the output of a session, waiting for it if
+    there is none yet (see :func:`web_server.output_long_poll`).
+    """
+    endpoint = 'output_long_poll'
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self):
+        session = self.get_argument('computation_id')
+        sequence = int(self.get_argument('sequence', 0))
+        timeout = min(float(self.get_argument('timeout', LONG_POLL_TIMEOUT)), LONG_POLL_MAX_TIMEOUT)
+        limit, max_bytes = web_server._page_limits(self.values())
+        def check(db, fs):
+            page = _output(db, fs, session, sequence, limit, max_bytes)
+            return page if page[0] else None
+        waiter = LoopWaiter()
+        notifier.register(session, waiter)
+        try:
+            page = yield gen.Task(self.wait_for_output, session, waiter, time()+timeout, check)
+        finally:
+            notifier.unregister(session, waiter)
+        if not page:
+            page = ([], sequence, False)
+        self.send(*web_server._output_body(self.get_argument('callback', None), *page))
+
+class OutputStreamHandler(BaseHandler):
+    """
+    ``/output_stream``: the output of a session as Server-Sent Events
+    (see :func:`web_server.output_stream`).
+    """
+    endpoint = 'output_stream'
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self):
+        session = self.get_argument('computation_id')
+        if 'Last-Event-ID' in self.request.headers:
+            sequence = int(self.request.headers['Last-Event-ID'])+1
+        else:
+            sequence = int(self.get_argument('sequence', 0))
+        end_time = time()+STREAM_TIMEOUT
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("X-Accel-Buffering", "no")
+        self.write("retry: %d\n\n"%(STREAM_MIN_INTERVAL*1000))
+        self.flush()
+        interval = STREAM_MIN_INTERVAL
+        last_write = time()
+        waiter = LoopWaiter()
+        notifier.register(session, waiter)
+        try:
+            while time() < end_time and not self.closed:
+                waiter.clear()
+                results = yield gen.Task(blocking, _messages_json, session, sequence)
+                ended = False
+                for seq, s in results:
+                    if seq < sequence:
+                        continue
+                    sequence = seq+1
+                    self.write("id: %d\ndata: %s\n\n"%(seq, s))
+                    if '"session_end"' in s and is_session_end(json.loads(s)):
+                        ended = True
+                        break
+                if self.closed or ended:
+                    break
+                if results:
+                    self.flush()
+                    interval = STREAM_MIN_INTERVAL
+                    last_write = time()
+                else:
+                    if time()-last_write > STREAM_KEEPALIVE:
+                        # a comment line keeps proxies from closing the connection
+                        self.write(": keepalive\n\n")
+                        self.flush()
+                        last_write = time()
+                    yield gen.Task(waiter.wait, interval)
+                    interval = min(2*interval, STREAM_MAX_INTERVAL)
+        finally:
+            notifier.unregister(session, waiter)
+        if not self.closed:
+            self.finish()
+
+class ServiceHandler(BaseHandler):
+    """
+    ``/service``: run code and return its output (see
+    :func:`web_server.service`).
+    """
+    endpoint = 'service'
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self):
+        self.rate_limit('service')
+        code = self.get_argument("code", None)
+        if code is None:
+            self.finish("")
+            return
+        logger.debug("Service called with code: %.1000r", code)
+        key = web_server._service_cache_key(code)
+        use_cache = self.get_argument("cache", None) == "1"
+        if not use_cache:
+            use_cache = key in (yield gen.Task(blocking, _permalinks))
+        if use_cache:
+            cached = web_server._service_cache.get(key)
+            if cached is not None:
+                web_server.service_cache_hits.labels().inc()
+                web_server.service_cache_bytes_saved.labels().inc(len(cached[0]))
+                self.send(json.dumps({"output": cached[0], "success": cached[1]}),
+                          "application/json")
+                return
+            web_server.service_cache_misses.labels().inc()
+        session = str(uuid4())
+        waiter = LoopWaiter()
+        notifier.register(session, waiter, completion=True)
+        try:
+            yield gen.Task(blocking, _start_service, [(code, session)])
+            s, success, cacheable = yield gen.Task(self.service_result, session, waiter,
+                                                   time()+SERVICE_TIMEOUT)
+        finally:
+            notifier.unregister(session, waiter)
+        if use_cache and cacheable:
+            web_server._service_cache.set(key, (s, success))
+        logger.debug('Service returning: %r', [s, success])
+        self.send(json.dumps({"output": s, "success": success}), "application/json")
+
+    post = get
+
+    @gen.engine
+    def service_result(self, session, waiter, end_time, callback):
+        """
+        Collect the output of a session started by
+        :func:`_start_service`, and call ``callback`` with the result of
+        :meth:`web_server.ServiceOutput.result`.
+        """
+        output = ServiceOutput()
+        def check(db, fs):
+            output.add(db.get_messages(session, sequence=output.sequence))
+            return output.done
+        yield gen.Task(self.wait_for_output, session, waiter, end_time, check)
+        callback(output.result())
+
+class ServiceBatchHandler(ServiceHandler):
+    """
+    ``/service/batch``: run many snippets at once (see
+    :func:`web_server.service_batch`).  The results are written in the
+    order the snippets were submitted, not the order they finish in.
+    """
+    endpoint = 'service_batch'
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def post(self):
+        try:
+            jobs = web_server._batch_jobs(self.get_argument('snippets', self.request.body))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        logger.debug("Service batch called with %d snippets", len(jobs))
+        self.rate_limit('service', len(jobs))
+        start_time = time()
+        sessions = [(code, str(uuid4()), LoopWaiter(), start_time+timeout)
+                    for code, timeout in jobs]
+        for code, session, waiter, end_time in sessions:
+            notifier.register(session, waiter, completion=True)
+        try:
+            yield gen.Task(blocking, _start_service, [(j[0], j[1]) for j in sessions])
+            self.set_header("Content-Type", "application/json")
+            self.write("[")
+            for i, (code, session, waiter, end_time) in enumerate(sessions):
+                s, success, cacheable = yield gen.Task(self.service_result, session,
+                                                       waiter, end_time)
+                notifier.unregister(session, waiter)
+                if self.closed:
+                    return
+                self.write((", " if i>0 else "") + json.dumps({"output": s, "success": success}))
+                self.flush()
+        finally:
+            for code, session, waiter, end_time in sessions:
+                notifier.unregister(session, waiter)
+        self.finish("]")
+
+    get = tornado.web.RequestHandler.get
+
+class CompleteHandler(BaseHandler):
+    """
+    ``/complete``: tab completion (see :func:`web_server.tabComplete`).
+    """
+    endpoint = 'tabComplete'
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self):
+        self.rate_limit('complete')
+        matches = yield gen.Task(blocking, _complete, self.get_argument("code"),
+                                 int(self.get_argument("pos")))
+        self.send(json.dumps({"completions": matches}), "application/json")
+
+class FilesHandler(BaseHandler):
+    """
+    ``/files/<session>/<filename>``: a file made by a session (see
+    :func:`web_server.session_file`).  The file is read in chunks in
+    the thread pool and each chunk is sent before the next is read.
+    """
+    endpoint = 'session_file'
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def get(self, session, filename):
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if 'v' in self.request.arguments:
+            self.set_header('Cache-Control', 'public, max-age=%d' % FILE_MAX_AGE)
+        else:
+            self.set_header('Cache-Control', 'no-cache')
+        # the file belongs to the filestore context, so keep the same
+        # context until the file is closed
+        contexts = yield gen.Task(blocking, checkout, contexts=())
+        try:
+            if FILE_SENDFILE is not None and hasattr(contexts[1], 'file_path'):
+                paths = contexts[1].file_path(session=session, filename=filename)
+                if paths is None:
+                    raise tornado.web.HTTPError(404)
+                if FILE_SENDFILE['header'] == 'X-Accel-Redirect':
+                    self.set_header('X-Accel-Redirect',
+                                    FILE_SENDFILE.get('prefix', '/') + quote(paths[0]))
+                else:
+                    self.set_header(FILE_SENDFILE['header'], paths[1])
+                self.send('', mimetype)
+                return
+            opened = yield gen.Task(blocking, _open_file, session, filename, contexts=contexts)
+            if opened is None:
+                raise tornado.web.HTTPError(404)
+            f, size, version = opened
+            try:
+                yield gen.Task(self.send_file, contexts, f, size,
+                               '"%s"' % sha1(repr((session, filename, size, version))).hexdigest(),
+                               mimetype)
+            finally:
+                pool.run(_close, f, contexts=contexts, callback=lambda result: None)
+        finally:
+            pool.run(checkin, *contexts, contexts=(), callback=lambda result: None)
+
+    @gen.engine
+    def send_file(self, contexts, f, size, etag, mimetype, callback):
+        self.set_header('ETag', etag)
+        self.set_header('Accept-Ranges', 'bytes')
+        if etag in [t.strip() for t in self.request.headers.get('If-None-Match', '').split(',')]:
+            self.set_status(304)
+            self.finish()
+            callback()
+            return
+        byte_range = web_server._parse_range(self.request.headers.get('Range'), size)
+        if self.request.headers.get('If-Range', etag) != etag:
+            byte_range = None
+        if byte_range is False:
+            self.set_status(416)
+            self.set_header('Content-Range', 'bytes */%d' % size)
+            self.finish()
+            callback()
+            return
+        if byte_range is None:
+            start, length = 0, size
+        else:
+            start, length = byte_range[0], byte_range[1]-byte_range[0]+1
+            self.set_status(206)
+            self.set_header('Content-Range', 'bytes %d-%d/%d' % (byte_range[0], byte_range[1], size))
+        self.set_header('Content-Type', mimetype)
+        self.set_header('Content-Length', str(length))
+        yield gen.Task(blocking, _seek, f, start, contexts=contexts)
+        while length > 0 and not self.closed:
+            data = yield gen.Task(blocking, _read, f, min(FILE_CHUNK_SIZE, length),
+                                  contexts=contexts)
+            if not data:
+                break
+            length -= len(data)
+            self.write(data)
+            # wait for the chunk to be sent before reading the next
+            yield gen.Task(self.flush)
+        if not self.closed:
+            self.finish()
+        callback()
+
+class OutputWebSocket(tornado.websocket.WebSocketHandler):
+    """
+    ``/output_ws?computation_id=<session>&sequence=<n>``: a WebSocket
+    that carries a session's output as it is produced, each message in
+    its own frame (in the same JSON format as :func:`web_server.output_poll`
+    messages).  The server closes the socket after the ``session_end``
+    message.  Messages the client sends on the socket (like interact
+    updates) are handled like the ``message`` parameter of ``/eval``,
+    but only for this session.
+    """
+    def check_origin(self, origin):
+        # cells are embedded in other sites
+        return True
+
+    def open(self):
+        self.session = self.get_argument('computation_id')
+        self.sequence = int(self.get_argument('sequence', 0))
+        self.closed = False
+        self.waiter = LoopWaiter()
+        notifier.register(self.session, self.waiter)
+        self.send_output()
+
+    @gen.engine
+    def send_output(self):
+        while not self.closed:
+            self.waiter.clear()
+            results, exc_info = yield gen.Task(pool.run, _messages_json, self.session, self.sequence)
+            if exc_info is not None:
+                logger.error("Output WebSocket error", exc_info=exc_info)
+                self.close()
+                return
+            for seq, s in results:
+                if seq < self.sequence:
+                    continue
+                self.sequence = seq+1
+                self.write_message(s)
+                if '"session_end"' in s and is_session_end(json.loads(s)):
+                    self.close()
+                    return
+            if not results:
+                yield gen.Task(self.waiter.wait, LONG_POLL_RECHECK)
+
+    def on_message(self, message):
+        try:
+            ip, origin = web_server._client(self.request.remote_ip, self.request.headers)
+            rate_limiter.check('message', ip, origin)
+            message = json.loads(message)
+            if message['header']['session'] != self.session:
+                raise ValueError("message for another session")
+        except (ratelimit.RateLimited, ValueError, KeyError, TypeError) as e:
+            logger.warning("Dropped WebSocket message for %s: %s", self.session, e)
+            return
+        logger.debug('Received Request: %s', message)
+        def done(result):
+            if result[1] is not None:
+                logger.error("Couldn't store a message", exc_info=result[1])
+        pool.run(_new_input, message, callback=done)
+
+    def on_close(self):
+        self.closed = True
+        notifier.unregister(self.session, self.waiter)
+        # end the wait in send_output
+        self.waiter.set()
+
+def make_app(threads=20):
+    """
+    Make the Tornado application.
+
+    :arg int threads: the size of the thread pool (see :class:`ThreadPool`)
+    """
+    global pool
+    pool = ThreadPool(threads)
+    return tornado.web.Application([
+        (r"/eval", EvalHandler),
+        (r"/output_poll", OutputPollHandler),
+        (r"/output_long_poll", OutputLongPollHandler),
+        (r"/output_stream", OutputStreamHandler),
+        (r"/output_ws", OutputWebSocket),
+        (r"/service", ServiceHandler),
+        (r"/service/batch", ServiceBatchHandler),
+        (r"/complete", CompleteHandler),
+        (r"/files/([^/]+)/([^/]+)", FilesHandler),
+        (r".*", tornado.web.FallbackHandler, dict(fallback=tornado.wsgi.WSGIContainer(app))),
+        ], gzip=TORNADO_CONFIG.get('gzip', True))
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="The asynchronous web server component of the notebook")
+    parser.add_argument("--db", choices=["mongo", "sqlalchemy"], help="Database to use")
+    parser.add_argument("-q", action="store_true", dest="quiet", help="Turn off most logging")
+    parser.add_argument("--port", type=int, default=TORNADO_CONFIG.get('port', 8888))
+    parser.add_argument("--host", default=TORNADO_CONFIG.get('host', ''))
+    parser.add_argument("--threads", type=int, default=TORNADO_CONFIG.get('threads', 20))
+    (sysargs, args) = parser.parse_known_args()
+    if sysargs.quiet:
+        util.quiet()
+    web_server.sysargs = sysargs
+    server = tornado.httpserver.HTTPServer(make_app(sysargs.threads), xheaders=True,
+                                           max_buffer_size=MAX_UPLOAD_BYTES + 2**20)
+    server.listen(sysargs.port, sysargs.host)
+    logger.info("Listening on port %d", sysargs.port)
+    tornado.ioloop.IOLoop.instance().start()
@@ -5,6 +5,7 @@ to the database.
 
 import zmq
 import misc
+import notify
 import os
 import signal
 import sys
@@ -18,6 +19,7 @@ from base64 import b64encode
 from zmq.eventloop import ioloop, zmqstream
 import util
 from util import log
+logger=util.get_logger('trusted')
 shutting_down=False
 
 class AuthenticationException(Exception):
@@ -35,13 +37,16 @@ class MessageLoop:
     :arg db.DB db: the database to send the commands to
     :arg list keys: keys with which to generate authentication codes
     :arg bool isFS: True if the database is a filestore; False if not
+    :arg str input_bus: the address the notification bus publishes on,
+         if there is one, to relay new input events to the device from
     """
 
-    def __init__(self, db, key, isFS=False):
+    def __init__(self, db, key, isFS=False, input_bus=None):
         conn,self.pipe=Pipe()
-        self.process=Process(target=loop, args=(db, key, conn, isFS))
+        self.process=Process(target=loop, args=(db, key, conn, isFS, input_bus))
         self.process.start()
         self.port=self.pipe.recv()
+        self.input_port=self.pipe.recv() if input_bus is not None else None
         self._device_info = None
 
     def device_id(self):
@@ -73,21 +78,34 @@ class MessageLoop:
         self._device_info=self.pipe.recv()
         self.pipe.close()
 
-def loop(db, key, pipe, isFS):
+def loop(db, key, pipe, isFS, input_bus=None):
     u"""
     Create a \xd8MQ socket and an event loop listening for new messages.
 
+    The device may not subscribe to the notification bus, which carries
+    every session ID (see :mod:`notify`), so if ``input_bus`` is given,
+    the loop subscribes to its new input events and passes each one on
+    to the device through a socket of its own.  The events carry no
+    information.
+
     :arg db.DB db: the database to which to send the commands received
     :arg str key: a key with which to generate authentication codes
     :arg multiprocessing.Connection pipe: one end of a multiprocessing
          Pipe, for sending information back into the main process
     :arg bool isFS: True if the database is a filestore; False if not
+    :arg str input_bus: the address the notification bus publishes on,
+         or ``None``
     """
     db.new_context()
     context=zmq.Context()
     rep=context.socket(zmq.XREP if isFS else zmq.REP)
     pipe.send(rep.bind_to_random_port('tcp://127.0.0.1'))
     loop=ioloop.IOLoop()
+    if input_bus is not None:
+        relay=context.socket(zmq.PUB)
+        pipe.send(relay.bind_to_random_port('tcp://127.0.0.1'))
+        inputs=zmqstream.ZMQStream(notify.input_subscriber(context, input_bus), loop)
+        inputs.on_recv(lambda msgs: relay.send_multipart([notify.INPUT_TOPIC, ''], zmq.NOBLOCK))
     fs_auth_dict={}
     db_auth_dict={}
     stream=zmqstream.ZMQStream(rep,loop)
@@ -135,7 +153,7 @@ def callback(db, key, pipe, auth_dict, socket, msgs, isFS):
         if msg['msg_type']=='create_secret':
             key[0]=sha1(key[0]).digest()
             auth_dict[auth_session]=hmac.new(key[0],digestmod=sha1)
-            log("Create authkey: session: %r, key: %r"%(auth_session, auth_dict[auth_session].digest()))
+            logger.debug("Create authkey: session: %r", auth_session)
             to_send=True
         elif isFS:
             c=msg['content']
@@ -162,7 +180,7 @@ def callback(db, key, pipe, auth_dict, socket, msgs, isFS):
         elif msg['msg_type'] in db.valid_untrusted_methods:
             to_send=getattr(db,msg['msg_type'])(**msg['content'])
     except AuthenticationException:
-        log("Authentication failed: %s"%msg)
+        logger.warning("Authentication failed: %s", msg)
     finally:
         if send_finally:
             if isFS:
@@ -188,7 +206,8 @@ def authenticate(msg_str, digest, session, auth_dict, hexdigest=False):
     real_digest=auth_dict[session].hexdigest() if hexdigest else auth_dict[session].digest()
     if real_digest!=digest:
         auth_dict[session]=old_hmac
-        log("Authentication problem: msg: %r\nreal_digest: %r\nsentdigest: %r\nold_digest: %r"%(msg_str, real_digest, digest, old_hmac.digest()))
+        logger.warning("Authentication problem: msg: %r\nreal_digest: %r\nsentdigest: %r\nold_digest: %r",
+                       msg_str, real_digest, digest, old_hmac.digest())
         raise AuthenticationException
 
 def signal_handler(signal, frame):
@@ -279,6 +298,12 @@ if __name__=='__main__':
     parser.add_option("--untrusted-mem", dest="untrusted_mem", type=float,
                       default=sagecell_config.device_config.get('untrusted-mem',-1), 
                       help="Memory (MB) allotted to each session")
+    parser.add_option("--prefork", dest="prefork", type=int,
+                      default=sagecell_config.device_config.get('prefork',2),
+                      help="Number of session processes to keep ready")
+    parser.add_option("--lookahead", dest="lookahead", type=int,
+                      default=sagecell_config.device_config.get('lookahead',1),
+                      help="Number of sessions each device claims beyond its free workers")
     parser.add_option("-q", "--quiet", action="store_true", dest="quiet", help="Turn off most logging")
 
     (sysargs,args)=parser.parse_args()
@@ -288,7 +313,7 @@ if __name__=='__main__':
         sys.exit(1)
 
     if sysargs.quiet:
-        util.LOGGING=False
+        util.quiet()
     print "PID: ", os.getpid()
     if sysargs.pidfile:
         if os.path.isfile(sysargs.pidfile):
@@ -297,7 +322,8 @@ if __name__=='__main__':
             f.write("%s\n"%os.getpid())
     db, fs = misc.select_db(sysargs)
     keys=[b64encode(os.urandom(32)) if sysargs.print_cmd else os.urandom(32) for _ in (0,1)]
-    db_loop=MessageLoop(db, keys[0])
+    bus=notify.bus_config()
+    db_loop=MessageLoop(db, keys[0], input_bus=bus['subscribe'] if bus else None)
     fs_loop=MessageLoop(fs, keys[1], isFS=True)
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -317,9 +343,12 @@ if __name__=='__main__':
                  untrusted_python=sysargs.untrusted_python,
                  untrusted_cpu=sysargs.untrusted_cpu,
                  untrusted_mem=sysargs.untrusted_mem,
+                 prefork=sysargs.prefork,
+                 lookahead=sysargs.lookahead,
+                 inputs='--input-address tcp://localhost:%i'%db_loop.input_port if bus else '',
                  keyfile=filename+"_copy")
     cmd="""cd %(cwd)s
-%(untrusted_python)s device_process.py --db zmq --timeout 60 -w %(workers)s --cpu %(untrusted_cpu)f --mem %(untrusted_mem)f --dbaddress tcp://localhost:%(db_port)i --fsaddress=tcp://localhost:%(fs_port)i --keyfile %(keyfile)s %(quiet)s\n"""%options
+%(untrusted_python)s device_process.py --db zmq --timeout 60 -w %(workers)s --cpu %(untrusted_cpu)f --mem %(untrusted_mem)f --prefork %(prefork)i --lookahead %(lookahead)i %(inputs)s --dbaddress tcp://localhost:%(db_port)i --fsaddress=tcp://localhost:%(fs_port)i --keyfile %(keyfile)s %(quiet)s\n"""%options
     if sysargs.print_cmd:
         print
         print "echo %s%s%s > %s_copy"%(keys[0],'KEY_SEPARATOR',keys[1],filename)
@@ -1,4 +1,30 @@
+"""
+Logging
+-------
+
+Each part of the Sage cell server logs to its own logger (see
+:func:`get_logger`): ``web``, ``device``, ``db``, ``fs`` and
+``trusted``.  Loggers have the usual :mod:`logging` levels; the level of
+each can be set with ``LOG_LEVELS`` in ``sagecell_config`` (for
+example, ``LOG_LEVELS={'web': 'DEBUG'}``), and ``LOG_LEVEL`` sets the
+default.  Messages that are logged for every request or output
+message use the ``DEBUG`` level with lazy formatting arguments::
+
+    logger.debug("Retrieved messages: %s", results)
+
+so that they cost almost nothing when debugging is off.
+
+Records are written to ``sys.__stderr__`` by a background thread, so
+logging never waits for the terminal or a log file.  If records come
+in faster than they can be written, the newest ones are dropped and the
+number dropped is logged.
+"""
+
 import sys
+import os
+import logging
+import threading
+from collections import deque
 from time import time
 
 try:
@@ -7,15 +33,157 @@ except ImportError:
     # the untrusted user will probably not have access to the sagecell_config
     # file
     LOGGING=True
+try:
+    from sagecell_config import LOG_LEVEL
+except ImportError:
+    LOG_LEVEL='INFO'
+try:
+    from sagecell_config import LOG_LEVELS
+except ImportError:
+    LOG_LEVELS={}
+
+class AsyncHandler(logging.Handler):
+    """
+    A logging handler that formats records in the calling thread and
+    writes them from a background thread.  A process that forks gets
+    its own writer thread the first time it logs.
+
+    The ``dropped`` attribute counts the records dropped because too
+    many were waiting to be written.
+
+    :arg stream: the file to write to (``sys.__stderr__`` by default)
+    :arg int maxsize: the maximum number of records waiting to be
+        written
+    """
+    def __init__(self, stream=None, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.stream=stream if stream is not None else sys.__stderr__
+        self.maxsize=maxsize
+        self.dropped=0
+        self._pid=None
+
+    def _start(self):
+        self._pid=os.getpid()
+        self._cond=threading.Condition(threading.Lock())
+        self._records=deque()
+        # records queued or being written
+        self._unwritten=0
+        self._reported=self.dropped
+        writer=threading.Thread(target=self._write, name='log writer')
+        writer.daemon=True
+        writer.start()
+        # multiprocessing children leave with os._exit, skipping the
+        # atexit hook that flushes log handlers
+        from multiprocessing.util import Finalize
+        Finalize(self, self.flush, exitpriority=0)
+
+    def emit(self, record):
+        """
+        Format a record and queue it to be written.
+        """
+        if self._pid!=os.getpid():
+            # the first record, or the first since a fork (the writer
+            # thread doesn't survive a fork)
+            self._start()
+        try:
+            line=self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self._cond:
+            if len(self._records)>=self.maxsize:
+                self.dropped+=1
+                return
+            self._records.append(line)
+            self._unwritten+=1
+            self._cond.notify()
+
+    def _write(self):
+        while True:
+            with self._cond:
+                while not self._records:
+                    self._cond.wait()
+                lines=list(self._records)
+                self._records.clear()
+                dropped=self.dropped
+            written=len(lines)
+            if dropped>self._reported:
+                lines.append("%s:\tlog\t: %d log records dropped"%(time(), dropped-self._reported))
+                self._reported=dropped
+            try:
+                self.stream.write('\n'.join(lines)+'\n')
+                self.stream.flush()
+            except Exception:
+                pass
+            with self._cond:
+                self._unwritten-=written
+                self._cond.notify_all()
+
+    def flush(self, timeout=1):
+        """
+        Wait (up to ``timeout`` seconds) for the queued records to be
+        written.
+        """
+        if self._pid!=os.getpid():
+            return
+        end_time=time()+timeout
+        with self._cond:
+            while self._unwritten>0:
+                remaining=end_time-time()
+                if remaining<=0:
+                    break
+                self._cond.wait(remaining)
+
+_handler=AsyncHandler()
+_handler.setFormatter(logging.Formatter("%(created)f:\t%(name)s\t: %(message)s"))
+_root=logging.getLogger('sagecell')
+_root.addHandler(_handler)
+_root.propagate=False
+_root.setLevel(LOG_LEVEL)
+
+def get_logger(name):
+    """
+    Get the logger for a part of the server.
+
+    :arg str name: ``"web"``, ``"device"``, ``"db"``, ``"fs"``, or
+        ``"trusted"``
+    :rtype: logging.Logger
+    """
+    logger=logging.getLogger('sagecell.'+name)
+    if name in LOG_LEVELS:
+        logger.setLevel(LOG_LEVELS[name])
+    return logger
+
+def quiet():
+    """
+    Turn off most logging (the ``-q`` command line option): only
+    warnings and errors are logged.
+    """
+    global LOGGING
+    LOGGING=False
+    _root.setLevel(logging.WARNING)
+    for name in LOG_LEVELS:
+        logging.getLogger('sagecell.'+name).setLevel(logging.NOTSET)
+
+_log=logging.getLogger('sagecell.log')
 
 def log(message, key=' '):
+    """
+    Log a message at the ``INFO`` level.  This is the old interface;
+    new code should use a logger from :func:`get_logger`.
+
+    :arg str message: the message
+    :arg str key: a tag (like a device or session ID) to log with the
+        message
+    """
     if LOGGING:
-        sys.__stderr__.write("%s:\t%s\t: %s\n"%(time(), key, message))
+        if key.strip():
+            _log.info("%s: %s", key, message)
+        else:
+            _log.info("%s", message)
 
-import os
 DEFAULT_DIR=''
 
 def write_process_id(prefix=None):
     with open(DEFAULT_DIR+prefix+'sage-cell-pid.%d'%os.getpid(),'w') as f:
         f.write('%d %d %d\n'%(os.getpid(), os.getpgid(0), os.getppid()))
-
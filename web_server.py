@@ -2,31 +2,284 @@
 Flask web server for frontend
 """
 
-from flask import Flask, request, render_template, redirect, url_for, jsonify, send_file, json, Response, abort, make_response
+from flask import Flask, Request, request, render_template, redirect, url_for, jsonify, send_file, json, Response, abort, make_response
 import mimetypes
-from time import time, sleep
+import os
+import threading
+from hashlib import sha1
+from time import time
 from functools import wraps
+import util
 from util import log
 from uuid import uuid4
-import zmq
-from ip_receiver import IPReceiver
+from completion import CompletionService
+import notify
+from notify import notifier, is_session_end
+import misc
+from cache import new_cache
+from static_assets import StaticAssets
+import metrics
+import ratelimit
+from db import DB
+from filestore import FileStore
 from werkzeug import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from urllib import quote, quote_plus
+from urlparse import urlparse
+import zlib
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 try:
     import sagecell_config
 except ImportError:
     import sagecell_config_default as sagecell_config
 MAX_FILES = sagecell_config.flask_config['max_files']
+# the maximum total size (in bytes) of the files uploaded with one request
+MAX_UPLOAD_BYTES = sagecell_config.flask_config.get('max_upload_bytes', 10*2**20)
+# the most messages, and (unless there is just one message) the most
+# bytes of JSON, returned by one /output_poll request
+OUTPUT_POLL_LIMIT = sagecell_config.flask_config.get('output_poll_limit', 1000)
+OUTPUT_POLL_MAX_BYTES = sagecell_config.flask_config.get('output_poll_max_bytes', 2**20)
+# /output_stream settings (all in seconds)
+STREAM_TIMEOUT = sagecell_config.flask_config.get('stream_timeout', 300)
+STREAM_MIN_INTERVAL = sagecell_config.flask_config.get('stream_min_interval', 0.05)
+STREAM_MAX_INTERVAL = sagecell_config.flask_config.get('stream_max_interval', 1)
+STREAM_KEEPALIVE = sagecell_config.flask_config.get('stream_keepalive', 15)
+# /output_long_poll settings (all in seconds)
+LONG_POLL_TIMEOUT = sagecell_config.flask_config.get('long_poll_timeout', 30)
+LONG_POLL_MAX_TIMEOUT = sagecell_config.flask_config.get('long_poll_max_timeout', 60)
+LONG_POLL_RECHECK = sagecell_config.flask_config.get('long_poll_recheck', 1)
+if notify.bus_config() is None:
+    # Output is committed by the trusted database, in another process,
+    # so without the notification bus no notification arrives here and
+    # waiting requests have to poll as often as they used to.
+    LONG_POLL_RECHECK = min(LONG_POLL_RECHECK, 0.1)
+# /service: the maximum time to wait for a snippet (in seconds), and the
+# maximum number of snippets in one /service/batch request
+SERVICE_TIMEOUT = sagecell_config.flask_config.get('service_timeout', 30)
+SERVICE_BATCH_MAX = sagecell_config.flask_config.get('service_batch_max', 100)
+# the size of each of the database and filestore context pools, and how
+# long a request waits for a context when the pool is exhausted
+DB_POOL_CONFIG = sagecell_config.flask_config.get('db_pool', {'size': 20, 'timeout': 5})
+# the size and lifetime of the permalink caches
+PERMALINK_CACHE_CONFIG = sagecell_config.flask_config.get('permalink_cache',
+        {'maxsize': 1000, 'ttl': 3600, 'shared': False})
+# /files: the size of each piece of a streamed file, how long browsers may
+# cache a versioned file URL (in seconds), and whether the front-end web
+# server should send files from a filesystem filestore itself
+FILE_CHUNK_SIZE = sagecell_config.flask_config.get('file_chunk_size', 2**16)
+FILE_MAX_AGE = sagecell_config.flask_config.get('file_max_age', 365*24*3600)
+FILE_SENDFILE = sagecell_config.flask_config.get('file_sendfile', None)
+# response compression: the compression level, and the smallest body (in
+# bytes) worth compressing
+COMPRESSION_CONFIG = sagecell_config.flask_config.get('compression', {})
+# /complete: the number of connections to the kernel, the time a request
+# may take (in seconds), and the size and lifetime of the matches cache
+COMPLETION_CONFIG = sagecell_config.flask_config.get('completion', {})
+# static files: how long (in seconds) browsers may cache fingerprinted
+# assets and fonts, and the embedding script, and which files to
+# fingerprint
+STATIC_MAX_AGE = sagecell_config.flask_config.get('static_max_age', 365*24*3600)
+EMBED_MAX_AGE = sagecell_config.flask_config.get('embed_max_age', 600)
+STATIC_ASSETS = sagecell_config.flask_config.get('static_assets',
+        ['all.min.js', 'all.min.css', 'jquery.min.js', 'root.css', 'favicon.ico',
+         'sagelogo.png', 'spinner.gif', 'jqueryui/css/sage/jquery-ui-1.8.17.custom.css',
+         'colorpicker/css/colorpicker.css'])
+# the /service result cache: its size and lifetime, and the permalinks
+# whose code is always cached
+SERVICE_CACHE_CONFIG = sagecell_config.flask_config.get('service_cache',
+        {'maxsize': 1000, 'ttl': 24*3600, 'shared': False, 'permalinks': []})
+# admission control for new computations (see misc.AdmissionControl)
+ADMISSION_CONFIG = sagecell_config.flask_config.get('admission', {})
+# per-client rate limits (see ratelimit.RateLimiter), where the shared
+# buckets are kept, and whether to trust the X-Forwarded-For header added
+# by a front-end proxy
+RATE_LIMITS = sagecell_config.flask_config.get('rate_limits', {})
+RATE_LIMIT_CONFIG = sagecell_config.flask_config.get('rate_limit',
+        {'path': '/tmp/sagecell_ratelimit', 'slots': 65536, 'forwarded': False})
+# the directory shared by all web server processes for /metrics
+METRICS_DIR = sagecell_config.flask_config.get('metrics_dir', '/tmp/sagecell_metrics')
+
+class UploadWriter(object):
+    """
+    The stream that :class:`UploadRequest` gives the form parser for an
+    uploaded file.  Each chunk of the file is written into the filestore
+    as it arrives.
+
+    :arg UploadRequest request: the request the file belongs to
+    :arg str filename: the (sanitized) name of the file, or ``None`` to
+        throw the file away
+    """
+    def __init__(self, request, filename):
+        self.request = request
+        self.filename = filename
+        self._file = None
+        if filename:
+            self._file = request.upload_fs.new_file(session=request.upload_session,
+                                                    filename=filename)
+            request.upload_files.append(filename)
+
+    def write(self, data):
+        self.request.upload_bytes += len(data)
+        if self.request.upload_bytes > MAX_UPLOAD_BYTES:
+            self.discard()
+            raise RequestEntityTooLarge()
+        if self._file is not None:
+            self._file.write(data)
+
+    def seek(self, *args):
+        # the form parser rewinds the stream when the file is complete;
+        # there is nothing to rewind
+        pass
+
+    def finish(self):
+        """
+        Finish writing the file to the filestore.
+
+        :returns: the file name, or ``None`` if the file was discarded
+        """
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        return self.filename
+
+    def discard(self):
+        """
+        Stop writing the file and remove what was written.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.request.upload_fs.delete_files(session=self.request.upload_session,
+                                                filename=self.filename)
+
+    def close(self):
+        self.finish()
+
+class UploadRequest(Request):
+    """
+    A request that streams uploaded files directly into the filestore
+    as the request body is parsed, instead of spooling each one to
+    memory or a temporary file first.  Set ``upload_fs`` and
+    ``upload_session`` before the form data is first accessed; until
+    they are set, uploads are handled as usual.
+
+    At most ``max_files`` files are kept, and a request whose files add
+    up to more than ``max_upload_bytes`` is stopped with a 413 error
+    as soon as it crosses the limit.  The names of the files written so
+    far are in ``upload_files``; if the request fails, call
+    :meth:`discard_uploads`.
+
+    If ``upload_check`` is set, it is called (see :meth:`check_upload`)
+    before the first file is written, so that it can turn the request
+    away before the upload costs anything.
+    """
+    upload_fs = None
+    upload_session = None
+    upload_bytes = 0
+    upload_count = 0
+    upload_files = ()
+    upload_check = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        if self.upload_fs is None:
+            return Request._get_file_stream(self, total_content_length, content_type,
+                                            filename, content_length)
+        if filename:
+            self.upload_count += 1
+            filename = secure_filename(filename)
+        if self.upload_count > MAX_FILES:
+            filename = None
+        if filename:
+            self.check_upload()
+        return UploadWriter(self, filename)
+
+    def check_upload(self):
+        """
+        Call ``upload_check``, unless it has already been called.
+        """
+        check, self.upload_check = self.upload_check, None
+        if check is not None:
+            check()
+
+    def discard_uploads(self):
+        """
+        Remove every file this request has written to the filestore.
+        """
+        for filename in set(self.upload_files):
+            self.upload_fs.delete_files(session=self.upload_session, filename=filename)
+        self.upload_files = []
+
+logger = util.get_logger('web')
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 2**20
+assets = StaticAssets(os.path.join(app.root_path, 'static'), STATIC_ASSETS, STATIC_MAX_AGE)
+app.jinja_env.globals['static_url'] = assets.url
+
+registry = metrics.Registry(METRICS_DIR)
+request_count = registry.counter('sagecell_http_requests_total',
+        'HTTP requests, by endpoint and status', ['endpoint', 'status'])
+request_latency = registry.histogram('sagecell_http_request_duration_seconds',
+        'Time to handle HTTP requests (for streamed responses, until the stream starts)',
+        ['endpoint'])
+request_errors = registry.counter('sagecell_http_errors_total',
+        'Exceptions raised while handling HTTP requests, by endpoint and type',
+        ['endpoint', 'type'])
+requests_in_flight = registry.gauge('sagecell_http_requests_in_flight',
+        'HTTP requests being handled', ['endpoint'])
+admission_rejections = registry.counter('sagecell_admission_rejections_total',
+        'Computations turned away because the workers are too busy', ['endpoint'])
+rate_limited_requests = registry.counter('sagecell_rate_limited_total',
+        'Requests refused because a client used up its budget, by endpoint and limit',
+        ['endpoint', 'limit'])
+cache_metrics = metrics.CacheMetrics(registry)
+pool_metrics = metrics.PoolMetrics(registry)
+db_metrics = metrics.Instrumented(registry, 'db')
+fs_metrics = metrics.Instrumented(registry, 'fs')
+
+@app.before_request
+def start_request_metrics():
+    endpoint = request.endpoint or 'none'
+    request.metrics_start = time()
+    request.metrics_status = 500
+    requests_in_flight.labels(endpoint).inc()
+
+@app.after_request
+def record_status(response):
+    request.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    endpoint = request.endpoint or 'none'
+    start = getattr(request, 'metrics_start', None)
+    if start is None:
+        return
+    requests_in_flight.labels(endpoint).dec()
+    request_latency.labels(endpoint).observe(time() - start)
+    request_count.labels(endpoint, str(request.metrics_status)).inc()
+    if exception is not None:
+        request_errors.labels(endpoint, type(exception).__name__).inc()
 
 # is it safe to have global variables here?
 db=None
 fs=None
-xreq=None
+db_pool=None
+fs_pool=None
+completer=None
+admission=misc.AdmissionControl(**ADMISSION_CONFIG)
+rate_limiter=ratelimit.RateLimiter(RATE_LIMITS, RATE_LIMIT_CONFIG.get('path', '/tmp/sagecell_ratelimit'),
+                                   RATE_LIMIT_CONFIG.get('slots', 65536))
 messages=[]
 sysargs=None
+_init_lock=threading.Lock()
 
 def print_exception(f):
     """
@@ -41,35 +294,187 @@ def print_exception(f):
             return "<pre>%s</pre>"%traceback.format_exc()
     return wrapper
 
+def init_db():
+    """
+    Connect to the database and filestore, the first time this is
+    called in a process, and set up the context pools.
+
+    :returns: the database and filestore context pools
+    :rtype: tuple
+    """
+    global db
+    global fs
+    global db_pool
+    global fs_pool
+    global sysargs
+    if db_pool is None or fs_pool is None:
+        # the threads of the Tornado server start at the same time
+        with _init_lock:
+            if db_pool is None or fs_pool is None:
+                db,fs=misc.select_db(sysargs)
+                bus = notify.bus_config()
+                if bus is not None:
+                    notifier.subscribe(bus['subscribe'])
+                db_metrics.instrument(type(db), DB)
+                fs_metrics.instrument(type(fs), FileStore)
+                db_pool=pool_metrics.instrument(misc.ContextPool(db, **DB_POOL_CONFIG), 'db')
+                fs_pool=pool_metrics.instrument(misc.ContextPool(fs, **DB_POOL_CONFIG), 'fs')
+    return db_pool, fs_pool
+
 def get_db(f):
     """
-    This decorator gets the database and passes it into the function as the first argument.
+    This decorator checks a database and filestore context out of the
+    context pools (see :class:`misc.ContextPool`) and passes them into
+    the function as the first arguments.  The contexts are returned to
+    the pools when the function returns, or, for a streamed response,
+    when the response is closed.
+
+    Handlers that wait for output don't use this, since a context held
+    while waiting is one that no other request can use.  They check a
+    context out for each query instead (see :meth:`misc.ContextPool.context`).
     """
-    import misc
     @wraps(f)
     def wrapper(*args, **kwds):
-        global db
-        global fs
-        global sysargs
-        if db is None or fs is None:
-            db,fs=misc.select_db(sysargs)
-        args = (db.new_context_copy(), fs.new_context_copy()) + args
-        return f(*args, **kwds)
+        db_pool, fs_pool = init_db()
+        db_context=db_pool.checkout()
+        try:
+            fs_context=fs_pool.checkout()
+        except:
+            db_pool.checkin(db_context)
+            raise
+        def release():
+            db_pool.checkin(db_context)
+            fs_pool.checkin(fs_context)
+        try:
+            rval = f(db_context, fs_context, *args, **kwds)
+        except:
+            release()
+            raise
+        if isinstance(rval, Response) and rval.is_streamed:
+            # the response generator still uses the contexts
+            rval.call_on_close(release)
+        else:
+            release()
+        return rval
     return wrapper
 
-def jsonify_with_callback(callback, *args, **kwargs):
-    if callback is None:
-        return jsonify(*args, **kwargs)
+@app.errorhandler(misc.PoolTimeout)
+def pool_timeout(error):
+    r = Response("The server is too busy; please try again.", status=503,
+                 content_type='text/plain')
+    r.headers["Retry-After"] = "1"
+    return r
+
+@app.errorhandler(misc.Overloaded)
+def overloaded(error):
+    admission_rejections.labels(request.endpoint or 'none').inc()
+    r = Response("The server is too busy; please try again later.", status=503,
+                 content_type='text/plain')
+    r.headers["Retry-After"] = str(int(min(error.wait, admission.max_wait)) + 1)
+    r.headers["Access-Control-Allow-Origin"] = "*"
+    return r
+
+@app.errorhandler(ratelimit.RateLimited)
+def rate_limited(error):
+    rate_limited_requests.labels(request.endpoint or 'none', error.limit).inc()
+    r = Response("Too many requests; please slow down.", status=429,
+                 content_type='text/plain')
+    r.headers["Retry-After"] = str(int(error.retry_after) + 1)
+    r.headers["Access-Control-Allow-Origin"] = "*"
+    return r
+
+def _client(remote_addr=None, headers=None):
+    """
+    Identify the client making a request for rate limiting.
+
+    :arg str remote_addr: the address the request came from (by
+        default, that of the current Flask request)
+    :arg headers: the request headers (by default, those of the current
+        Flask request)
+    :returns: the client's IP address, and the site (scheme and host)
+        of the page that made the request, or ``None``
+    :rtype: tuple
+    """
+    if headers is None:
+        remote_addr, headers = request.remote_addr, request.headers
+    ip = remote_addr
+    if RATE_LIMIT_CONFIG.get('forwarded'):
+        # our proxy appends the address it saw to the header
+        forwarded = headers.get('X-Forwarded-For')
+        if forwarded:
+            ip = forwarded.split(',')[-1].strip()
+    origin = headers.get('Origin')
+    if not origin or origin == 'null':
+        referer = urlparse(headers.get('Referer', ''))
+        origin = '%s://%s'%(referer.scheme, referer.netloc) if referer.netloc else None
+    return ip, origin
+
+def rate_limit(budget):
+    """
+    This decorator charges each request to the client's ``budget``
+    (see :class:`ratelimit.RateLimiter`) before handling it.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            rate_limiter.check(budget, *_client())
+            return f(*args, **kwds)
+        return wrapper
+    return decorator
+
+def _gzip(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _compress(response):
+    """
+    Compress the body of a response with the best encoding that both
+    the client (according to its ``Accept-Encoding`` header) and the
+    server support.  Streamed responses, responses that are already
+    encoded, and small bodies are left alone.
+    """
+    response.headers.add('Vary', 'Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough
+        or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    data = response.data
+    if len(data) < COMPRESSION_CONFIG.get('min_size', 1024):
+        return response
+    level = COMPRESSION_CONFIG.get('level', 6)
+    accepted = request.accept_encodings
+    if brotli is not None and COMPRESSION_CONFIG.get('brotli', True) and accepted['br']:
+        data, encoding = brotli.compress(data, quality=min(level, 11)), 'br'
+    elif accepted['gzip']:
+        data, encoding = _gzip(data, level), 'gzip'
     else:
-        return Response(callback + '(' + json.dumps(json.dumps(kwargs))+')',
-                        mimetype="application/javascript")
+        return response
+    response.data = data
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def compress(f):
+    """
+    This decorator compresses the response of the function if the
+    client accepts a compressed response (see :func:`_compress`).
+    """
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        return _compress(make_response(f(*args, **kwds)))
+    return wrapper
 
 import string
 _VALID_QUERY_CHARS=set(string.letters+string.digits+'-')
+# shortened ID -> code, and (URL root, shortened ID, autoeval) -> page
+_permalink_cache=cache_metrics.instrument(
+        new_cache(prefix='permalink:', **PERMALINK_CACHE_CONFIG), 'permalink')
+_root_page_cache=cache_metrics.instrument(
+        new_cache(prefix='root:', **PERMALINK_CACHE_CONFIG), 'root_page')
 @app.route("/")
 @get_db
 def root(db,fs):
     options={}
+    # set when the page is a permalink, which can be cached
+    page_key=None
     if 'c' in request.values:
         options['code']=request.values['c']
     elif 'z' in request.values:
@@ -84,26 +489,85 @@ def root(db,fs):
         except Exception as e:
             options['code']="# Error decompressing code: %s"%e
     elif 'q' in request.values and set(request.values['q']).issubset(_VALID_QUERY_CHARS):
-        options['code']=db.get_input_message_by_shortened(request.values['q'])
+        # Permalinks never change, so we cache both the code and the
+        # rendered page (which also depends on the URL root, since
+        # the template uses external URLs).
+        shortened=request.values['q']
+        page_key=(request.url_root, shortened, _autoeval())
+        page=_root_page_cache.get(page_key)
+        if page is not None:
+            return page
+        code=_permalink_cache.get(shortened)
+        if code is None:
+            code=db.get_input_message_by_shortened(shortened)
+            if code:
+                _permalink_cache.set(shortened, code)
+        options['code']=code
     if 'code' in options:
         if isinstance(options['code'], unicode):
             options['code']=options['code'].encode('utf8')
         options['code']=quote(options['code'])
-        options['autoeval'] = 'false' if 'autoeval' in request.args and request.args['autoeval'] == 'false' else 'true'
-    return render_template('root.html', **options)
+        options['autoeval'] = _autoeval()
+    page=render_template('root.html', **options)
+    if page_key is not None and options.get('code'):
+        _root_page_cache.set(page_key, page)
+    return page
+
+def _autoeval():
+    return 'false' if 'autoeval' in request.args and request.args['autoeval'] == 'false' else 'true'
 
 @app.route("/static/mathjax/fonts/HTML-CSS/TeX/<fontformat>/<filename>")
 def webfont(fontformat, filename):
-    response = send_file("static/mathjax/fonts/HTML-CSS/TeX/%s/%s" % (fontformat, filename))
+    # the fonts only change when MathJax is upgraded
+    response = send_file("static/mathjax/fonts/HTML-CSS/TeX/%s/%s" % (fontformat, filename),
+                         conditional=True, cache_timeout=STATIC_MAX_AGE)
     response.headers["Access-Control-Allow-Origin"] = "*"
     return response
 
+def static(filename):
+    """
+    Serve a static file.  Fingerprinted assets (see
+    :mod:`static_assets`) are served from memory, precompressed and
+    with long-lived caching headers; everything else is handled by
+    Flask as usual.
+    """
+    response = assets.response(filename, request)
+    if response is None:
+        response = app.send_static_file(filename)
+    return response
+app.view_functions['static'] = static
+
 @app.route("/eval", methods=['POST'])
 @get_db
 def evaluate(db,fs):
+    # Uploaded files are written to the filestore as the form is parsed,
+    # which happens the first time we look at the form data below.  If
+    # the request is turned away or fails, they are removed.
+    session_id = str(uuid4())
+    request.upload_fs = fs
+    request.upload_session = session_id
+    request.upload_files = []
+    # Only new computations upload files, so a request with files is
+    # charged and admitted before the first one is written.  Messages
+    # for a running session are always admitted, since their device is
+    # already working on them, and have their own budget.
+    request.upload_check = lambda: _admit_eval(db)
+    try:
+        return _evaluate(db, session_id)
+    except:
+        request.discard_uploads()
+        raise
+
+def _admit_eval(db):
+    rate_limiter.check('eval', *_client())
+    admission.admit(db)
+
+def _evaluate(db, session_id):
     # If the request is a JSON message, such as from an interact update:
     if request.values.get("message") is not None:
-        log('Received Request: %s'%(request.values['message'],))
+        request.discard_uploads()
+        rate_limiter.check('message', *_client())
+        logger.debug('Received Request: %s', request.values['message'])
         message=json.loads(request.values['message'])
         session_id=message['header']['session']
         db.new_input_message(message)
@@ -111,52 +575,34 @@ def evaluate(db,fs):
         rval = json.dumps({"computation_id": session_id})
     # Else if the request is the initial form submission at the beginning of a session:
     else:
-        log('Received Request: %s' % (request.values,))
-        session_id = str(uuid4())
-        valid_request = True
-        code = ""
+        # a computation without files hasn't been charged or admitted yet
+        request.check_upload()
+        logger.debug('Received Request: %s', request.values)
         uploaded_files = request.files.getlist("file")
         files = []
 
         # Checks if too many files were uploaded.
-        if len(request.files.getlist("file")) > MAX_FILES:
-            code += "print('ERROR: Too many files uploaded. Maximum number of uploaded files is 10.')\n"
-            valid_request = False
-
-        if valid_request:
+        if request.upload_count > MAX_FILES:
+            request.discard_uploads()
+            code = "print('ERROR: Too many files uploaded. Maximum number of uploaded files is %d.')\n"%MAX_FILES
+        else:
             for file in uploaded_files:
-                if file:
-                    filename = secure_filename(file.filename)
-                    fs.create_file(file, filename=filename, session=session_id)
+                filename = file.stream.finish()
+                if filename:
                     files.append(filename)
             code = json.loads(request.values.get("commands"))
             if not isinstance(code, basestring):
                 log("code was not a string: %r"%(code,))
+                request.discard_uploads()
                 return jsonify()
 
-            sage_mode = "sage_mode" in request.values
-            shortened = str(uuid4())
-            message = {"parent_header": {},
-                       "header": {"msg_id": request.values.get("msg_id"),
-                                  "username": "",
-                                  "session": session_id
-                                  },
-                       "msg_type": "execute_request",
-                       "content": {"code": code,
-                                   "silent": False,
-                                   "files": files,
-                                   "sage_mode": sage_mode,
-                                   "user_variables": [],
-                                   "user_expressions": {}
-                                   },
-                        "shortened": shortened
-                       }
-        log("Received Request: %s"%(message))
+        sage_mode = "sage_mode" in request.values
+        message = _eval_request(code, session_id, request.values.get("msg_id"),
+                                files, sage_mode)
+        logger.debug("Received Request: %s", message)
         db.new_input_message(message)
-        import zlib, base64
-        z=base64.urlsafe_b64encode(zlib.compress(code.encode('utf8')))
-        zipurl = url_for('root', _external=True, z=z)
-        queryurl = url_for('root', _external=True, q=shortened)
+        zipurl = url_for('root', _external=True, z=_zip_code(code))
+        queryurl = url_for('root', _external=True, q=message["shortened"])
         rval = json.dumps({"zipurl": zipurl, "queryurl": queryurl,
                            "session_id": session_id})
     if (request.values.get("frame") is not None):
@@ -167,11 +613,117 @@ def evaluate(db,fs):
         r.headers["Access-Control-Allow-Origin"] = "*"
         return r
 
+def _eval_request(code, session, msg_id, files, sage_mode):
+    """
+    Build the ``execute_request`` message for an :func:`evaluate` call
+    that starts a session.
+
+    :arg str code: the code to execute
+    :arg str session: the ID of the new session
+    :arg str msg_id: the client's ID for the message
+    :arg list files: the names of the uploaded files
+    :arg bool sage_mode: whether to run the code in Sage mode
+    :returns: an IPython-style message, including the ``shortened`` ID
+        of its permalink
+    :rtype: dict
+    """
+    return {"parent_header": {},
+            "header": {"msg_id": msg_id,
+                       "username": "",
+                       "session": session
+                       },
+            "msg_type": "execute_request",
+            "content": {"code": code,
+                        "silent": False,
+                        "files": files,
+                        "sage_mode": sage_mode,
+                        "user_variables": [],
+                        "user_expressions": {}
+                        },
+            "shortened": str(uuid4())
+            }
+
+def _zip_code(code):
+    """
+    Compress code for the ``z`` parameter of a link to the root page.
+    """
+    import base64
+    return base64.urlsafe_b64encode(zlib.compress(code.encode('utf8')))
+
 from urllib import urlencode, urlopen
 from json import loads
 
+def _page_limits(values=None):
+    """
+    The ``limit`` (messages) and ``max_bytes`` request parameters,
+    capped by the server's settings.
+
+    :arg values: the request parameters (by default, those of the
+        current Flask request)
+    """
+    if values is None:
+        values = request.values
+    limit = min(int(values.get('limit', OUTPUT_POLL_LIMIT)), OUTPUT_POLL_LIMIT)
+    max_bytes = min(int(values.get('max_bytes', OUTPUT_POLL_MAX_BYTES)), OUTPUT_POLL_MAX_BYTES)
+    return max(limit, 1), max_bytes
+
+def _output_page(db, computation_id, sequence, limit, max_bytes):
+    """
+    Get a page of a session's output, encoded as JSON.  The messages
+    are never decoded (see :meth:`db.DB.get_messages_json`).
+
+    :arg int limit: the maximum number of messages
+    :arg int max_bytes: the maximum size of the encoded messages; the
+        first message is always included, however big it is
+    :returns: the list of JSON-encoded messages, the sequence number to
+        ask for next, and whether there is more output after this page
+    :rtype: tuple
+    """
+    messages = db.get_messages_json(computation_id, sequence, limit=limit+1)
+    more = len(messages) > limit
+    encoded = []
+    size = 0
+    next_sequence = sequence
+    for seq, s in messages[:limit]:
+        if encoded and size+len(s) > max_bytes:
+            more = True
+            break
+        encoded.append(s)
+        size += len(s)+2
+        next_sequence = seq+1
+    return encoded, next_sequence, more
+
+def _output_body(callback, encoded, next_sequence, more):
+    """
+    Make the body of a response to an output request from the result
+    of :func:`_output_page`, joining the encoded messages into the
+    response without encoding them again.
+
+    :returns: the body and its MIME type
+    :rtype: tuple
+    """
+    if encoded:
+        body = '{"content": [%s], "next_sequence": %d, "more": %s}'%(
+                ', '.join(encoded), next_sequence, 'true' if more else 'false')
+    else:
+        body = '{}'
+    if callback is None:
+        return body, "application/json"
+    # the client parses the JSON text it is handed
+    return callback + '(' + json.dumps(body) + ')', "application/javascript"
+
+def _output_response(callback, encoded, next_sequence, more):
+    """
+    Make the response to an output request (see :func:`_output_body`).
+    """
+    body, mimetype = _output_body(callback, encoded, next_sequence, more)
+    r = Response(body, mimetype=mimetype)
+    r.headers["Access-Control-Allow-Origin"] = "*"
+    return r
+
 @app.route("/output_poll")
 @print_exception
+@compress
 @get_db
 def output_poll(db,fs):
     """
@@ -179,130 +731,549 @@ def output_poll(db,fs):
 
     If a computation id has output, then return to browser. If no
     output is entered, then return nothing.
+
+    A large backlog of output is returned in pages of at most ``limit``
+    messages and ``max_bytes`` bytes (both optional, and capped by the
+    ``output_poll_limit`` and ``output_poll_max_bytes`` settings).  The
+    response includes the ``next_sequence`` to ask for and whether
+    there is ``more`` output waiting.
     """
     callback=request.values['callback'] if 'callback' in request.values else None
     computation_id=request.values['computation_id']
     sequence=int(request.values.get('sequence',0))
-    results = db.get_messages(computation_id,sequence=sequence)
-    log("Retrieved messages: %s"%(str(results)[:2000],))
-    if results is not None and len(results)>0:
-        rval = jsonify_with_callback(callback, content=results)
+    limit, max_bytes = _page_limits()
+    encoded, next_sequence, more = _output_page(db, computation_id, sequence, limit, max_bytes)
+    logger.debug("Retrieved messages: %.2000s", encoded)
+    return _output_response(callback, encoded, next_sequence, more)
+
+@app.route("/output_stream")
+def output_stream():
+    """
+    Stream the output of a computation id as Server-Sent Events.
+
+    This keeps one connection open for the whole session instead of
+    having the browser call :func:`output_poll` every few hundred
+    milliseconds.  Each message is sent (in the same format as
+    :func:`output_poll`) as a separate event whose ``id`` is the
+    message's sequence number, so a client that reconnects (and sends
+    a ``Last-Event-ID`` header) resumes right after the last message it
+    received.  The stream ends after the ``session_end`` message, or
+    after ``stream_timeout`` seconds, in which case the client should
+    reconnect.
+    """
+    computation_id=request.values['computation_id']
+    if 'Last-Event-ID' in request.headers:
+        sequence=int(request.headers['Last-Event-ID'])+1
     else:
-        rval = jsonify_with_callback(callback, [])
-    rval.headers["Access-Control-Allow-Origin"] = "*"
-    return rval
+        sequence=int(request.values.get('sequence',0))
+    end_time=time()+STREAM_TIMEOUT
+    db_pool=init_db()[0]
+
+    def events(sequence):
+        # We wake up as soon as new output is announced for the session.
+        # Otherwise the delay between database queries backs off while
+        # the session is quiet, and resets when there is more output.
+        interval=STREAM_MIN_INTERVAL
+        last_write=time()
+        # tell EventSource how long to wait before reconnecting
+        yield "retry: %d\n\n"%(STREAM_MIN_INTERVAL*1000)
+        with notifier.listen(computation_id) as event:
+            while time()<end_time:
+                event.clear()
+                try:
+                    with db_pool.context() as db:
+                        results=db.get_messages_json(computation_id, sequence=sequence, limit=OUTPUT_POLL_LIMIT)
+                except misc.PoolTimeout:
+                    # the client reconnects and resumes where it left off
+                    return
+                if results:
+                    for seq, s in results:
+                        if seq<sequence:
+                            continue
+                        sequence=seq+1
+                        yield "id: %d\ndata: %s\n\n"%(seq, s)
+                        # only decode the messages that might end the session
+                        if '"session_end"' in s and is_session_end(json.loads(s)):
+                            return
+                    interval=STREAM_MIN_INTERVAL
+                    last_write=time()
+                else:
+                    if time()-last_write>STREAM_KEEPALIVE:
+                        # a comment line keeps proxies from closing the connection
+                        yield ": keepalive\n\n"
+                        last_write=time()
+                    event.wait(interval)
+                    interval=min(2*interval, STREAM_MAX_INTERVAL)
+
+    r=Response(events(sequence), mimetype="text/event-stream")
+    r.headers["Cache-Control"]="no-cache"
+    # tell nginx not to buffer the stream
+    r.headers["X-Accel-Buffering"]="no"
+    r.headers["Access-Control-Allow-Origin"]="*"
+    return r
 
 @app.route("/output_long_poll")
 @print_exception
-@get_db
-def output_long_poll(db,fs):
+@compress
+def output_long_poll():
     """
     Implements long-polling to return answers.
 
-    If a computation id has output, then return to browser. Otherwise,
-    poll the database periodically to check to see if the computation id
-    is done.  Return after a certain number of seconds whether or not
-    it is done.
-
-    This currently blocks (calls sleep), so is not very useful.
+    This takes the same arguments (and returns the same pages) as
+    :func:`output_poll`, plus an optional ``timeout`` (in seconds).  If the computation id has
+    output at or after ``sequence``, return it right away.  Otherwise,
+    wait until the database announces new output for the session (see
+    :mod:`notify`) and return it, or return nothing after ``timeout``
+    seconds.  While waiting, the database is only checked again when
+    a notification arrives or every ``long_poll_recheck`` seconds in
+    case a notification was missed.
     """
-    default_timeout=2 #seconds
-    poll_interval=.1 #seconds
-    end_time=float(request.values.get('timeout', default_timeout))+time()
+    callback=request.values['callback'] if 'callback' in request.values else None
     computation_id=request.values['computation_id']
-    while time()<end_time:
-        results = db.get_evaluated_cells(id=computation_id)
-        if results is not None and len(results)>0:
-            return jsonify({'output':results['output']})
-        sleep(poll_interval)
-    return jsonify([])
+    sequence=int(request.values.get('sequence',0))
+    timeout=min(float(request.values.get('timeout', LONG_POLL_TIMEOUT)), LONG_POLL_MAX_TIMEOUT)
+    limit, max_bytes = _page_limits()
+    end_time=time()+timeout
+    db_pool=init_db()[0]
+    with notifier.listen(computation_id) as event:
+        while True:
+            event.clear()
+            with db_pool.context() as db:
+                encoded, next_sequence, more = _output_page(db, computation_id, sequence, limit, max_bytes)
+            remaining=end_time-time()
+            if encoded or remaining<=0:
+                break
+            event.wait(min(remaining, LONG_POLL_RECHECK))
+    return _output_response(callback, encoded, next_sequence, more)
+
+def _file_size(f):
+    """
+    Find the size of a file returned by a filestore's ``get_file``.
+    """
+    length = getattr(f, 'length', None)
+    if length is not None:
+        # GridFS files and FileStoreSQLAlchemy.DBFileReader
+        return length
+    try:
+        return os.fstat(f.fileno()).st_size
+    except (AttributeError, IOError, OSError):
+        f.seek(0, 2)
+        length = f.tell()
+        f.seek(0)
+        return length
+
+def _file_version(f):
+    """
+    Find something that changes whenever a stored file is replaced.
+    """
+    for attr in ('version', '_id', 'upload_date'):
+        if getattr(f, attr, None) is not None:
+            return getattr(f, attr)
+    try:
+        return os.fstat(f.fileno()).st_mtime
+    except (AttributeError, IOError, OSError):
+        return None
+
+def _parse_range(header, size):
+    """
+    Parse a ``Range`` header asking for a single range of bytes.
+
+    :returns: the first and last byte positions (inclusive), ``None``
+        if the header is missing or not a single byte range, or
+        ``False`` if the range can't be satisfied
+    """
+    if header is None or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if start == '':
+            # the last ``end`` bytes
+            start, end = max(0, size-int(end)), size-1
+        else:
+            start, end = int(start), (int(end) if end else size-1)
+    except ValueError:
+        return None
+    end = min(end, size-1)
+    if start > end:
+        return False
+    return start, end
+
+def _read_chunks(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(FILE_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
 
 @app.route("/files/<session>/<filename>")
 @get_db
 def session_file(db,fs,session,filename):
-    """Returns a file generated by a session from the filesystem."""
+    """
+    Returns a file generated by a session from the filestore.
+
+    The file is streamed in chunks and supports ``Range`` requests and
+    ``ETag`` revalidation.  A file can be replaced while its session is
+    running, so it is only cached for a long time when the URL has a
+    ``v`` parameter that the client changes with each new version.
+
+    If the ``file_sendfile`` option is set and the filestore is a
+    :class:`filestore.FileStoreFilesystem`, we just tell the front-end
+    web server (with an ``X-Accel-Redirect`` or ``X-Sendfile`` header)
+    which file to send.
+    """
     # We can't use send_file because that will try to access the file
     # on the local filesystem (see the code to send_file).
     # So we have to do the work of send_file ourselves.
-    #return send_file(fs.get_file(session,filename), attachment_filename=filename)
-
     mimetype=mimetypes.guess_type(filename)[0]
     if mimetype is None:
         mimetype = 'application/octet-stream'
-    f=fs.get_file(session=session, filename=filename)
-    if f is not None:
-        return Response(f, content_type=mimetype)
+    if 'v' in request.args:
+        cache_control = 'public, max-age=%d' % FILE_MAX_AGE
     else:
+        cache_control = 'no-cache'
+
+    if FILE_SENDFILE is not None and hasattr(fs, 'file_path'):
+        paths = fs.file_path(session=session, filename=filename)
+        if paths is None:
+            abort(404)
+        r = Response(content_type=mimetype)
+        if FILE_SENDFILE['header'] == 'X-Accel-Redirect':
+            r.headers['X-Accel-Redirect'] = FILE_SENDFILE.get('prefix', '/') + quote(paths[0])
+        else:
+            r.headers[FILE_SENDFILE['header']] = paths[1]
+        r.headers['Cache-Control'] = cache_control
+        return r
+
+    f=fs.get_file(session=session, filename=filename)
+    if f is None:
         abort(404)
+    size = _file_size(f)
+    etag = '"%s"' % sha1(repr((session, filename, size, _file_version(f)))).hexdigest()
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes',
+               'Cache-Control': cache_control}
+    if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+        f.close()
+        return Response(status=304, headers=headers)
+
+    byte_range = _parse_range(request.headers.get('Range'), size)
+    if request.headers.get('If-Range', etag) != etag:
+        byte_range = None
+    if byte_range is False:
+        f.close()
+        headers['Content-Range'] = 'bytes */%d' % size
+        return Response(status=416, headers=headers)
+    if byte_range is None:
+        start, length, status = 0, size, 200
+    else:
+        start, length, status = byte_range[0], byte_range[1]-byte_range[0]+1, 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (byte_range[0], byte_range[1], size)
+    headers['Content-Length'] = str(length)
+    return Response(_read_chunks(f, start, length), status=status, headers=headers,
+                    content_type=mimetype, direct_passthrough=True)
+
+def _service_request(code, session):
+    """
+    Build the ``execute_request`` message for a :func:`service` call.
+
+    :arg str code: the code to execute (in Sage mode)
+    :arg str session: the ID of the new session
+    :returns: an IPython-style message
+    :rtype: dict
+    """
+    return {"parent_header": {},
+            "header": {"msg_id": session,
+                       "username": "",
+                       "session": session,
+                       },
+            "msg_type": "execute_request",
+            "content": {"code": code,
+                        "silent": False,
+                        "files": [],
+                        "sage_mode": True,
+                        "user_variables": [],
+                        "user_expressions": {},
+                        },
+            }
+
+class ServiceOutput(object):
+    """
+    Collects the output of a session started by
+    :func:`_service_request`, from the session's messages in order.
+    """
+    def __init__(self):
+        self.sequence = 0
+        self.output = ""
+        self.success = False
+        self.done = False
+        self.cacheable = True
+
+    def add(self, messages):
+        """
+        Add the next messages of the session.
+
+        :arg list messages: IPython-style messages, starting at
+            ``self.sequence``
+        """
+        for m in messages:
+            self.sequence = max(self.sequence, m['sequence']+1)
+            msg_type = m.get('msg_type','')
+            content = m['content']
+            if msg_type=="execute_reply":
+                if content['status']=="ok":
+                    self.success=True
+                elif content['status']=="error":
+                    self.success=False
+                self.done=True
+                break
+            elif msg_type=="stream":
+                if content['name']=="stdout":
+                    self.output += content['data']
+            elif msg_type=="pyout":
+                self.output+=content['data'].get('text/plain','')
+            elif is_session_end(m):
+                # the session ended without an execute_reply
+                self.done=True
+                break
+            elif msg_type=="extension":
+                # files, interacts and the like
+                self.cacheable=False
+
+    def result(self):
+        """
+        :returns: the stdout and ``pyout`` output, whether the code ran
+            without error, and whether the result may be cached (the code
+            finished without creating files or interacts)
+        :rtype: tuple
+        """
+        return self.output, self.success, self.cacheable and self.done
+
+def _service_result(db_pool, session, event, end_time):
+    """
+    Wait for a session started by :func:`_service_request` to finish,
+    collecting its output.
+
+    :arg misc.ContextPool db_pool: the database context pool; a context
+        is only checked out for each query, not while waiting
+    :arg str session: the session ID
+    :arg threading.Event event: the event from a completion listener
+        (see :meth:`notify.Notifier.listen`) registered for the session
+        before the request was inserted
+    :arg float end_time: give up waiting at this time
+    :returns: see :meth:`ServiceOutput.result`
+    :rtype: tuple
+    """
+    output = ServiceOutput()
+    # We are only woken when the computation finishes; the recheck
+    # timeout is just a safety net for lost notifications.
+    while True:
+        event.clear()
+        try:
+            with db_pool.context() as db:
+                output.add(db.get_messages(session, sequence=output.sequence))
+        except misc.PoolTimeout:
+            # a batch has already started its response; try again
+            # after the next wait
+            pass
+        remaining=end_time-time()
+        if output.done or remaining<=0:
+            break
+        event.wait(min(remaining, LONG_POLL_RECHECK))
+    return output.result()
+
+_service_cache=cache_metrics.instrument(new_cache(prefix='service:', **dict((k, v) for k, v in
+        SERVICE_CACHE_CONFIG.items() if k!='permalinks')), 'service')
+_service_cache_permalink_keys=None
+service_cache_hits = registry.counter('sagecell_service_cache_hits_total',
+        '/service requests answered from the result cache')
+service_cache_misses = registry.counter('sagecell_service_cache_misses_total',
+        'Cacheable /service requests that had to be run')
+service_cache_bytes_saved = registry.counter('sagecell_service_cache_bytes_saved_total',
+        'Output bytes served from the /service result cache')
+
+def _service_cache_key(code, sage_mode=True):
+    """
+    The result cache key for a :func:`service` snippet.
+    """
+    return sha1(json.dumps([code, sage_mode])).hexdigest()
+
+def _service_cache_permalinks(db):
+    """
+    The result cache keys of the code of the allow-listed permalinks
+    (``permalinks`` in the ``service_cache`` setting), whose results are
+    cached even without the ``cache`` flag.
+    """
+    global _service_cache_permalink_keys
+    if _service_cache_permalink_keys is None:
+        keys = set()
+        for shortened in SERVICE_CACHE_CONFIG.get('permalinks', []):
+            code = db.get_input_message_by_shortened(shortened)
+            if code:
+                keys.add(_service_cache_key(code))
+        _service_cache_permalink_keys = keys
+    return _service_cache_permalink_keys
 
 @app.route("/service", methods=['GET','POST'])
-@get_db
-def service(db,fs):
+@rate_limit('service')
+@compress
+def service():
     code = request.values.get("code")
     if not isinstance(code, basestring):
         log("code was not a string: %r"%(code,))
         return ""
-    log("Service called with code: %r"%code[:1000])
+    logger.debug("Service called with code: %.1000r", code)
+    db_pool = init_db()[0]
+    key = _service_cache_key(code)
+    with db_pool.context() as db:
+        use_cache = request.values.get("cache") == "1" or key in _service_cache_permalinks(db)
+        if use_cache:
+            cached = _service_cache.get(key)
+            if cached is not None:
+                s, success = cached
+                service_cache_hits.labels().inc()
+                service_cache_bytes_saved.labels().inc(len(s))
+                return jsonify(output=s, success=success)
+            service_cache_misses.labels().inc()
+        admission.admit(db)
 
-    default_timeout=30 #seconds
-    poll_interval=.1 #seconds
-    end_time=time()+default_timeout
+    end_time=time()+SERVICE_TIMEOUT
     session = str(uuid4())
-    message = {"parent_header": {},
-               "header": {"msg_id": session,
-                          "username": "",
-                          "session": session,
-                          },
-                          "msg_type": "execute_request",
-                          "content": {"code": code,
-                                      "silent": False,
-                                      "files": [],
-                                      "sage_mode": True,
-                                      "user_variables": [],
-                                      "user_expressions": {},
-                                      },
-        }
-    db.new_input_message(message)
-    sequence = 0
-    s = ""
-    success=False
-    done=False
-    while not done and time()<end_time:
-        sleep(poll_interval)
-        results = db.get_messages(session, sequence=sequence)
-        if results is not None and len(results)>0:
-            for m in results:
-                msg_type = m.get('msg_type','')
-                content = m['content']
-                if msg_type=="execute_reply":
-                    if content['status']=="ok":
-                        success=True
-                    elif content['status']=="error":
-                        success=False
-                    done=True
-                    break
-                elif msg_type=="stream":
-                    if content['name']=="stdout":
-                        s += content['data']
-                elif msg_type=="pyout":
-                    s+=content['data'].get('text/plain','')
-    log('Service returning: %r'%json.dumps([s,success]))
+    # Listen before inserting the request so that we can't miss the
+    # notification.
+    with notifier.listen(session, completion=True) as event:
+        with db_pool.context() as db:
+            db.new_input_message(_service_request(code, session))
+        s, success, cacheable = _service_result(db_pool, session, event, end_time)
+    if use_cache and cacheable:
+        _service_cache.set(key, (s, success))
+    logger.debug('Service returning: %r', [s, success])
     return jsonify(output=s, success=success)
 
+def _batch_jobs(data):
+    """
+    Parse the snippets of a :func:`service_batch` request.
+
+    :arg str data: the JSON list of snippets
+    :returns: a list of ``(code, timeout)`` tuples
+    :raises ValueError: if the request is malformed, or has more
+        snippets than ``service_batch_max`` or than fit in the client's
+        ``service`` rate limit buckets
+    """
+    most = SERVICE_BATCH_MAX
+    if rate_limiter.max_cost('service') is not None:
+        # each snippet is charged to the client's budget, so a bigger
+        # batch could never be paid for in full
+        most = min(most, rate_limiter.max_cost('service'))
+    snippets = json.loads(data)
+    if not isinstance(snippets, list) or len(snippets)>most:
+        raise ValueError("expected a list of at most %d snippets"%most)
+    jobs = []
+    for item in snippets:
+        if isinstance(item, dict):
+            code = item.get("code")
+            timeout = item.get("timeout", SERVICE_TIMEOUT)
+        else:
+            code = item
+            timeout = SERVICE_TIMEOUT
+        if not isinstance(code, basestring) or not isinstance(timeout, (int, float)):
+            raise ValueError("bad snippet: %r"%(item,))
+        jobs.append((code, min(max(timeout, 0), SERVICE_TIMEOUT)))
+    return jobs
+
+@app.route("/service/batch", methods=['POST'])
+def service_batch():
+    """
+    Evaluate many independent snippets in one HTTP request.
+
+    The request body (or the ``snippets`` form field) is a JSON list.
+    Each item is either a string of code or a dict
+    ``{"code": code, "timeout": seconds}``.  Every snippet runs in its
+    own session, and all of them are submitted to the device at once,
+    so they run concurrently.  The response is a JSON list of
+    ``{"output": ..., "success": ...}`` dicts, streamed as the results
+    become available, but in the order the snippets were submitted, not
+    the order they finish in: a slow snippet holds back the results
+    after it.
+    """
+    if 'snippets' in request.values:
+        data = request.values['snippets']
+    else:
+        data = request.data
+    try:
+        jobs = _batch_jobs(data)
+    except ValueError:
+        abort(400)
+    logger.debug("Service batch called with %d snippets", len(jobs))
+    ip, origin = _client()
+    rate_limiter.check('service', ip, origin, len(jobs))
+    db_pool = init_db()[0]
+
+    start_time = time()
+    sessions = []
+    listeners = []
+    def close_listeners():
+        while listeners:
+            listeners.pop().__exit__(None, None, None)
+    try:
+        with db_pool.context() as db:
+            admission.admit(db, len(jobs))
+            for code, timeout in jobs:
+                session = str(uuid4())
+                listener = notifier.listen(session, completion=True)
+                event = listener.__enter__()
+                listeners.append(listener)
+                db.new_input_message(_service_request(code, session))
+                sessions.append((session, event, start_time+timeout))
+    except:
+        close_listeners()
+        raise
+
+    def results():
+        # The snippets all run at the same time, so waiting for them in
+        # order costs no more than waiting for whichever finishes last.
+        yield "["
+        for i, (session, event, end_time) in enumerate(sessions):
+            s, success, cacheable = _service_result(db_pool, session, event, end_time)
+            yield (", " if i>0 else "") + json.dumps({"output": s, "success": success})
+        yield "]"
+
+    r = Response(results(), mimetype="application/json")
+    r.call_on_close(close_listeners)
+    r.headers["Access-Control-Allow-Origin"] = "*"
+    return r
+
 @app.route("/complete")
+@rate_limit('complete')
 @get_db
 def tabComplete(db,fs):
     """
     Perform tab completion using IPython
     """
-    global xreq
-    if xreq==None:
-        xreq=IPReceiver(zmq.XREQ,db.get_ipython_port("xreq"))
-    header={"msg_id":str(uuid4())}
-    code=request.values["code"]
-    xreq.socket.send_json({"header":header, "msg_type":"complete_request", "content": { \
-                "text":"", "line":code, "block":code, "cursor_pos":request.values["pos"]}})
-    return jsonify({"completions":xreq.getMessages(header,True)[0]["content"]["matches"]})
+    matches=get_completer(db).complete(request.values["code"], int(request.values["pos"]))
+    return jsonify({"completions": matches})
+
+_completer_lock=threading.Lock()
+def get_completer(db):
+    """
+    Get the completion service, starting it the first time this is
+    called in a process.
+
+    :arg db: a database context, to find the kernel with
+    :rtype: completion.CompletionService
+    """
+    global completer
+    if completer is None:
+        # only one of the first concurrent requests starts the service
+        with _completer_lock:
+            if completer is None:
+                service=CompletionService(db.get_ipython_port("xreq"), **COMPLETION_CONFIG)
+                cache_metrics.instrument(service.cache, 'completion')
+                completer=service
+    return completer
 
 # This is disabled for now since it is also a security issue.
 # We should be able to turn it on or off from the config file
@@ -350,25 +1321,43 @@ def config(db, fs):
 
     return Response(s, content_type='text/plain')
 
-from hashlib import sha1
-
-_embedded_sagecell_cache = None
+# URL root -> (rendered script, gzipped script, ETag); the URL root comes
+# from the client's Host header, so the cache has to be bounded
+_embedded_sagecell_cache = cache_metrics.instrument(new_cache(maxsize=100), 'embedded_script')
 @app.route("/embedded_sagecell.js")
 def embedded():
-    global _embedded_sagecell_cache
-    if _embedded_sagecell_cache is None:
-        data = Response(render_template("embedded_sagecell.js"),
-                        content_type='application/javascript')
-        _embedded_sagecell_cache = (data, sha1(repr(data)).hexdigest())
-    data,datahash = _embedded_sagecell_cache
-    if request.environ.get('HTTP_IF_NONE_MATCH', None) == datahash:
+    # The script contains absolute URLs, so we render (and compress) it
+    # once for each URL root the server is reached by.
+    cached = _embedded_sagecell_cache.get(request.url_root)
+    if cached is None:
+        data = render_template("embedded_sagecell.js").encode('utf8')
+        cached = (data, _gzip(data, 9), '"%s"'%sha1(data).hexdigest())
+        _embedded_sagecell_cache.set(request.url_root, cached)
+    data, gzipped, etag = cached
+    if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
         response = make_response('',304)
     else:
-        response = make_response(data)
+        if request.accept_encodings['gzip']:
+            response = make_response(gzipped)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = make_response(data)
         response.headers['Content-Type'] = 'application/javascript; charset=utf-8'
-        response.headers['Etag']=datahash
+    response.headers['ETag'] = etag
+    response.headers['Vary'] = 'Accept-Encoding'
+    # third-party pages load this URL directly, so it can't be
+    # fingerprinted; let browsers reuse it for a while
+    response.headers['Cache-Control'] = 'public, max-age=%d' % EMBED_MAX_AGE
     return response
 
+@app.route("/metrics")
+def metrics_page():
+    """
+    Report the metrics of all the web server processes in the Prometheus
+    text format.
+    """
+    return Response(registry.render(), content_type='text/plain; version=0.0.4')
+
 @app.route("/favicon.ico")
 def favicon():
     return send_file("static/favicon.ico")
@@ -389,7 +1378,7 @@ if __name__ == "__main__":
     (sysargs, args) = parser.parse_known_args()
 
     if sysargs.quiet:
-        util.LOGGING=False
+        util.quiet()
 
     # instead of parsing extra arguments, just import them from sagecell_config
     default_config = {'port': 8080}